@@ -0,0 +1,190 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""
+Compiled versions of the hottest functions in umqtt_codec: the remaining
+length decoder, the frame splitter, the PUBLISH header parser and the topic
+matcher. umqtt_codec uses them in place of its own if this module has been
+built, with
+
+    python setup.py build_ext --inplace
+
+in this directory. They take and return exactly what the pure Python
+versions do. Buffers can be anything that supports the buffer protocol.
+"""
+from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, PyBUF_SIMPLE
+
+
+cdef int _decode(const unsigned char *p, Py_ssize_t pos, Py_ssize_t end,
+                 Py_ssize_t *length, Py_ssize_t *after) noexcept:
+    # Returns 0 with the length and the offset after it set, 1 if the field
+    # is not all there yet, 2 if it is longer than 4 bytes.
+    cdef Py_ssize_t value = 0
+    cdef Py_ssize_t mult = 1
+    cdef Py_ssize_t i = pos
+    cdef unsigned char byte
+    while i < end:
+        byte = p[i]
+        i += 1
+        value += (byte & 127)*mult
+        if byte < 128:
+            length[0] = value
+            after[0] = i
+            return 0
+        if i - pos == 4:
+            return 2
+        mult *= 128
+    return 1
+
+
+cdef int _get_buffer(object buf, Py_buffer *view, Py_ssize_t end) except -1:
+    PyObject_GetBuffer(buf, view, PyBUF_SIMPLE)
+    if end > view.len:
+        PyBuffer_Release(view)
+        raise IndexError('index out of range')
+    return 0
+
+
+def unpack_remaining_length(buf, Py_ssize_t pos, Py_ssize_t end):
+    cdef Py_buffer view
+    cdef Py_ssize_t length = 0
+    cdef Py_ssize_t after = 0
+    cdef int status
+    if pos < 0:
+        raise IndexError('index out of range')
+    _get_buffer(buf, &view, end)
+    status = _decode(<const unsigned char *>view.buf, pos, end, &length, &after)
+    PyBuffer_Release(&view)
+    if status == 0:
+        return (length, after)
+    if status == 1:
+        return (-1, 0)
+    return (-1, -1)
+
+
+def split_frames(buf, Py_ssize_t pos, Py_ssize_t end):
+    cdef Py_buffer view
+    cdef const unsigned char *p
+    cdef list frames = []
+    cdef Py_ssize_t length = 0
+    cdef Py_ssize_t start = 0
+    cdef int status
+    if pos < 0:
+        raise IndexError('index out of range')
+    _get_buffer(buf, &view, end)
+    p = <const unsigned char *>view.buf
+    try:
+        while end - pos >= 2:
+            status = _decode(p, pos+1, end, &length, &start)
+            if status == 1:
+                return (frames, pos, -1, 0)
+            if status == 2:
+                return (frames, pos, -1, -1)
+            if end - start < length:
+                return (frames, pos, length, start)
+            frames.append((p[pos], start, start+length))
+            pos = start + length
+        return (frames, pos, -1, 0)
+    finally:
+        PyBuffer_Release(&view)
+
+
+def unpack_publish_header(packet, int qos):
+    cdef Py_buffer view
+    cdef const unsigned char *p
+    cdef Py_ssize_t n
+    cdef Py_ssize_t slen
+    cdef Py_ssize_t pos
+    PyObject_GetBuffer(packet, &view, PyBUF_SIMPLE)
+    p = <const unsigned char *>view.buf
+    n = view.len
+    try:
+        if n < 2:
+            return (-1, 0, 0)
+        slen = (p[0] << 8) | p[1]
+        pos = 2+slen
+        if qos > 0:
+            if pos+2 > n:
+                return (-1, 0, 0)
+            return (slen, (p[pos] << 8) | p[pos+1], pos+2)
+        if pos > n:
+            return (-1, 0, 0)
+        return (slen, 0, pos)
+    finally:
+        PyBuffer_Release(&view)
+
+
+cdef str _text(object data):
+    # As umqtt_codec._text(): str as it is, UTF-8 bytes decoded, anything
+    # else refused with the same TypeError.
+    if isinstance(data, str):
+        return <str>data
+    if isinstance(data, (bytes, bytearray)):
+        return str(data, 'utf-8')
+    raise TypeError('topic must be str or bytes, not %s' % type(data).__name__)
+
+
+def topic_matches_sub(sub, topic):
+    """Check whether a topic matches a subscription. Both can be str or UTF-8
+    bytes.
+
+    For example:
+
+    foo/bar would match the subscription foo/# or +/bar
+    non/matching would not match the subscription non/+/+
+    """
+    return _matches(_text(sub), _text(topic))
+
+
+cdef bint _matches(str sub, str topic):
+    cdef bint result = True
+    cdef bint multilevel_wildcard = False
+    cdef Py_ssize_t slen = len(sub)
+    cdef Py_ssize_t tlen = len(topic)
+    cdef Py_ssize_t spos = 0
+    cdef Py_ssize_t tpos = 0
+
+    if slen > 0 and tlen > 0:
+        if (sub[0] == u'$' and topic[0] != u'$') or (topic[0] == u'$' and sub[0] != u'$'):
+            return False
+
+    while spos < slen and tpos < tlen:
+        if sub[spos] == topic[tpos]:
+            if tpos == tlen-1:
+                # Check for e.g. foo matching foo/#
+                if spos == slen-3 and sub[spos+1] == u'/' and sub[spos+2] == u'#':
+                    result = True
+                    multilevel_wildcard = True
+                    break
+
+            spos += 1
+            tpos += 1
+
+            if tpos == tlen and spos == slen-1 and sub[spos] == u'+':
+                spos += 1
+                result = True
+                break
+        else:
+            if sub[spos] == u'+':
+                spos += 1
+                while tpos < tlen and topic[tpos] != u'/':
+                    tpos += 1
+                if tpos == tlen and spos == slen:
+                    result = True
+                    break
+
+            elif sub[spos] == u'#':
+                multilevel_wildcard = True
+                if spos+1 != slen:
+                    result = False
+                    break
+                else:
+                    result = True
+                    break
+
+            else:
+                result = False
+                break
+
+    if not multilevel_wildcard and (tpos < tlen or spos < slen):
+        result = False
+
+    return result
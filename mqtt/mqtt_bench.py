@@ -0,0 +1,1433 @@
+"""Benchmarks for the umqtt2 client, its asyncio front end and the sans-IO
+protocol core.
+
+Run from this directory with CPython:
+
+    python mqtt_bench.py            # everything
+    python mqtt_bench.py read       # just the named benchmarks
+
+No broker is needed. The client is wired to an in-memory socket that counts
+the calls made on it, so the numbers show syscalls as well as time.
+"""
+import sys
+
+# select.py, os.py, errno.py etc. in this directory are micropython shims that
+# shadow the CPython standard library, so load the real modules before this
+# directory goes back on the path.
+_here = sys.path.pop(0)
+import asyncio
+import collections
+import errno
+import os
+import random
+import selectors
+import select
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import tracemalloc
+sys.path.insert(0, _here)
+
+import umqtt2 as mqtt
+import umqtt2_asyncio
+import umqtt_codec
+import umqtt_core
+from umqtt_codec import pack_ack
+import umqtt_store
+
+class CountingSocket(object):
+    """Stands in for a connected non-blocking socket.
+
+    recv()/recv_into() hand out at most `segment` bytes of `data` per call, the way a
+    kernel receive buffer is drained, and raises EAGAIN when it is empty.
+    send()/sendmsg() accept at most `send_limit` bytes per call. Everything
+    sent is collected in `sent`.
+    """
+    def __init__(self, data=b"", segment=65536, send_limit=1 << 20):
+        self._data = memoryview(data)
+        self._pos = 0
+        self._segment = segment
+        self._send_limit = send_limit
+        self.recv_calls = 0
+        self.send_calls = 0
+        self.sent = bytearray()
+
+    def _take(self, n):
+        self.recv_calls += 1
+        if self._pos >= len(self._data):
+            raise socket.error(errno.EAGAIN, "Resource temporarily unavailable")
+        n = min(n, self._segment)
+        chunk = self._data[self._pos:self._pos+n]
+        self._pos += len(chunk)
+        return chunk
+
+    def recv(self, n):
+        return bytes(self._take(n))
+
+    def recv_into(self, buf, nbytes=0):
+        chunk = self._take(nbytes or len(buf))
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+
+    def send(self, data):
+        self.send_calls += 1
+        data = data[:self._send_limit]
+        self.sent.extend(data)
+        return len(data)
+
+    def sendmsg(self, buffers):
+        self.send_calls += 1
+        nbytes = 0
+        for data in buffers:
+            data = data[:self._send_limit-nbytes]
+            self.sent.extend(data)
+            nbytes += len(data)
+            if nbytes == self._send_limit:
+                break
+        return nbytes
+
+    def fileno(self):
+        return -1
+
+    def close(self):
+        pass
+
+
+class LegacyReadClient(mqtt.Client):
+    """The byte-at-a-time _packet_read() the client used to have, kept here
+    so the read benchmark has something to compare against."""
+    def __init__(self, *args, **kwargs):
+        mqtt.Client.__init__(self, *args, **kwargs)
+        self._legacy_reset()
+
+    def _legacy_reset(self):
+        self._legacy = dict(command=0, have_remaining=0, remaining_count=0,
+                            remaining_mult=1, remaining_length=0,
+                            packet=b"", to_process=0)
+
+    def _packet_read(self):
+        p = self._legacy
+        if p['command'] == 0:
+            try:
+                command = self._sock.recv(1)
+            except socket.error as err:
+                if err.errno == errno.EAGAIN:
+                    return mqtt.MQTT_ERR_AGAIN
+                return 1
+            if len(command) == 0:
+                return 1
+            p['command'] = struct.unpack("!B", command)[0]
+
+        if p['have_remaining'] == 0:
+            while True:
+                try:
+                    byte = self._sock.recv(1)
+                except socket.error as err:
+                    if err.errno == errno.EAGAIN:
+                        return mqtt.MQTT_ERR_AGAIN
+                    return 1
+                byte = struct.unpack("!B", byte)[0]
+                p['remaining_count'] += 1
+                if p['remaining_count'] > 4:
+                    return mqtt.MQTT_ERR_PROTOCOL
+                p['remaining_length'] += (byte & 127)*p['remaining_mult']
+                p['remaining_mult'] *= 128
+                if (byte & 128) == 0:
+                    break
+            p['have_remaining'] = 1
+            p['to_process'] = p['remaining_length']
+
+        while p['to_process'] > 0:
+            try:
+                data = self._sock.recv(p['to_process'])
+            except socket.error as err:
+                if err.errno == errno.EAGAIN:
+                    return mqtt.MQTT_ERR_AGAIN
+                return 1
+            p['to_process'] -= len(data)
+            p['packet'] = p['packet'] + data
+
+        rc = self._packet_handle(p['command'], p['packet'])
+        self._legacy_reset()
+        return rc
+
+
+class CountingRealSocket(socket.socket):
+    """A real socket that counts its send and receive calls."""
+    def __init__(self, *args, **kwargs):
+        socket.socket.__init__(self, *args, **kwargs)
+        self.recv_calls = 0
+        self.send_calls = 0
+
+    def recv_into(self, *args):
+        self.recv_calls += 1
+        return socket.socket.recv_into(self, *args)
+
+    def send(self, *args):
+        self.send_calls += 1
+        return socket.socket.send(self, *args)
+
+    def sendmsg(self, *args):
+        self.send_calls += 1
+        return socket.socket.sendmsg(self, *args)
+
+
+def real_socketpair():
+    """Return (client side, broker side) of a connected socket pair."""
+    a, b = socket.socketpair()
+    a = CountingRealSocket(fileno=a.detach())
+    a.setblocking(0)
+    return a, b
+
+
+class LegacyWriteClient(mqtt.Client):
+    """One send() per packet from a list drained with pop(0), re-slicing the
+    packet on every partial write, as _packet_write() used to."""
+    def __init__(self, *args, **kwargs):
+        mqtt.Client.__init__(self, *args, **kwargs)
+        # One FIFO for everything.
+        self._out_packet = self._out_control = []
+
+    def _packet_write(self):
+        while self._out_packet:
+            packet = self._out_packet[0]
+            try:
+                write_length = self._sock.send(packet.packet[packet.pos:])
+            except socket.error as err:
+                if err.errno == errno.EAGAIN:
+                    return mqtt.MQTT_ERR_AGAIN
+                return 1
+            if write_length <= 0:
+                break
+            packet.to_process -= write_length
+            packet.pos += write_length
+            if packet.to_process == 0:
+                self._out_packet.pop(0)
+        return mqtt.MQTT_ERR_SUCCESS
+
+
+class LegacyRetryClient(mqtt.Client):
+    """Compares every in-flight message's timestamp with the clock to find
+    the ones due a retry, as _message_retry_check() used to."""
+    def _message_retry_check(self):
+        for messages in (self._out_messages, self._in_messages):
+            now = mqtt.time_func()
+            for m in messages.values():
+                if m.timestamp + self._message_retry < now:
+                    if m.state == mqtt.mqtt_ms_wait_for_puback or m.state == mqtt.mqtt_ms_wait_for_pubrec:
+                        m.timestamp = now
+                        m.dup = True
+                        self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
+
+
+class LegacyDispatchClient(mqtt.Client):
+    """Tests every registered filter with topic_matches_sub() in turn, as
+    _handle_on_message() used to."""
+    def __init__(self, *args, **kwargs):
+        mqtt.Client.__init__(self, *args, **kwargs)
+        self._legacy_filtered = []
+
+    def message_callback_add(self, sub, callback):
+        self._legacy_filtered.append((sub, callback))
+
+    def _handle_on_message(self, message):
+        matched = False
+        for t in self._legacy_filtered:
+            if mqtt.topic_matches_sub(t[0], message.topic):
+                t[1](self, self._userdata, message)
+                matched = True
+        if not matched and self.on_message:
+            self.on_message(self, self._userdata, message)
+
+
+class FifoClient(mqtt.Client):
+    """Queues everything in the one lane, in order, as _packet_queue() did
+    before acknowledgements and PINGREQ had a lane of their own. Only right
+    while the socket is too full for _packet_queue() to write anything."""
+    def _packet_queue(self, command, packet, mid, qos, info=None, topic=None):
+        rc = mqtt.Client._packet_queue(self, command, packet, mid, qos, info, topic)
+        while self._out_control:
+            self._out_packet.append(self._out_control.popleft())
+        return rc
+
+
+class LegacyConnectClient(mqtt.Client):
+    """Connects with a blocking socket.create_connection(), which looks the
+    host up and tries its addresses one at a time, as reconnect() used to."""
+    def reconnect(self):
+        self._reconnect_reset()
+        sock = socket.create_connection((self._host, self._port), source_address=(self._bind_address, 0))
+        return self._connect_socket(sock)
+
+
+class LegacyWakeup(object):
+    """A TCP socketpair with a byte sent for every packet queued, as the
+    network thread used to be woken."""
+    def __init__(self):
+        self._r, self._w = mqtt._socketpair_compat()
+        self.writes = 0
+
+    def fileno(self):
+        return self._r.fileno()
+
+    def set(self):
+        self.writes += 1
+        self._w.send(mqtt.sockpair_data)
+
+    def clear(self):
+        try:
+            self._r.recv(10000)
+        except socket.error as err:
+            if err.errno != errno.EAGAIN:
+                raise
+
+    def close(self):
+        self._r.close()
+        self._w.close()
+
+
+class LegacyCodec(object):
+    """The packing and unpacking the clients used to do: a struct.pack() per
+    remaining length byte, format strings built per packet, and packets
+    grown with extend()."""
+    @staticmethod
+    def pack_remaining_length(packet, remaining_length):
+        while True:
+            byte = remaining_length % 128
+            remaining_length = remaining_length // 128
+            if remaining_length > 0:
+                byte = byte | 0x80
+            packet.extend(struct.pack("!B", byte))
+            if remaining_length == 0:
+                return packet
+
+    @staticmethod
+    def unpack_remaining_length(buf, pos, end):
+        remaining_length = 0
+        remaining_mult = 1
+        i = pos
+        while i < end:
+            byte = buf[i]
+            i += 1
+            remaining_length += (byte & 127)*remaining_mult
+            if (byte & 128) == 0:
+                return (remaining_length, i)
+            if i - pos == 4:
+                return (-1, -1)
+            remaining_mult *= 128
+        return (-1, 0)
+
+    @staticmethod
+    def pack_str16(packet, data):
+        if isinstance(data, bytearray) or isinstance(data, bytes):
+            packet.extend(struct.pack("!H", len(data)))
+            packet.extend(data)
+        else:
+            udata = data.encode('utf-8')
+            pack_format = "!H" + str(len(udata)) + "s"
+            packet.extend(struct.pack(pack_format, len(udata), udata))
+
+    @staticmethod
+    def encode_publish(mid, utopic, payload, qos, retain, dup):
+        command = mqtt.PUBLISH | ((dup&0x1)<<3) | (qos<<1) | retain
+        packet = bytearray()
+        packet.extend(struct.pack("!B", command))
+        remaining_length = 2+len(utopic) + len(payload)
+        if qos > 0:
+            remaining_length = remaining_length + 2
+        LegacyCodec.pack_remaining_length(packet, remaining_length)
+        LegacyCodec.pack_str16(packet, utopic)
+        if qos > 0:
+            packet.extend(struct.pack("!H", mid))
+        packet.extend(payload)
+        return packet
+
+    @staticmethod
+    def encode_connect(protocol, proto_ver, keepalive, client_id, username, password):
+        remaining_length = 2+len(protocol) + 1+1+2 + 2+len(client_id) + 2+len(username) + 2+len(password)
+        packet = bytearray()
+        packet.extend(struct.pack("!B", mqtt.CONNECT))
+        LegacyCodec.pack_remaining_length(packet, remaining_length)
+        packet.extend(struct.pack("!H"+str(len(protocol))+"sBBH", len(protocol), protocol, proto_ver, 0xC2, keepalive))
+        LegacyCodec.pack_str16(packet, client_id)
+        LegacyCodec.pack_str16(packet, username)
+        LegacyCodec.pack_str16(packet, password)
+        return packet
+
+    @staticmethod
+    def encode_subscribe(command, mid, topics):
+        remaining_length = 2
+        for t in topics:
+            remaining_length = remaining_length + 2+len(t[0])+1
+        packet = bytearray()
+        packet.extend(struct.pack("!B", command))
+        LegacyCodec.pack_remaining_length(packet, remaining_length)
+        packet.extend(struct.pack("!H", mid))
+        for t in topics:
+            LegacyCodec.pack_str16(packet, t[0])
+            packet.extend(struct.pack("B", t[1]))
+        return packet
+
+    @staticmethod
+    def encode_puback(mid):
+        return struct.pack('!BBH', mqtt.PUBACK, 2, mid)
+
+    @staticmethod
+    def unpack_suback(packet):
+        pack_format = "!H" + str(len(packet)-2) + 's'
+        (mid, packet) = struct.unpack(pack_format, packet)
+        pack_format = "!" + "B"*len(packet)
+        return (mid, struct.unpack(pack_format, packet))
+
+    @staticmethod
+    def unpack_publish(packet, qos):
+        (slen,) = struct.unpack_from("!H", packet)
+        pos = 2+slen
+        mid = 0
+        if qos > 0:
+            (mid,) = struct.unpack_from("!H", packet, pos)
+            pos = pos+2
+        return (packet[2:2+slen], mid, pos)
+
+    @staticmethod
+    def unpack_mid(packet):
+        return struct.unpack("!H", packet)[0]
+
+
+class Codec(object):
+    """The same operations through umqtt_codec."""
+    pack_remaining_length = staticmethod(umqtt_codec.pack_remaining_length)
+    unpack_remaining_length = staticmethod(umqtt_codec.pure['unpack_remaining_length'])
+    pack_str16 = staticmethod(umqtt_codec.pack_str16)
+    encode_publish = staticmethod(umqtt_codec.encode_publish)
+    encode_subscribe = staticmethod(umqtt_codec.encode_subscribe)
+    unpack_suback = staticmethod(umqtt_codec.unpack_suback)
+
+    @staticmethod
+    def encode_connect(protocol, proto_ver, keepalive, client_id, username, password):
+        return umqtt_codec.encode_connect(protocol, proto_ver, keepalive, client_id, True,
+                                          username=username, password=password)
+
+    @staticmethod
+    def encode_puback(mid):
+        # As _send_command_with_mid() does it.
+        return pack_ack(mqtt.PUBACK, 2, mid)
+
+    @staticmethod
+    def unpack_publish(packet, qos, U16=umqtt_codec.U16):
+        (slen,) = U16.unpack_from(packet)
+        pos = 2+slen
+        mid = 0
+        if qos > 0:
+            (mid,) = U16.unpack_from(packet, pos)
+            pos = pos+2
+        return (packet[2:2+slen], mid, pos)
+
+    @staticmethod
+    def unpack_mid(packet, U16=umqtt_codec.U16):
+        return U16.unpack(packet)[0]
+
+
+def open_fds():
+    """Number of file descriptors the process has open, or 0 if /proc isn't
+    there to tell."""
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return 0
+
+
+def publish_frame(topic, payload, qos=0, mid=1):
+    """Encode a PUBLISH packet the way a broker would send it."""
+    utopic = topic.encode('utf-8')
+    body = struct.pack("!H", len(utopic)) + utopic
+    if qos > 0:
+        body += struct.pack("!H", mid)
+    body += payload
+    header = bytearray([mqtt.PUBLISH | (qos << 1)])
+    remaining_length = len(body)
+    while True:
+        byte = remaining_length % 128
+        remaining_length = remaining_length // 128
+        if remaining_length > 0:
+            byte |= 0x80
+        header.append(byte)
+        if remaining_length == 0:
+            return bytes(header) + body
+
+
+def drain(sock):
+    """Read whatever is waiting on a non-blocking socket."""
+    try:
+        while sock.recv(1 << 20):
+            pass
+    except socket.error as err:
+        if err.errno != errno.EAGAIN:
+            raise
+
+
+def connected_client(cls, sock):
+    client = cls()
+    client._sock = sock
+    client._state = mqtt.mqtt_cs_connected
+    return client
+
+
+def report(name, count, elapsed, **extra):
+    line = "  %-28s %9.0f msgs/s" % (name, count/elapsed)
+    for key in sorted(extra):
+        line += "  %s=%.3f" % (key, extra[key])
+    sys.stdout.write(line + "\n")
+
+
+def bench_read(count=20000, payload_size=64):
+    """Drain a stream of small QoS 0 PUBLISH packets through loop_read()."""
+    sys.stdout.write("read: %d x PUBLISH (%d byte payload)\n" % (count, payload_size))
+    frame = publish_frame("sonos/living_room/current_track", b"x"*payload_size)
+    stream = frame*count
+    for name, cls in (("byte-at-a-time recv", LegacyReadClient),
+                      ("buffered frame decoder", mqtt.Client)):
+        sock = CountingSocket(stream)
+        client = connected_client(cls, sock)
+        received = [0]
+
+        def on_message(client, userdata, message):
+            received[0] += 1
+        client.on_message = on_message
+
+        start = time.time()
+        while received[0] < count:
+            client.loop_read()
+        elapsed = time.time() - start
+        report(name, count, elapsed, syscalls_per_msg=sock.recv_calls/float(count))
+
+
+def bench_large(count=20, payload_size=512*1024, segment=16384):
+    """Receive large retained-style payloads that arrive in many segments."""
+    sys.stdout.write("large: %d x PUBLISH (%d KB payload, %d byte segments)\n"
+                  % (count, payload_size//1024, segment))
+    frame = publish_frame("sonos/living_room/state", b"{" + b"x"*(payload_size-2) + b"}")
+    for name, cls in (("packet + data", LegacyReadClient),
+                      ("recv_into preallocated", mqtt.Client)):
+        sock = CountingSocket(frame*count, segment)
+        client = connected_client(cls, sock)
+        received = [0]
+
+        def on_message(client, userdata, message):
+            received[0] += 1
+        client.on_message = on_message
+
+        tracemalloc.start()
+        start = time.time()
+        while received[0] < count:
+            client.loop_read()
+        elapsed = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        report(name, count, elapsed, MB_per_s=count*len(frame)/elapsed/1e6,
+               peak_alloc_MB=peak/1e6)
+
+
+def bench_acks(count=20000, batch=500):
+    """Receive QoS 1 PUBLISHes in bursts over a socketpair and write the
+    PUBACKs back."""
+    sys.stdout.write("acks: %d x QoS 1 PUBLISH -> PUBACK, bursts of %d\n" % (count, batch))
+    burst = b"".join(publish_frame("sensors/%d/temp" % (i % 50), b"21.5", qos=1, mid=i+1)
+                     for i in range(batch))
+    for name, cls in (("send() per packet", LegacyWriteClient),
+                      ("coalesced sendmsg()", mqtt.Client)):
+        sock, broker = real_socketpair()
+        client = connected_client(cls, sock)
+        start = time.time()
+        for i in range(count//batch):
+            broker.sendall(burst)
+            acked = 0
+            while acked < 4*batch:
+                client.loop_read()
+                acked += len(broker.recv(65536))
+        elapsed = time.time() - start
+        report(name, count, elapsed, packets_per_send=count/float(sock.send_calls))
+        sock.close()
+        broker.close()
+
+
+def bench_publish(count=20000, batch=1000, payload_size=16):
+    """Publish small QoS 0 messages over a socketpair, one publish() call
+    each and in publish_many() batches."""
+    sys.stdout.write("publish: %d x QoS 0 PUBLISH (%d byte payload), batches of %d\n"
+                  % (count, payload_size, batch))
+    payload = b"x"*payload_size
+    messages = [("sensors/%d/temp" % (i % 50), payload) for i in range(batch)]
+
+    def publish_loop(client):
+        for topic, payload in messages:
+            client.publish(topic, payload)
+
+    def publish_many(client):
+        client.publish_many(messages)
+
+    for name, func in (("publish() loop", publish_loop),
+                       ("publish_many()", publish_many)):
+        sock, broker = real_socketpair()
+        broker.setblocking(0)
+        client = connected_client(mqtt.Client, sock)
+        start = time.time()
+        for i in range(count//batch):
+            func(client)
+            while client._out_packet:
+                drain(broker)
+                client.loop_write()
+            drain(broker)
+        elapsed = time.time() - start
+        report(name, count, elapsed, sends_per_msg=sock.send_calls/float(count))
+        sock.close()
+        broker.close()
+
+
+def bench_inflight(windows=(100, 1000, 10000), payload_size=16):
+    """Publish a full window of QoS 1 messages plus as many again queued, then
+    feed back a PUBACK for each. Cost per ack should not grow with the
+    window."""
+    sys.stdout.write("inflight: QoS 1 PUBACK handling by in-flight window size\n")
+    payload = b"x"*payload_size
+    for window in windows:
+        count = 2*window
+        sock = CountingSocket()
+        client = connected_client(mqtt.Client, sock)
+        client.max_inflight_messages_set(window)
+        client.publish_many([("sensors/%d/temp" % (i % 50), payload, 1) for i in range(count)])
+        # Ack the newest in-flight message first, the worst case for a scan.
+        acks = b"".join(struct.pack("!BBH", mqtt.PUBACK, 2, mid)
+                        for mid in list(range(window, 0, -1)) + list(range(window+1, count+1)))
+        client._sock = CountingSocket(acks)
+        start = time.time()
+        while client._out_messages:
+            client.loop_read()
+        elapsed = time.time() - start
+        report("window %d" % window, count, elapsed)
+
+
+def bench_retry(windows=(100, 1000, 10000), checks=2000):
+    """Cost of looking for QoS 1 messages due a retry when none are, by
+    in-flight window size."""
+    sys.stdout.write("retry: %d retry checks with nothing due, by in-flight window size\n" % checks)
+    for window in windows:
+        for name, cls in (("scan", LegacyRetryClient), ("deadline heap", mqtt.Client)):
+            client = connected_client(cls, CountingSocket())
+            client.max_inflight_messages_set(window)
+            client.publish_many([("sensors/%d/temp" % (i % 50), b"21.5", 1) for i in range(window)])
+            client._now = mqtt.time_func()
+            start = time.time()
+            for i in range(checks):
+                client._message_retry_check()
+            elapsed = time.time() - start
+            report("%s, window %d" % (name, window), checks, elapsed, us_per_check=elapsed/checks*1e6)
+
+
+def bench_dispatch(count=20000, filter_counts=(10, 100, 1000)):
+    """Dispatch messages to message_callback_add() callbacks, with one
+    filter per device plus a couple of wildcards."""
+    sys.stdout.write("dispatch: %d messages by number of callback filters\n" % count)
+    messages = []
+    for i in range(count):
+        message = mqtt.MQTTMessage()
+        message.topic = "sonos/speaker%d/current_track" % (i % 50)
+        messages.append(message)
+
+    def on_track(client, userdata, message):
+        pass
+
+    for filters in filter_counts:
+        for name, cls in (("topic_matches_sub() scan", LegacyDispatchClient),
+                          ("topic trie", mqtt.Client)):
+            client = cls()
+            client.message_callback_add("sonos/+/current_track", on_track)
+            client.message_callback_add("sonos/#", on_track)
+            for i in range(filters-2):
+                client.message_callback_add("sonos/speaker%d/volume" % i, on_track)
+            # Best of three, the loops are short enough to be upset by noise.
+            best = None
+            for attempt in range(3):
+                start = time.time()
+                for message in messages:
+                    client._handle_on_message(message)
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            report("%s, %d" % (name, filters), count, best)
+
+
+def bench_topics(count=20000, topics=50, filters=100):
+    """Receive QoS 0 PUBLISHes on a small set of topics with callbacks
+    registered for them, with and without the topic cache."""
+    sys.stdout.write("topics: %d x PUBLISH over %d topics, %d callback filters\n"
+                  % (count, topics, filters))
+    stream = b"".join(publish_frame("sonos/speaker%d/current_track" % (i % topics), b"x"*16)
+                      for i in range(count))
+
+    def on_track(client, userdata, message):
+        pass
+
+    for name, size in (("no topic cache", 0),
+                       ("topic cache", mqtt.TOPIC_CACHE_SIZE)):
+        client = connected_client(mqtt.Client, CountingSocket(stream))
+        client.topic_cache_set(size)
+        client.message_callback_add("sonos/+/current_track", on_track)
+        for i in range(filters-1):
+            client.message_callback_add("sonos/speaker%d/volume" % i, on_track)
+        start = time.time()
+        while client._topic_cache_hits + client._topic_cache_misses < count:
+            client.loop_read()
+        elapsed = time.time() - start
+        stats = client.topic_cache_stats()
+        report(name, count, elapsed, hit_rate=stats['hits']/float(count))
+
+
+def bench_log(count=1000000, messages=20000):
+    """Cost of a per-packet debug log call, on its own and in the read path,
+    with nothing listening, with on_log set but filtered out by level, and
+    with on_log taking every message."""
+    sys.stdout.write("log: %d debug log calls, %d x QoS 1 PUBLISH read\n" % (count, messages))
+
+    def on_log(client, userdata, level, buf):
+        pass
+
+    client = mqtt.Client()
+    mid = 1234
+    start = time.time()
+    for i in range(count):
+        # How every log call used to be made.
+        client._easy_log(mqtt.MQTT_LOG_DEBUG, "Sending PUBACK (Mid: "+str(mid)+")")
+    elapsed = time.time() - start
+    report("concatenated, no on_log", count, elapsed, ns_per_call=elapsed/count*1e9)
+
+    for name, sink, level in (("no on_log", None, mqtt.MQTT_LOG_DEBUG),
+                              ("on_log, level ERR", on_log, mqtt.MQTT_LOG_ERR),
+                              ("on_log, level DEBUG", on_log, mqtt.MQTT_LOG_DEBUG)):
+        client.on_log = sink
+        client.log_level_set(level)
+        start = time.time()
+        for i in range(count):
+            if client._log_mask & mqtt.MQTT_LOG_DEBUG:
+                client._easy_log(mqtt.MQTT_LOG_DEBUG, "Sending PUBACK (Mid: %d)", mid)
+        elapsed = time.time() - start
+        report("lazy, " + name, count, elapsed, ns_per_call=elapsed/count*1e9)
+
+    stream = b"".join(publish_frame("sonos/living_room/volume", b"42", qos=1, mid=i % 65535 + 1)
+                      for i in range(messages))
+    for name, sink, level in (("read, no on_log", None, mqtt.MQTT_LOG_DEBUG),
+                              ("read, on_log level ERR", on_log, mqtt.MQTT_LOG_ERR),
+                              ("read, on_log level DEBUG", on_log, mqtt.MQTT_LOG_DEBUG)):
+        client = connected_client(mqtt.Client, CountingSocket(stream))
+        client.on_log = sink
+        client.log_level_set(level)
+        received = [0]
+
+        def on_message(client, userdata, message):
+            received[0] += 1
+        client.on_message = on_message
+
+        start = time.time()
+        while received[0] < messages:
+            client.loop_read()
+        elapsed = time.time() - start
+        report(name, messages, elapsed)
+
+
+def bench_asyncio(count=5000):
+    """Latency from a PUBLISH arriving on the socket to an asyncio consumer
+    having it: Client.loop() in a thread handing messages over with
+    call_soon_threadsafe(), against AsyncClient.messages()."""
+    sys.stdout.write("asyncio: %d x QoS 0 PUBLISH, one at a time\n" % count)
+    frame = publish_frame("sonos/living_room/volume", b"42")
+
+    async def threaded():
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue()
+        a, b = real_socketpair()
+        client = connected_client(mqtt.Client, a)
+
+        def on_message(client, userdata, message):
+            loop.call_soon_threadsafe(queue.put_nowait, bytes(message.payload))
+        client.on_message = on_message
+
+        running = [True]
+
+        def run():
+            while running[0]:
+                client.loop(0.1)
+        thread = threading.Thread(target=run)
+        thread.start()
+        start = time.time()
+        for i in range(count):
+            b.send(frame)
+            await queue.get()
+        elapsed = time.time() - start
+        running[0] = False
+        thread.join()
+        b.close()
+        return elapsed
+
+    async def native():
+        loop = asyncio.get_event_loop()
+        a, b = real_socketpair()
+        client = connected_client(umqtt2_asyncio.AsyncClient, a)
+        client._loop = loop
+        client._io_update()
+        messages = client.messages("#")
+        start = time.time()
+        for i in range(count):
+            b.send(frame)
+            await messages.__anext__()
+        elapsed = time.time() - start
+        await messages.aclose()
+        b.close()
+        return elapsed
+
+    for name, func in (("loop() thread", threaded), ("AsyncClient", native)):
+        elapsed = asyncio.run(func())
+        report(name, count, elapsed, us_per_msg=elapsed/count*1e6)
+
+
+def bench_threaded(count=2000, threads=4):
+    """Publish QoS 0 messages from worker threads while loop_start() runs the
+    network thread. Each worker waits for its message to be written before
+    publishing the next, so the time per message is the hand-over latency.
+    Compares waking the network thread through a TCP socketpair on every
+    packet with the coalesced eventfd/pipe wakeup."""
+    sys.stdout.write("threaded: %d x QoS 0 PUBLISH from %d threads\n" % (count, threads))
+    for name, wakeup_cls in (("socketpair, every packet", LegacyWakeup),
+                             ("coalesced wakeup", mqtt._Wakeup)):
+        fds = open_fds()
+        wakeup = wakeup_cls()
+        fds = open_fds() - fds
+
+        a, b = real_socketpair()
+        client = connected_client(mqtt.Client, a)
+        client._wakeup = wakeup
+        client.loop_start()
+
+        def broker():
+            while b.recv(65536):
+                pass
+        broker_thread = threading.Thread(target=broker)
+        broker_thread.start()
+
+        def worker():
+            for i in range(count // threads):
+                info = client.publish("sonos/living_room/volume", b"42")
+                while not info.is_published():
+                    time.sleep(0)
+
+        workers = [threading.Thread(target=worker) for i in range(threads)]
+        start = time.time()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.time() - start
+        client.loop_stop()
+        a.close()
+        broker_thread.join()
+        wakeup.close()
+        report(name, count, elapsed, sends_per_msg=a.send_calls/float(count),
+               wakeups_per_msg=wakeup.writes/float(count), fds=fds)
+
+
+def bench_protocol(count=20000, payload_size=64, chunk=4096):
+    """The sans-IO protocol core on its own, with no sockets: bytes in, events
+    and bytes out. Shows what the protocol costs before any transport."""
+    sys.stdout.write("protocol: %d x PUBLISH (%d byte payload), %d byte reads\n"
+                     % (count, payload_size, chunk))
+    payload = b"x"*payload_size
+    for qos in (0, 1):
+        stream = b"".join(publish_frame("sonos/living_room/current_track", payload, qos, i % 65535 + 1)
+                          for i in range(count))
+        proto = umqtt_core.MQTTProtocol("bench")
+        proto.connect(60)
+        proto.receive_data(b"\x20\x02\x00\x00")
+        proto.data_to_send()
+        received = 0
+        sent = 0
+        start = time.time()
+        for pos in range(0, len(stream), chunk):
+            received += len(proto.receive_data(stream[pos:pos+chunk]))
+            sent += len(proto.data_to_send())
+        elapsed = time.time() - start
+        assert received == count
+        report("receive QoS %d" % qos, count, elapsed, bytes_out_per_msg=sent/float(count))
+
+    for qos in (0, 1):
+        proto = umqtt_core.MQTTProtocol("bench")
+        proto.max_inflight = count
+        proto.connect(60)
+        proto.receive_data(b"\x20\x02\x00\x00")
+        proto.data_to_send()
+        acks = bytearray()
+        sent = 0
+        start = time.time()
+        for i in range(count):
+            mid = proto.publish("sonos/living_room/current_track", payload, qos)
+            if qos:
+                acks.extend(struct.pack("!BBH", 0x40, 2, mid))
+        sent += len(proto.data_to_send())
+        completed = len(proto.receive_data(bytes(acks)))
+        elapsed = time.time() - start
+        assert completed == (count if qos else 0) and proto.inflight() == 0
+        report("publish QoS %d" % qos, count, elapsed, bytes_out_per_msg=sent/float(count))
+
+    # One large PUBLISH trickling in: each read should only cost its own
+    # bytes, not a copy of everything held so far.
+    stream = publish_frame("sonos/living_room/album_art", b"x"*(1 << 20))
+    proto = umqtt_core.MQTTProtocol("bench")
+    proto.connect(60)
+    proto.receive_data(b"\x20\x02\x00\x00")
+    reads = (len(stream) + chunk - 1) // chunk
+    start = time.time()
+    for pos in range(0, len(stream), chunk):
+        received = proto.receive_data(stream[pos:pos+chunk])
+    elapsed = time.time() - start
+    assert len(received) == 1
+    report("1 MB PUBLISH in %d byte reads" % chunk, reads, elapsed)
+
+    # tick() with a full window and nothing due: looks at the earliest
+    # retry only.
+    proto = umqtt_core.MQTTProtocol("bench")
+    proto.max_inflight = count
+    proto.connect(0)
+    proto.receive_data(b"\x20\x02\x00\x00")
+    for i in range(count):
+        proto.publish("sonos/living_room/current_track", payload, 1)
+    proto.data_to_send()
+    start = time.time()
+    for i in range(1000):
+        proto.tick(1)
+        proto.next_deadline()
+    report("tick, %d in flight" % count, 1000, time.time() - start)
+
+
+def bench_codec(count=100000):
+    """Encode and decode each packet type on its own, with the old format
+    string based code and with umqtt_codec."""
+    sys.stdout.write("codec: %d of each packet type\n" % count)
+    topic = b"sonos/living_room/current_track"
+    small = b"x"*16
+    large = b"x"*1024
+    topics = [(b"sonos/+/current_track", 1), (b"sonos/+/volume", 0), (b"alarms/#", 2)]
+    suback = memoryview(b"\x00\x07\x01\x00\x02")
+    publish = memoryview(bytes(umqtt_codec.encode_publish(7, topic, small, 1, False, False))[2:])
+    puback = memoryview(b"\x00\x07")
+    cases = [
+        ("remaining length encode", lambda c: c.pack_remaining_length(bytearray(), 300)),
+        ("remaining length decode, 1", lambda c: c.unpack_remaining_length(b"\x30\x2c", 1, 2)),
+        ("remaining length decode, 2", lambda c: c.unpack_remaining_length(b"\x30\xac\x02", 1, 3)),
+        ("CONNECT encode", lambda c: c.encode_connect(b"MQTT", 4, 60, "bench-client", "user", "password")),
+        ("PUBLISH encode, 16 bytes", lambda c: c.encode_publish(7, topic, small, 1, False, False)),
+        ("PUBLISH encode, 1 KB", lambda c: c.encode_publish(7, topic, large, 1, False, False)),
+        ("PUBACK encode", lambda c: c.encode_puback(7)),
+        ("SUBSCRIBE encode", lambda c: c.encode_subscribe(0x82, 7, topics)),
+        ("PUBLISH header decode", lambda c: c.unpack_publish(publish, 1)),
+        ("PUBACK decode", lambda c: c.unpack_mid(puback)),
+        ("SUBACK decode", lambda c: c.unpack_suback(suback)),
+    ]
+    for name, op in cases:
+        assert op(LegacyCodec) == op(Codec), name
+        # Best of five, the loops are short enough to be upset by noise. The
+        # old and new code take turns so that a change of clock speed part
+        # way through hits both.
+        best = [None, None]
+        for attempt in range(5):
+            for (n, codec) in enumerate((LegacyCodec, Codec)):
+                start = time.time()
+                for i in range(count):
+                    op(codec)
+                elapsed = time.time() - start
+                if best[n] is None or elapsed < best[n]:
+                    best[n] = elapsed
+        rates = [count/best[0], count/best[1]]
+        line = "  %-28s %9.0f -> %9.0f ops/s  speedup=%.2f" % (name, rates[0], rates[1], rates[1]/rates[0])
+        sys.stdout.write(line + "\n")
+
+
+def bench_group(client_counts=(100, 400, 2000), rounds=200, active=10):
+    """Deliver a QoS 0 PUBLISH to a few of many connected clients at a time.
+    Compares calling loop(0) on every client in turn, one select() each, with
+    a ClientGroup that waits on all of them with one selector. loop() is
+    left out once there are more sockets than select() can take."""
+    for clients in client_counts:
+        sys.stdout.write("group: %d clients, %d rounds of %d PUBLISH\n" % (clients, rounds, active))
+        frame = publish_frame("sonos/living_room/volume", b"42")
+        for name in ("loop() on each client", "ClientGroup"):
+            pairs = [real_socketpair() for i in range(clients)]
+            if name != "ClientGroup" and pairs[-1][1].fileno() >= 1024:
+                sys.stdout.write("  %-28s (sockets beyond select() limit)\n" % name)
+                for a, b in pairs:
+                    a.close()
+                    b.close()
+                continue
+            received = [0]
+
+            def on_message(client, userdata, message):
+                received[0] += 1
+            group = mqtt.ClientGroup()
+            members = []
+            for a, b in pairs:
+                client = connected_client(mqtt.Client, a)
+                client.on_message = on_message
+                members.append(client)
+                if name == "ClientGroup":
+                    group.add(client)
+
+            rng = random.Random(1)
+            passes = 0
+            start = time.time()
+            for r in range(rounds):
+                for i in rng.sample(range(clients), active):
+                    pairs[i][1].send(frame)
+                target = (r+1)*active
+                while received[0] < target:
+                    if name == "ClientGroup":
+                        group.loop(0)
+                        passes += 1
+                    else:
+                        for client in members:
+                            client.loop(0)
+                            passes += 1
+            elapsed = time.time() - start
+            report(name, rounds*active, elapsed, polls_per_msg=passes/float(rounds*active))
+            group.close()
+            for a, b in pairs:
+                a.close()
+                b.close()
+
+
+class ConnackBroker(object):
+    """Accepts connections on a thread of its own and answers each CONNECT
+    with a CONNACK."""
+    def __init__(self):
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(4096)
+        self.port = self.listener.getsockname()[1]
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            for key, mask in self.selector.select(0.1):
+                if key.fileobj is self.listener:
+                    sock = self.listener.accept()[0]
+                    self.selector.register(sock, selectors.EVENT_READ)
+                    continue
+                try:
+                    data = key.fileobj.recv(4096)
+                except socket.error:
+                    data = b""
+                if not data:
+                    self.selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                elif data[0] & 0xF0 == mqtt.CONNECT:
+                    key.fileobj.sendall(b"\x20\x02\x00\x00")
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+
+
+def bench_connect(clients=500):
+    """Connect many clients to "localhost" at once, as after a broker
+    restart. Compares blocking connects, each looking the name up again,
+    with a ClientGroup, whose connects are non-blocking and share one
+    cached lookup."""
+    sys.stdout.write("connect: %d clients\n" % clients)
+    broker = ConnackBroker()
+    lookups = [0]
+    real_getaddrinfo = socket.getaddrinfo
+
+    def counting_getaddrinfo(*args, **kwargs):
+        lookups[0] += 1
+        return real_getaddrinfo(*args, **kwargs)
+    socket.getaddrinfo = counting_getaddrinfo
+    try:
+        for name in ("blocking create_connection", "ClientGroup"):
+            mqtt._address_cache.clear()
+            lookups[0] = 0
+            connected = [0]
+
+            def on_connect(client, userdata, flags, rc):
+                connected[0] += 1
+            group = mqtt.ClientGroup()
+            members = []
+            start = time.time()
+            for i in range(clients):
+                if name == "ClientGroup":
+                    client = mqtt.Client("bench-%d" % i)
+                    client.on_connect = on_connect
+                    group.add(client)
+                    client.connect_async("localhost", broker.port)
+                else:
+                    client = LegacyConnectClient("bench-%d" % i)
+                    client.on_connect = on_connect
+                    client.connect("localhost", broker.port)
+                    group.add(client)
+                members.append(client)
+            while connected[0] < clients:
+                group.loop(1.0)
+            elapsed = time.time() - start
+            report(name, clients, elapsed, lookups=lookups[0])
+            for client in members:
+                client._sock.close()
+            group.close()
+    finally:
+        socket.getaddrinfo = real_getaddrinfo
+        broker.close()
+
+
+def bench_priority(count=500, payload_size=16384):
+    """Queue a burst of PUBLISHes faster than the socket can take them, then
+    a PINGREQ, and see how much the broker has to read before the PINGREQ
+    reaches it."""
+    sys.stdout.write("priority: PINGREQ behind %d x PUBLISH (%d byte payload)\n" % (count, payload_size))
+    payload = b"x"*payload_size
+    for name, cls in (("one FIFO", FifoClient), ("control lane", mqtt.Client)):
+        sock, broker = real_socketpair()
+        broker.setblocking(0)
+        client = connected_client(cls, sock)
+        for i in range(count):
+            client.publish("sonos/living_room/log", payload)
+        start = time.time()
+        client._send_pingreq()
+        depth = client.queue_stats()
+
+        stream = bytearray()
+        ping_at = None
+        while ping_at is None:
+            client.loop_write()
+            try:
+                while True:
+                    data = broker.recv(1 << 20)
+                    if not data:
+                        break
+                    stream += data
+            except socket.error as err:
+                if err.errno != errno.EAGAIN:
+                    raise
+            frames = umqtt_codec.split_frames(stream, 0, len(stream))[0]
+            for (command, body_start, body_end) in frames:
+                if command == mqtt.PINGREQ:
+                    ping_at = body_start - 2
+                    break
+        elapsed = time.time() - start
+        sys.stdout.write("  %-28s %9.3f ms to PINGREQ  bytes_before=%d  publish_depth=%d  control_depth=%d\n"
+                         % (name, elapsed*1000, ping_at, depth['publish'], depth['control']))
+        sock.close()
+        broker.close()
+
+
+def slow_broker(sock, latency, rate, stop):
+    """Acknowledge each QoS 1 PUBLISH read from sock latency seconds after it
+    arrives and no faster than rate a second, like a broker with a queue in
+    front of it: the more in flight, the longer each waits."""
+    stream = bytearray()
+    due = collections.deque()
+    last = 0
+    while not stop.is_set():
+        timeout = max(0, due[0][0] - time.time()) if due else 0.05
+        if select.select([sock], [], [], timeout)[0]:
+            data = sock.recv(1 << 16)
+            if not data:
+                break
+            stream += data
+            now = time.time()
+            frames, pos = umqtt_codec.split_frames(stream, 0, len(stream))[:2]
+            for (command, body_start, body_end) in frames:
+                if command & 0xF0 == mqtt.PUBLISH:
+                    mid_at = body_start + 2 + struct.unpack_from("!H", stream, body_start)[0]
+                    last = max(now + latency, last + 1.0/rate)
+                    due.append((last, struct.unpack_from("!H", stream, mid_at)[0]))
+            del stream[:pos]
+        now = time.time()
+        acks = []
+        while due and due[0][0] <= now:
+            acks.append(struct.pack("!BBH", mqtt.PUBACK, 2, due.popleft()[1]))
+        if acks:
+            sock.sendall(b"".join(acks))
+
+
+def bench_autotune(count=2000, latency=0.02, rate=4000, target=0.05):
+    """Publish a burst of QoS 1 messages to a broker that takes latency
+    seconds to ack each and handles rate a second. A small fixed window
+    leaves the broker idle, a large one queues messages in it; the adaptive
+    window should get near the broker's rate with acks near the target."""
+    sys.stdout.write("autotune: %d x QoS 1 PUBLISH, broker %.0f ms latency, %d msgs/s, target %.0f ms\n"
+                     % (count, latency*1000, rate, target*1000))
+    messages = [("sensors/%d/temp" % (i % 50), b"21.5", 1) for i in range(count)]
+    for name in ("fixed 20", "fixed 1000", "auto"):
+        sock, broker = real_socketpair()
+        stop = threading.Event()
+        thread = threading.Thread(target=slow_broker, args=(broker, latency, rate, stop))
+        thread.start()
+        client = connected_client(mqtt.Client, sock)
+        if name == "auto":
+            client.max_inflight_messages_auto(target)
+        else:
+            client.max_inflight_messages_set(int(name.split()[1]))
+        start = time.time()
+        client.publish_many(messages)
+        while client._out_messages or client._out_message_queue:
+            client.loop(0.01)
+        elapsed = time.time() - start
+        stop.set()
+        thread.join()
+        stats = client.inflight_stats()
+        report(name, count, elapsed, rtt_p50_ms=stats['rtt_p50']*1000,
+               rtt_p99_ms=stats['rtt_p99']*1000, window=stats['window'])
+        sock.close()
+        broker.close()
+
+
+def bench_store(count=2000, batch=100):
+    """Publish QoS 1 messages and read back their PUBACKs with and without a
+    FileSessionStore. publish() commits each message on its own, the
+    publish_many() batches and the PUBACKs read in one go are committed
+    together."""
+    sys.stdout.write("store: %d x QoS 1 PUBLISH and PUBACK, fsync on commit\n" % count)
+    messages = [("sensors/%d/temp" % (i % 50), b"21.5", 1) for i in range(count)]
+    acks = b"".join(struct.pack("!BBH", mqtt.PUBACK, 2, mid) for mid in range(1, count+1))
+    directory = tempfile.mkdtemp()
+    for (name, stored, batched) in (("memory, publish()", False, False),
+                                    ("file, publish()", True, False),
+                                    ("memory, publish_many(%d)" % batch, False, True),
+                                    ("file, publish_many(%d)" % batch, True, True)):
+        client = connected_client(mqtt.Client, CountingSocket())
+        client.max_inflight_messages_set(0)
+        store = None
+        if stored:
+            store = umqtt_store.FileSessionStore(os.path.join(directory, "session"))
+            client.session_store_set(store)
+        start = time.time()
+        if not batched:
+            for (topic, payload, qos) in messages:
+                client.publish(topic, payload, qos)
+        else:
+            for i in range(0, count, batch):
+                client.publish_many(messages[i:i+batch])
+        client._sock = CountingSocket(acks)
+        while client._out_messages:
+            client.loop_read()
+        client.loop_misc()
+        elapsed = time.time() - start
+        if store is None:
+            report(name, count, elapsed)
+        else:
+            stats = store.stats()
+            store.close()
+            report(name, count, elapsed, commits=stats['commits'], compactions=stats['compactions'])
+    shutil.rmtree(directory)
+
+
+def bench_offline(count=20000, in_memory=1000, payload_size=64):
+    """Publish QoS 0 messages while disconnected into the offline queue,
+    then connect and drain it, with the whole queue in memory and with all
+    but in_memory messages spilled to a segment file."""
+    sys.stdout.write("offline: %d x PUBLISH (%d byte payload) queued and drained\n" % (count, payload_size))
+    payload = b"x"*payload_size
+    directory = tempfile.mkdtemp()
+    for (name, limit, path) in (("memory", count, None),
+                                ("spill, %d in memory" % in_memory, in_memory, os.path.join(directory, "spill"))):
+        client = mqtt.Client()
+        client.offline_queue_set(limit, max_bytes=count*(payload_size+32), spill_path=path,
+                                 spill_max_bytes=count*(payload_size+32))
+        start = time.time()
+        for i in range(count):
+            client.publish("sensors/%d/temp" % (i % 50), payload)
+        queued = time.time() - start
+        stats = client.offline_stats()
+        sock = CountingSocket()
+        client._sock = sock
+        client._state = mqtt.mqtt_cs_connected
+        start = time.time()
+        while client._offline:
+            client.loop_misc()
+            client.loop_write()
+        drained = time.time() - start
+        report("%s, queue" % name, count, queued, file_mb=stats['file_bytes']/1e6)
+        report("%s, drain" % name, count, drained, mb_sent=len(sock.sent)/1e6)
+        client.offline_queue_set(0)
+    shutil.rmtree(directory)
+
+
+class SlowLinkSocket(CountingSocket):
+    """A CountingSocket that takes no more than budget bytes in all before
+    raising EAGAIN, like a link that has filled up. Top budget up to let
+    more through."""
+    def __init__(self):
+        CountingSocket.__init__(self)
+        self.budget = 0
+
+    def sendmsg(self, buffers):
+        if self.budget <= 0:
+            raise socket.error(errno.EAGAIN, "Resource temporarily unavailable")
+        self._send_limit = self.budget
+        nbytes = CountingSocket.sendmsg(self, buffers)
+        self.budget -= nbytes
+        return nbytes
+
+
+def bench_coalesce(count=10000, topics=5, link_bytes=256, flush_every=10):
+    """Publish QoS 0 volume levels on a few topics faster than a slow link
+    takes them: link_bytes get through after every flush_every publishes.
+    Queued, every level is sent eventually, long after it was current. With
+    coalescing only the newest level per topic waiting in the queue is."""
+    sys.stdout.write("coalesce: %d x QoS 0 PUBLISH over %d topics, %d bytes per %d publishes\n"
+                     % (count, topics, link_bytes, flush_every))
+    for (name, enabled) in (("queue everything", False), ("coalesce", True)):
+        sock = SlowLinkSocket()
+        client = connected_client(mqtt.Client, sock)
+        client.coalesce_set(enabled)
+        start = time.time()
+        for i in range(count):
+            client.publish("sonos/room%d/volume" % (i % topics), '{"action":"volume", "level":%d}' % (i % 100))
+            if i % flush_every == 0:
+                sock.budget = link_bytes
+                client.loop_write()
+        backlog = len(client._out_packet)
+        while client._out_packet:
+            sock.budget = link_bytes
+            client.loop_write()
+        elapsed = time.time() - start
+        stats = client.queue_stats()
+        report(name, count, elapsed, kb_sent=len(sock.sent)/1e3, backlog_at_end=backlog,
+               coalesced=stats['coalesced'])
+
+
+def bench_last_value(count=20000, rooms=500, lookups=2000):
+    """Read PUBLISH packets for rooms x 2 topics with and without the last
+    value cache, then look up one room's topics with snapshot() against
+    scanning every cached topic with topic_matches_sub(), and time loading
+    the saved cache the way a client does at startup."""
+    sys.stdout.write("last_value: %d x PUBLISH over %d topics, %d lookups\n"
+                     % (count, rooms*2, lookups))
+    topics = ["sonos/room%d/%s" % (i % rooms, ("current_track", "volume")[(i // rooms) % 2])
+              for i in range(count)]
+    stream = b"".join(publish_frame(topic, b'{"title":"x"}') for topic in topics)
+    for (name, enabled) in (("read, no cache", False), ("read, cache", True)):
+        client = connected_client(mqtt.Client, CountingSocket(stream))
+        client.last_value_cache_set(enabled)
+        received = [0]
+
+        def on_message(client, userdata, message):
+            received[0] += 1
+        client.on_message = on_message
+
+        start = time.time()
+        while received[0] < count:
+            client.loop_read()
+        report(name, count, time.time() - start)
+    cached = dict(client.snapshot("#"))
+    start = time.time()
+    for i in range(lookups):
+        sub = "sonos/room%d/+" % (i % rooms)
+        [m for (topic, m) in cached.items() if mqtt.topic_matches_sub(sub, topic)]
+    report("linear scan", lookups, time.time() - start)
+    start = time.time()
+    for i in range(lookups):
+        client.snapshot("sonos/room%d/+" % (i % rooms))
+    report("snapshot()", lookups, time.time() - start)
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "last_values")
+    client.last_value_cache_set(True, path)
+    for m in cached.values():
+        client._last_value_put(m)
+    start = time.time()
+    client.last_value_save()
+    saved = time.time() - start
+    client = mqtt.Client()
+    start = time.time()
+    client.last_value_cache_set(True, path)
+    report("load at startup", len(cached), time.time() - start, save_ms=saved*1000)
+    shutil.rmtree(directory)
+
+
+def bench_cython(count=200000):
+    """Time the functions in umqtt_codec that have compiled versions, pure
+    Python against the _umqtt_codec extension. tests/test_codec.py holds the
+    two to the same results."""
+    if not umqtt_codec.compiled:
+        sys.stdout.write("cython: _umqtt_codec is not built (python setup.py build_ext --inplace)\n")
+        return
+    import _umqtt_codec
+    sys.stdout.write("cython: %d calls each\n" % count)
+    stream = bytearray()
+    for i in range(50):
+        stream += publish_frame("sonos/living_room/current_track", b"x"*64, qos=1, mid=i+1)
+    stream = memoryview(stream)
+    publish = stream[2:]
+    cases = [
+        ("remaining length decode, 1", "unpack_remaining_length", (b"\x30\x2c", 1, 2), count),
+        ("remaining length decode, 2", "unpack_remaining_length", (b"\x30\xac\x02", 1, 3), count),
+        ("split 50 PUBLISH frames", "split_frames", (stream, 0, len(stream)), count//50),
+        ("PUBLISH header decode", "unpack_publish_header", (publish, 1), count),
+        ("topic match", "topic_matches_sub", ("sonos/+/current_track", "sonos/living_room/current_track"), count),
+        ("topic match, #", "topic_matches_sub", ("alarms/#", "alarms/kitchen/smoke"), count),
+    ]
+    for label, name, args, n in cases:
+        rates = []
+        for func in (umqtt_codec.pure[name], getattr(_umqtt_codec, name)):
+            best = None
+            for attempt in range(3):
+                start = time.time()
+                for i in range(n):
+                    func(*args)
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            rates.append(n/best)
+        line = "  %-28s %9.0f -> %9.0f ops/s  speedup=%.2f" % (label, rates[0], rates[1], rates[1]/rates[0])
+        sys.stdout.write(line + "\n")
+
+
+BENCHMARKS = [
+    ("read", bench_read),
+    ("large", bench_large),
+    ("acks", bench_acks),
+    ("publish", bench_publish),
+    ("inflight", bench_inflight),
+    ("retry", bench_retry),
+    ("dispatch", bench_dispatch),
+    ("topics", bench_topics),
+    ("log", bench_log),
+    ("asyncio", bench_asyncio),
+    ("threaded", bench_threaded),
+    ("protocol", bench_protocol),
+    ("codec", bench_codec),
+    ("cython", bench_cython),
+    ("group", bench_group),
+    ("connect", bench_connect),
+    ("priority", bench_priority),
+    ("autotune", bench_autotune),
+    ("store", bench_store),
+    ("offline", bench_offline),
+    ("coalesce", bench_coalesce),
+    ("last_value", bench_last_value),
+]
+
+
+def main(names):
+    for name, func in BENCHMARKS:
+        if not names or name in names:
+            func()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
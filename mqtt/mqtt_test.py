@@ -1,7 +1,5 @@
 import umqtt3 as mqtt
 
-import utime as time
-
 # The callback for when the client receives a CONNACK response from the server.
 def on_connect(client, userdata, flags, rc):
     print("Connected with result code "+str(rc))
@@ -13,7 +11,7 @@ def on_connect(client, userdata, flags, rc):
 # The callback for when a PUBLISH message is received from the server.
 def on_message(client, userdata, msg):
     #print(msg.topic+" "+str(msg.payload))
-    print('new'+msg['topic']+str(msg['payload']))
+    print('new'+msg.topic+str(msg.payload))
 
 client = mqtt.Client()
 client.on_connect = on_connect
@@ -21,7 +19,6 @@ client.on_message = on_message
 
 client.connect("54.173.234.69", 1883, 60)
 
-while 1:
-    client.loop()
-    print(time.time())
-    time.sleep(4)
+# Blocks, waking only for incoming packets and keepalive pings, and
+# reconnects if the connection drops.
+client.loop_forever()
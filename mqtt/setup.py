@@ -0,0 +1,12 @@
+import sys
+
+# os.py, select.py etc. in this directory are micropython shims that shadow
+# the CPython standard library, so take this directory off the path first.
+sys.path.pop(0)
+
+from distutils.core import setup
+from Cython.Build import cythonize
+
+setup(
+    ext_modules=cythonize("_umqtt_codec.pyx"),
+)
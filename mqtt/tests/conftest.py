@@ -0,0 +1,21 @@
+"""Test setup: the mqtt directory on the path, and a broker fixture."""
+import os
+import sys
+
+import pytest
+
+# os.py, select.py etc. in the mqtt directory are MicroPython shims that
+# shadow the standard library, so the directory goes at the end of the path,
+# after the real modules.
+MQTT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if MQTT_DIR not in sys.path:
+    sys.path.append(MQTT_DIR)
+
+from fakebroker import FakeBroker
+
+
+@pytest.fixture
+def broker():
+    b = FakeBroker()
+    yield b
+    b.close()
@@ -0,0 +1,225 @@
+"""A scripted MQTT broker on a localhost socket, so the clients are tested
+through their public API over a real connection. Packets are encoded and
+decoded here independently of the codec under test."""
+import select
+import socket
+import struct
+import time
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+PUBREC = 0x50
+PUBREL = 0x60
+PUBCOMP = 0x70
+SUBSCRIBE = 0x80
+SUBACK = 0x90
+UNSUBSCRIBE = 0xA0
+UNSUBACK = 0xB0
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+
+def remaining_length(n):
+    out = bytearray()
+    while True:
+        byte = n % 128
+        n //= 128
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def packet(command, body=b""):
+    return bytes((command,)) + remaining_length(len(body)) + body
+
+
+def publish_packet(topic, payload=b"", qos=0, mid=0, retain=False, dup=False):
+    if isinstance(topic, str):
+        topic = topic.encode('utf-8')
+    body = struct.pack("!H", len(topic)) + topic
+    if qos:
+        body += struct.pack("!H", mid)
+    command = PUBLISH | (qos << 1) | (0x08 if dup else 0) | (0x01 if retain else 0)
+    return packet(command, body + payload)
+
+
+def ack_packet(command, mid):
+    return packet(command, struct.pack("!H", mid))
+
+
+def parse_publish(command, body):
+    """Return (topic, payload, qos, mid, dup, retain) of a PUBLISH."""
+    qos = (command >> 1) & 3
+    slen = struct.unpack_from("!H", body)[0]
+    topic = body[2:2+slen].decode('utf-8')
+    pos = 2 + slen
+    mid = 0
+    if qos:
+        mid = struct.unpack_from("!H", body, pos)[0]
+        pos += 2
+    return (topic, body[pos:], qos, mid, bool(command & 0x08), bool(command & 0x01))
+
+
+def pump(client, until, timeout=5.0):
+    """Run client.loop() until until() is true."""
+    deadline = time.time() + timeout
+    while not until():
+        if time.time() > deadline:
+            raise AssertionError("timed out waiting for the client")
+        client.loop(0.01)
+
+
+class BrokerConnection(object):
+    """The broker's end of one client connection."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self._buf = bytearray()
+
+    def send(self, data):
+        self.sock.setblocking(True)
+        try:
+            self.sock.sendall(data)
+        finally:
+            self.sock.setblocking(False)
+
+    def connack(self, result=0, flags=0):
+        self.send(packet(CONNACK, bytes((flags, result))))
+
+    def ack(self, command, mid):
+        self.send(ack_packet(command, mid))
+
+    def close(self):
+        self.sock.close()
+
+    def _split(self):
+        found = []
+        buf = self._buf
+        pos = 0
+        while pos < len(buf):
+            length = 0
+            mult = 1
+            i = pos + 1
+            while True:
+                if i >= len(buf):
+                    del buf[:pos]
+                    return found
+                byte = buf[i]
+                length += (byte & 0x7F) * mult
+                mult *= 128
+                i += 1
+                if not byte & 0x80:
+                    break
+            if i + length > len(buf):
+                break
+            found.append((buf[pos], bytes(buf[i:i+length])))
+            pos = i + length
+        del buf[:pos]
+        return found
+
+    def read_available(self):
+        """Return the packets that have arrived so far, without waiting."""
+        while True:
+            try:
+                data = self.sock.recv(1 << 20)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            self._buf.extend(data)
+        return self._split()
+
+    def packets(self, count, client=None, timeout=5.0):
+        """Wait for count packets, running client.loop() meanwhile if a
+        client is given, and return them as (command, body)."""
+        found = []
+        deadline = time.time() + timeout
+        while len(found) < count:
+            if time.time() > deadline:
+                raise AssertionError("timed out after %d of %d packets: %r" % (len(found), count, found))
+            if client is not None:
+                client.loop(0.01)
+            else:
+                select.select([self.sock], [], [], 0.01)
+            found.extend(self.read_available())
+        return found
+
+    def expect(self, command, client=None, timeout=5.0):
+        """Wait for the next packet, check its type and return its body."""
+        (got, body) = self.packets(1, client, timeout)[0]
+        assert got & 0xF0 == command, "expected 0x%02x, got 0x%02x" % (command, got)
+        return body
+
+    def quiet(self, client=None, duration=0.1):
+        """Run for duration and return whatever packets arrive."""
+        found = []
+        deadline = time.time() + duration
+        while time.time() < deadline:
+            if client is not None:
+                client.loop(0.01)
+            else:
+                time.sleep(0.01)
+            found.extend(self.read_available())
+        return found
+
+
+class FakeBroker(object):
+    """A listening socket on localhost that hands out BrokerConnections."""
+    def __init__(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(16)
+        self.port = self.listener.getsockname()[1]
+        self.connections = []
+
+    def accept(self, client=None, timeout=5.0):
+        """Wait for a connection, running client.loop() meanwhile if a
+        client is given."""
+        self.listener.setblocking(False)
+        deadline = time.time() + timeout
+        while True:
+            try:
+                sock = self.listener.accept()[0]
+                break
+            except BlockingIOError:
+                pass
+            if time.time() > deadline:
+                raise AssertionError("timed out waiting for a connection")
+            if client is not None:
+                client.loop(0.01)
+            else:
+                select.select([self.listener], [], [], 0.01)
+        conn = BrokerConnection(sock)
+        self.connections.append(conn)
+        return conn
+
+    def close(self):
+        for conn in self.connections:
+            conn.close()
+        self.listener.close()
+
+
+def connect(client, broker, keepalive=60):
+    """Connect client to broker and complete the CONNECT/CONNACK exchange.
+    Returns the broker's end of the connection."""
+    connected = []
+    on_connect = client.on_connect
+
+    def record(client_, userdata, flags, rc):
+        connected.append(rc)
+        if on_connect is not None:
+            on_connect(client_, userdata, flags, rc)
+    client.on_connect = record
+    client.connect("127.0.0.1", broker.port, keepalive)
+    conn = broker.accept(client)
+    conn.expect(CONNECT, client)
+    conn.connack()
+    pump(client, lambda: connected)
+    client.on_connect = on_connect
+    return conn
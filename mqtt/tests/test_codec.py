@@ -0,0 +1,144 @@
+"""The codec functions that have a compiled version in _umqtt_codec, held
+to the same results as their pure Python versions in umqtt_codec."""
+import random
+
+import pytest
+
+import umqtt_codec
+
+try:
+    import _umqtt_codec
+except ImportError:
+    _umqtt_codec = None
+
+# (function, arguments, expected result). An exception class as the expected
+# result means the call must raise it.
+CODEC_VECTORS = [
+    ("unpack_remaining_length", (b"\x30\x00", 1, 2), (0, 2)),
+    ("unpack_remaining_length", (b"\x30\x7f", 1, 2), (127, 2)),
+    ("unpack_remaining_length", (b"\x30\x80\x01", 1, 3), (128, 3)),
+    ("unpack_remaining_length", (b"\x30\xff\x7f", 1, 3), (16383, 3)),
+    ("unpack_remaining_length", (b"\x30\x80\x80\x01", 1, 4), (16384, 4)),
+    ("unpack_remaining_length", (b"\x30\xff\xff\xff\x7f", 1, 5), (268435455, 5)),
+    ("unpack_remaining_length", (bytearray(b"xx\x30\xac\x02yy"), 3, 5), (300, 5)),
+    ("unpack_remaining_length", (memoryview(b"\x30\xac\x02"), 1, 3), (300, 3)),
+    ("unpack_remaining_length", (b"\x30", 1, 1), (-1, 0)),
+    ("unpack_remaining_length", (b"\x30\x80", 1, 2), (-1, 0)),
+    ("unpack_remaining_length", (b"\x30\xff\xff\xff", 1, 4), (-1, 0)),
+    ("unpack_remaining_length", (b"\x30\xff\xff\xff\xff", 1, 5), (-1, -1)),
+    ("unpack_remaining_length", (b"\x30\xff\xff\xff\xff\x01", 1, 6), (-1, -1)),
+    ("split_frames", (b"", 0, 0), ([], 0, -1, 0)),
+    ("split_frames", (b"\xd0", 0, 1), ([], 0, -1, 0)),
+    ("split_frames", (b"\xd0\x00", 0, 2), ([(0xd0, 2, 2)], 2, -1, 0)),
+    ("split_frames", (b"\x40\x02\x00\x07\xd0\x00", 0, 6), ([(0x40, 2, 4), (0xd0, 6, 6)], 6, -1, 0)),
+    ("split_frames", (b"\x40\x02\x00\x07\xd0\x00", 4, 6), ([(0xd0, 6, 6)], 6, -1, 0)),
+    ("split_frames", (b"\x40\x02\x00\x07\x30\x05ab", 0, 8), ([(0x40, 2, 4)], 4, 5, 6)),
+    ("split_frames", (b"\x40\x02\x00\x07\x30\x80", 0, 6), ([(0x40, 2, 4)], 4, -1, 0)),
+    ("split_frames", (b"\x40\x02\x00\x07\x30\xff\xff\xff\xff", 0, 9), ([(0x40, 2, 4)], 4, -1, -1)),
+    ("split_frames", (bytearray(b"\x40\x02\x00\x07\x00\x00"), 0, 4), ([(0x40, 2, 4)], 4, -1, 0)),
+    ("split_frames", (b"\x30\x80\x01" + b"x"*128, 0, 131), ([(0x30, 3, 131)], 131, -1, 0)),
+    ("unpack_publish_header", (b"\x00\x03a/bhello", 0), (3, 0, 5)),
+    ("unpack_publish_header", (b"\x00\x03a/b\x01\x02hello", 1), (3, 258, 7)),
+    ("unpack_publish_header", (memoryview(b"\x00\x03a/b\x00\x07"), 2), (3, 7, 7)),
+    ("unpack_publish_header", (b"\x00\x00", 0), (0, 0, 2)),
+    ("unpack_publish_header", (b"", 0), (-1, 0, 0)),
+    ("unpack_publish_header", (b"\x00", 1), (-1, 0, 0)),
+    ("unpack_publish_header", (b"\x00\x05a/b", 0), (-1, 0, 0)),
+    ("unpack_publish_header", (b"\x00\x03a/b\x00", 1), (-1, 0, 0)),
+    ("topic_matches_sub", ("foo/bar", "foo/bar"), True),
+    ("topic_matches_sub", ("foo/+", "foo/bar"), True),
+    ("topic_matches_sub", ("foo/+/baz", "foo/bar/baz"), True),
+    ("topic_matches_sub", ("foo/+/#", "foo/bar/baz"), True),
+    ("topic_matches_sub", ("foo/#", "foo"), True),
+    ("topic_matches_sub", ("#", "foo/bar/baz"), True),
+    ("topic_matches_sub", ("+/+", "/"), True),
+    ("topic_matches_sub", ("foo/+", "foo/"), True),
+    ("topic_matches_sub", ("+/bar", "foo/bar"), True),
+    ("topic_matches_sub", ("$SYS/#", "$SYS/bar"), True),
+    ("topic_matches_sub", ("foo/bar", "foo"), False),
+    ("topic_matches_sub", ("foo/+", "foo/bar/baz"), False),
+    ("topic_matches_sub", ("foo/+/baz", "foo/bar/bar"), False),
+    ("topic_matches_sub", ("foo/#/bar", "foo/baz/bar"), False),
+    ("topic_matches_sub", ("#", "$SYS/bar"), False),
+    ("topic_matches_sub", ("$BOB/bar", "$SYS/bar"), False),
+    ("topic_matches_sub", ("", "foo"), False),
+    ("topic_matches_sub", ("sensors/\u00e9t\u00e9/+", "sensors/\u00e9t\u00e9/1"), True),
+    ("topic_matches_sub", (b"foo/+", b"foo/bar"), True),
+    ("topic_matches_sub", (bytearray(b"foo/#"), "foo/bar/baz"), True),
+    ("topic_matches_sub", ("$SYS/#", b"$SYS/bar"), True),
+    ("topic_matches_sub", (b"#", b"$SYS/bar"), False),
+    ("topic_matches_sub", ("sensors/\u00e9t\u00e9/+", "sensors/\u00e9t\u00e9/1".encode('utf-8')), True),
+    ("topic_matches_sub", (None, "foo"), TypeError),
+    ("topic_matches_sub", ("foo", None), TypeError),
+    ("topic_matches_sub", ("foo", 1), TypeError),
+]
+
+
+IMPLEMENTATIONS = [pytest.param(umqtt_codec.pure, id="pure")]
+if _umqtt_codec is not None:
+    IMPLEMENTATIONS.append(pytest.param(_umqtt_codec.__dict__, id="compiled"))
+else:
+    IMPLEMENTATIONS.append(pytest.param(None, id="compiled", marks=pytest.mark.skip(
+        reason="_umqtt_codec is not built (python setup.py build_ext --inplace)")))
+
+
+def call(functions, name, args):
+    try:
+        return functions[name](*args)
+    except Exception as err:
+        return type(err)
+
+
+@pytest.mark.parametrize("functions", IMPLEMENTATIONS)
+@pytest.mark.parametrize("name,args,expected", CODEC_VECTORS)
+def test_vector(functions, name, args, expected):
+    assert call(functions, name, args) == expected
+
+
+def test_module_uses_compiled_when_built():
+    assert umqtt_codec.compiled == (_umqtt_codec is not None)
+    for name in umqtt_codec.pure:
+        if _umqtt_codec is not None:
+            assert getattr(umqtt_codec, name) is getattr(_umqtt_codec, name)
+        else:
+            assert getattr(umqtt_codec, name) is umqtt_codec.pure[name]
+
+
+@pytest.mark.skipif(_umqtt_codec is None, reason="_umqtt_codec is not built")
+def test_random_input_same_results():
+    # Streams of valid packets cut at random places, with random bytes mixed
+    # in, so the malformed and incomplete paths get exercised too.
+    rnd = random.Random(1)
+    pure = umqtt_codec.pure
+    frames = []
+    for size in (0, 1, 2, 5, 127, 128, 300, 16383, 16384):
+        body = bytes(rnd.getrandbits(8) for i in range(size))
+        frames.append(bytes((0x30,)) + umqtt_codec.encode_remaining_length(size) + body)
+    for i in range(2000):
+        stream = bytearray()
+        for j in range(rnd.randint(0, 4)):
+            if rnd.random() < 0.1:
+                stream += bytes(rnd.getrandbits(8) for k in range(rnd.randint(1, 6)))
+            else:
+                stream += rnd.choice(frames)
+        end = rnd.randint(0, len(stream))
+        pos = rnd.randint(0, end)
+        for buf in (bytes(stream), stream, memoryview(stream)):
+            assert call(_umqtt_codec.__dict__, "split_frames", (buf, pos, end)) == \
+                call(pure, "split_frames", (buf, pos, end))
+            if end > pos:
+                args = (buf, pos + 1, end)
+                assert call(_umqtt_codec.__dict__, "unpack_remaining_length", args) == \
+                    call(pure, "unpack_remaining_length", args)
+            for qos in (0, 1, 2):
+                args = (buf[pos:end], qos)
+                assert call(_umqtt_codec.__dict__, "unpack_publish_header", args) == \
+                    call(pure, "unpack_publish_header", args)
+
+    levels = ["a", "b", "", "+", "#", "$SYS", "\u00e9"]
+    for i in range(5000):
+        sub = "/".join(rnd.choice(levels) for j in range(rnd.randint(1, 4)))
+        topic = "/".join(rnd.choice(levels[:3] + levels[5:]) for j in range(rnd.randint(1, 4)))
+        for args in ((sub, topic), (sub.encode('utf-8'), topic), (sub, topic.encode('utf-8'))):
+            assert call(_umqtt_codec.__dict__, "topic_matches_sub", args) == \
+                call(pure, "topic_matches_sub", args)
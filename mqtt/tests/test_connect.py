@@ -0,0 +1,158 @@
+"""Connecting without blocking, in Client and AsyncClient."""
+import asyncio
+import socket
+import threading
+import time
+
+import pytest
+
+import umqtt2
+import umqtt2_asyncio
+from fakebroker import CONNECT, pump
+
+
+@pytest.fixture
+def blackhole():
+    """An address that never answers a connect: a listener whose accept
+    queue is full, so the kernel drops further SYNs."""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(0)
+    address = listener.getsockname()
+    fillers = []
+    for i in range(3):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.connect_ex(address)
+        fillers.append(sock)
+    time.sleep(0.05)
+    yield address
+    for sock in fillers:
+        sock.close()
+    listener.close()
+
+
+@pytest.fixture
+def addresses():
+    """Set the addresses a made up host name resolves to."""
+    host = "broker.test"
+    def resolve(*sockaddrs):
+        umqtt2._address_cache.put(host, 1883, [
+            (socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", sockaddr)
+            for sockaddr in sockaddrs])
+        return host
+    yield resolve
+    umqtt2._address_cache.clear()
+
+
+def test_connect_returns_at_once(blackhole, monkeypatch):
+    monkeypatch.setattr(umqtt2, "CONNECT_TIMEOUT", 0.3)
+    client = umqtt2.Client("c")
+    start = time.time()
+    assert client.connect(*blackhole) == umqtt2.MQTT_ERR_SUCCESS
+    assert client.loop(0.05) == umqtt2.MQTT_ERR_SUCCESS
+    assert time.time() - start < 0.2
+    # loop() gives up once CONNECT_TIMEOUT has passed.
+    rc = umqtt2.MQTT_ERR_SUCCESS
+    while rc == umqtt2.MQTT_ERR_SUCCESS:
+        assert time.time() - start < 1.0
+        rc = client.loop(0.05)
+    assert rc == umqtt2.MQTT_ERR_NO_CONN
+    assert time.time() - start > 0.25
+    assert client.socket() is None
+
+
+def test_connect_races_addresses(broker, blackhole, addresses):
+    client = umqtt2.Client("c")
+    host = addresses(blackhole, ("127.0.0.1", broker.port))
+    start = time.time()
+    connected = []
+    client.on_connect = lambda c, u, f, rc: connected.append(rc)
+    client.connect(host, 1883)
+    conn = broker.accept(client)
+    conn.expect(CONNECT, client)
+    conn.connack()
+    pump(client, lambda: connected)
+    assert time.time() - start < 1.0
+
+
+def test_connect_async_then_loop(broker):
+    client = umqtt2.Client("c")
+    client.connect_async("127.0.0.1", broker.port)
+    assert client.socket() is None
+    conn = broker.accept(client)
+    conn.expect(CONNECT, client)
+
+
+def test_loop_forever_raises_first_failure():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    client = umqtt2.Client("c")
+    # Refused straight away by connect(), or later in loop_forever().
+    with pytest.raises(ConnectionRefusedError):
+        client.connect("127.0.0.1", port)
+        client.loop_forever()
+
+
+def test_loop_stop_while_connecting(blackhole):
+    client = umqtt2.Client("c")
+    client.connect_async(*blackhole)
+    client.loop_start()
+    time.sleep(0.1)
+    start = time.time()
+    client.disconnect()
+    client.loop_stop()
+    assert time.time() - start < 0.5
+
+
+def test_async_client_races_addresses(broker, blackhole, addresses):
+    host = addresses(blackhole, ("127.0.0.1", broker.port))
+
+    def serve():
+        conn = broker.accept()
+        conn.expect(CONNECT)
+        conn.connack()
+    thread = threading.Thread(target=serve)
+    thread.start()
+
+    async def main():
+        client = umqtt2_asyncio.AsyncClient("c")
+        start = time.time()
+        rc = await client.connect(host, 1883)
+        return (rc, time.time() - start)
+
+    (rc, elapsed) = asyncio.run(main())
+    thread.join(5)
+    assert rc == umqtt2.CONNACK_ACCEPTED
+    assert elapsed < 1.0
+
+
+def test_async_client_connect_timeout(blackhole, addresses, monkeypatch):
+    monkeypatch.setattr(umqtt2_asyncio, "CONNECT_TIMEOUT", 0.3)
+    host = addresses(blackhole, blackhole)
+
+    async def main():
+        client = umqtt2_asyncio.AsyncClient("c")
+        with pytest.raises(socket.timeout):
+            await client.connect(host, 1883)
+
+    start = time.time()
+    asyncio.run(main())
+    assert time.time() - start < 1.0
+
+
+def test_v31_fallback_reconnects_from_loop(broker):
+    client = umqtt2.Client("c", protocol=umqtt2.MQTTv311)
+    connected = []
+    client.on_connect = lambda c, u, f, rc: connected.append(rc)
+    client.connect("127.0.0.1", broker.port)
+    conn = broker.accept(client)
+    assert b"MQTT" in conn.expect(CONNECT, client)
+    conn.connack(umqtt2.CONNACK_REFUSED_PROTOCOL_VERSION)
+    conn = broker.accept(client)
+    assert b"MQIsdp" in conn.expect(CONNECT, client)
+    conn.connack()
+    pump(client, lambda: connected)
+    assert connected == [umqtt2.CONNACK_ACCEPTED]
@@ -0,0 +1,100 @@
+"""umqtt_core.MQTTProtocol, the protocol shared by the clients, driven with
+bytes and times and no sockets."""
+import struct
+
+import pytest
+
+import umqtt_core
+from umqtt_core import EV_CONNACK, EV_MESSAGE, EV_PUBLISHED, EV_TIMEOUT, MQTTProtocol
+
+CONNACK = b"\x20\x02\x00\x00"
+
+
+def connected(keepalive=60, **options):
+    proto = MQTTProtocol("core")
+    for (name, value) in options.items():
+        setattr(proto, name, value)
+    proto.connect(keepalive)
+    assert proto.receive_data(CONNACK) == [(EV_CONNACK, 0, 0)]
+    proto.data_to_send()
+    return proto
+
+
+def ack(command, mid):
+    return struct.pack("!BBH", command, 2, mid)
+
+
+def test_qos1_publish_completes_on_puback():
+    proto = connected()
+    mid = proto.publish("a/b", b"x", qos=1)
+    sent = proto.data_to_send()
+    assert sent[0] == 0x32 and proto.inflight() == 1
+    assert proto.receive_data(ack(0x40, mid)) == [(EV_PUBLISHED, mid)]
+    assert proto.inflight() == 0
+
+
+def test_qos2_publish_flow():
+    proto = connected()
+    mid = proto.publish("a/b", b"x", qos=2)
+    proto.data_to_send()
+    assert proto.receive_data(ack(0x50, mid)) == []
+    assert proto.data_to_send() == ack(0x62, mid)
+    assert proto.receive_data(ack(0x70, mid)) == [(EV_PUBLISHED, mid)]
+
+
+def test_qos2_message_delivered_once_on_pubrel():
+    proto = connected()
+    publish = b"\x34\x09\x00\x03a/b\x00\x09xy"
+    assert proto.receive_data(publish) == []
+    assert proto.data_to_send() == ack(0x50, 9)
+    # A resent PUBLISH is acknowledged again but not delivered twice.
+    assert proto.receive_data(publish) == []
+    assert proto.data_to_send() == ack(0x50, 9)
+    events = proto.receive_data(ack(0x62, 9))
+    assert [e[0] for e in events] == [EV_MESSAGE]
+    assert (events[0][1].topic, events[0][1].payload) == (b"a/b", b"xy")
+    assert proto.data_to_send() == ack(0x70, 9)
+    # PUBCOMP is sent for a PUBREL whose message is already gone too.
+    assert proto.receive_data(ack(0x62, 9)) == []
+    assert proto.data_to_send() == ack(0x70, 9)
+
+
+def test_window_holds_messages_back():
+    proto = connected(max_inflight=1)
+    first = proto.publish("a", b"1", qos=1)
+    second = proto.publish("a", b"2", qos=1)
+    assert proto.data_to_send().count(b"\x32") == 1
+    assert proto.receive_data(ack(0x40, first)) == [(EV_PUBLISHED, first)]
+    assert proto.data_to_send()[-1:] == b"2"
+    assert proto.receive_data(ack(0x40, second)) == [(EV_PUBLISHED, second)]
+
+
+def test_unacknowledged_message_sent_again_with_dup():
+    proto = connected(message_retry=5)
+    proto.publish("a", b"1", qos=1)
+    proto.data_to_send()
+    assert proto.next_deadline() == 5
+    proto.tick(4)
+    assert proto.data_to_send() == b""
+    proto.tick(5)
+    assert proto.data_to_send()[0] == 0x3a
+
+
+def test_keepalive_ping_then_timeout():
+    proto = connected(keepalive=10)
+    proto.tick(10)
+    assert proto.data_to_send() == b"\xc0\x00"
+    assert proto.tick(19) == []
+    assert proto.tick(20) == [(EV_TIMEOUT,)]
+
+
+def test_connack_timeout():
+    proto = MQTTProtocol("core")
+    proto.connect(10)
+    assert proto.tick(10) == [(EV_TIMEOUT,)]
+
+
+def test_invalid_packet_raises():
+    proto = connected()
+    with pytest.raises(umqtt_core.ProtocolError):
+        proto.receive_data(b"\x40\x01\x00")
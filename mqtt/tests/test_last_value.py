@@ -0,0 +1,80 @@
+import asyncio
+import os
+import threading
+
+import umqtt2
+import umqtt2_asyncio
+from fakebroker import CONNECT, PUBACK, connect, publish_packet, pump
+
+
+def test_get_last_and_snapshot(broker):
+    client = umqtt2.Client("lv")
+    client.last_value_cache_set(True)
+    conn = connect(client, broker)
+    conn.send(publish_packet("room/1/temp", b"20", qos=0))
+    conn.send(publish_packet("room/2/temp", b"21", qos=1, mid=7))
+    conn.send(publish_packet("room/1/temp", b"22", qos=0, retain=True))
+    conn.send(publish_packet("$SYS/load", b"3", qos=0))
+    pump(client, lambda: client.get_last("$SYS/load") is not None)
+
+    last = client.get_last("room/1/temp")
+    assert (last.topic, last.payload, last.retain) == ("room/1/temp", b"22", 1)
+    assert client.get_last("room/3/temp") is None
+    assert sorted(client.snapshot("room/+/temp")) == ["room/1/temp", "room/2/temp"]
+    assert sorted(client.snapshot("#")) == ["room/1/temp", "room/2/temp"]
+    assert sorted(client.snapshot("$SYS/#")) == ["$SYS/load"]
+
+    # A retained message with no payload clears the topic.
+    conn.send(publish_packet("room/2/temp", b"", qos=0, retain=True))
+    pump(client, lambda: client.get_last("room/2/temp") is None)
+    assert list(client.snapshot("#")) == ["room/1/temp"]
+
+
+def test_save_and_load(broker, tmp_path):
+    path = str(tmp_path / "last.bin")
+    client = umqtt2.Client("lv")
+    client.last_value_cache_set(True, path)
+    conn = connect(client, broker)
+    conn.send(publish_packet("a/b", b"1", qos=1, mid=1))
+    conn.send(publish_packet("a/c", b"2", qos=0))
+    pump(client, lambda: client.get_last("a/c") is not None)
+    client.disconnect()
+    assert os.path.exists(path)
+
+    client = umqtt2.Client("lv2")
+    client.last_value_cache_set(True, path)
+    assert {t: m.payload for (t, m) in client.snapshot("a/+").items()} == {"a/b": b"1", "a/c": b"2"}
+    assert client.get_last("a/b").qos == 1
+
+
+def test_async_client_feeds_cache(broker):
+    # The broker runs on a thread of its own while the event loop drives
+    # the client.
+    sent = threading.Event()
+
+    def serve():
+        conn = broker.accept()
+        conn.expect(CONNECT)
+        conn.connack()
+        conn.send(publish_packet("a/b", b"hello", qos=1, mid=3))
+        conn.send(publish_packet("a/c", b"world", qos=0))
+        conn.expect(PUBACK)
+        sent.set()
+    thread = threading.Thread(target=serve)
+    thread.start()
+
+    async def main():
+        client = umqtt2_asyncio.AsyncClient("lv")
+        client.last_value_cache_set(True)
+        await client.connect("127.0.0.1", broker.port)
+        for i in range(500):
+            if client.get_last("a/c") is not None:
+                break
+            await asyncio.sleep(0.01)
+        return client
+
+    client = asyncio.run(main())
+    thread.join(5)
+    assert sent.is_set()
+    assert client.get_last("a/b").payload == b"hello"
+    assert {t: m.payload for (t, m) in client.snapshot("a/#").items()} == {"a/b": b"hello", "a/c": b"world"}
@@ -0,0 +1,118 @@
+"""The outgoing queue of umqtt2.Client and umqtt.Client. The tests need
+packets to pile up in the client, so the socket buffers are shrunk and the
+broker doesn't read until the test has queued what it needs."""
+import socket
+import time
+
+import pytest
+
+import umqtt
+import umqtt2
+from fakebroker import (PINGREQ, PINGRESP, PUBACK, PUBLISH, PUBREC, PUBREL, connect, packet,
+                        parse_publish, publish_packet, pump)
+
+CLIENTS = [umqtt2.Client, umqtt.Client]
+BIG = b"x" * 16384
+
+
+def squeeze(client, broker, keepalive=60):
+    broker.listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    conn = connect(client, broker, keepalive)
+    client.socket().setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    return conn
+
+
+def fill(client, count=20):
+    # Enough PUBLISHes to fill the socket buffers, with most left queued.
+    infos = [client.publish("big/%d" % i, BIG) for i in range(count)]
+    pump(client, lambda: client.queue_stats()['publish'] >= count // 2)
+    return infos
+
+
+def drain(conn, client, until):
+    """Read packets until until(packets) is true."""
+    found = []
+    deadline = time.time() + 10
+    while not until(found):
+        assert time.time() < deadline, found
+        found.extend(conn.packets(1, client))
+    return found
+
+
+def publishes_before(found, command):
+    for (i, (c, body)) in enumerate(found):
+        if c == command:
+            return sum(1 for (c, b) in found[:i] if c & 0xF0 == PUBLISH)
+    raise AssertionError("0x%02x not sent" % command)
+
+
+@pytest.mark.parametrize("Client", CLIENTS)
+def test_control_packets_go_first(broker, Client):
+    client = Client("lanes")
+    got = []
+    client.on_message = lambda c, u, m: got.append(m.topic)
+    conn = squeeze(client, broker, keepalive=1)
+    info2 = client.publish("q2", b"two", qos=2)
+    assert parse_publish(*conn.packets(1, client)[0])[3] == info2.mid
+
+    infos = fill(client)
+    conn.ack(PUBREC, info2.mid)
+    conn.send(publish_packet("in", b"one", qos=1, mid=77))
+    pump(client, lambda: got)
+    # Nothing can be written for a keepalive, so a PINGREQ is due too.
+    start = time.time()
+    pump(client, lambda: time.time() - start > 1.2)
+    queued = client.queue_stats()['publish']
+    assert queued >= 5
+    # The PUBLISH partly written when they were queued is finished first.
+    written = len(infos) - queued + 1
+
+    found = drain(conn, client, lambda found: sum(1 for (c, b) in found if c & 0xF0 == PUBLISH) == len(infos))
+    assert publishes_before(found, PUBREL | 0x02) <= written
+    assert publishes_before(found, PUBACK) <= written
+    assert publishes_before(found, PINGREQ) <= written
+    conn.send(packet(PINGRESP))
+    pump(client, lambda: all(info.is_published() for info in infos))
+    assert client.queue_stats()['control_max'] >= 3
+
+
+@pytest.mark.parametrize("Client", CLIENTS)
+def test_coalesced_messages_complete_when_written(broker, Client):
+    client = Client("coalesce")
+    published = []
+    client.on_publish = lambda c, u, mid: published.append(mid)
+    client.coalesce_set(True)
+    conn = squeeze(client, broker)
+    big = fill(client)
+    first = client.publish("vol", b"1")
+    after = client.publish("big/after", BIG)
+    rest = [client.publish("vol", b"%d" % i) for i in range(2, 11)]
+    vol = [first] + rest
+    assert not any(info.is_published() for info in vol)
+    assert client.queue_stats()['coalesced'] == 9
+
+    found = drain(conn, client, lambda found: len(found) == len(big) + 2)
+    topics = [parse_publish(c, b)[0] for (c, b) in found]
+    # Sent once, with the latest value, in the place of the first.
+    assert topics == ["big/%d" % i for i in range(len(big))] + ["vol", "big/after"]
+    assert parse_publish(*found[-2])[1] == b"10"
+    pump(client, after.is_published)
+    assert all(info.is_published() for info in vol)
+    assert sorted(published) == sorted(info.mid for info in big + vol + [after])
+
+
+@pytest.mark.parametrize("Client", CLIENTS)
+def test_coalescing_off_keeps_queued_packets(broker, Client):
+    client = Client("coalesce")
+    client.coalesce_set(True)
+    conn = squeeze(client, broker)
+    big = fill(client)
+    vol = [client.publish("vol", b"%d" % i) for i in range(1, 4)]
+    client.coalesce_set(False)
+    vol += [client.publish("vol", b"%d" % i) for i in range(4, 6)]
+    assert client.queue_stats()['coalesced'] == 2
+
+    found = drain(conn, client, lambda found: len(found) == len(big) + 3)
+    assert [parse_publish(c, b)[:2] for (c, b) in found[len(big):]] == [
+        ("vol", b"3"), ("vol", b"4"), ("vol", b"5")]
+    pump(client, lambda: all(info.is_published() for info in big + vol))
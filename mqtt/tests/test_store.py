@@ -0,0 +1,256 @@
+import os
+
+import umqtt2
+from umqtt_store import FileSessionStore, SpillQueue
+from fakebroker import (PUBACK, PUBCOMP, PUBLISH, PUBREC, PUBREL, ack_packet, connect,
+                        parse_publish, publish_packet, pump)
+
+QUEUED = umqtt2.mqtt_ms_queued
+PUBACK_WAIT = umqtt2.mqtt_ms_wait_for_puback
+PUBCOMP_WAIT = umqtt2.mqtt_ms_wait_for_pubcomp
+
+
+def fill(path, **kwargs):
+    store = FileSessionStore(path, fsync=False, **kwargs)
+    store.out_put(1, PUBACK_WAIT, 1, False, "a/1", b"one")
+    store.out_put(2, QUEUED, 2, True, "a/é", None)
+    store.in_put(7, 2, False, "b/7", b"seven")
+    store.out_state(2, PUBCOMP_WAIT)
+    store.commit()
+    return store
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "session")
+    fill(path).close()
+    (out, incoming) = FileSessionStore(path).load()
+    assert out == [(1, PUBACK_WAIT, 1, False, "a/1", b"one"),
+                   (2, PUBCOMP_WAIT, 2, True, "a/é", None)]
+    assert incoming == [(7, 0, 2, False, "b/7", b"seven")]
+
+
+def test_uncommitted_changes_are_not_written(tmp_path):
+    path = str(tmp_path / "session")
+    store = fill(path)
+    store.out_del(1)
+    store.in_put(8, 2, False, "b/8", b"eight")
+    # No commit, as after a crash.
+    (out, incoming) = FileSessionStore(path).load()
+    assert [m[0] for m in out] == [1, 2]
+    assert [m[0] for m in incoming] == [7]
+
+
+def test_truncated_tail_is_skipped(tmp_path):
+    path = str(tmp_path / "session")
+    fill(path).close()
+    store = FileSessionStore(path, fsync=False)
+    store.out_put(3, PUBACK_WAIT, 1, False, "a/3", b"three")
+    store.close()
+    # Cut the last record short, as a crash part way through its write does.
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 3)
+
+    store = FileSessionStore(path)
+    (out, incoming) = store.load()
+    assert [m[0] for m in out] == [1, 2]
+    assert [m[0] for m in incoming] == [7]
+    # The file was rewritten without the torn record, so new records are
+    # not appended behind it.
+    store.out_put(4, PUBACK_WAIT, 1, False, "a/4", b"four")
+    store.close()
+    assert [m[0] for m in FileSessionStore(path).load()[0]] == [1, 2, 4]
+
+
+def test_corrupt_tail_is_skipped(tmp_path):
+    path = str(tmp_path / "session")
+    store = fill(path)
+    store.out_del(1)
+    store.close()
+    with open(path, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes((last[0] ^ 0xFF,)))
+
+    (out, incoming) = FileSessionStore(path).load()
+    # The damaged delete is dropped, so message 1 is still live.
+    assert [m[0] for m in out] == [1, 2]
+
+
+def test_garbage_after_records_is_skipped(tmp_path):
+    path = str(tmp_path / "session")
+    fill(path).close()
+    with open(path, 'ab') as f:
+        f.write(b"\x00" * 5 + b"\xff" * 40)
+    (out, incoming) = FileSessionStore(path).load()
+    assert [m[0] for m in out] == [1, 2]
+    assert [m[0] for m in incoming] == [7]
+
+
+def test_compaction_keeps_only_live_records(tmp_path):
+    path = str(tmp_path / "session")
+    store = FileSessionStore(path, fsync=False, compact_min=4)
+    for mid in range(1, 21):
+        store.out_put(mid, PUBACK_WAIT, 1, False, "t/%d" % mid, b"x" * mid)
+    for mid in range(1, 21):
+        if mid % 5:
+            store.out_del(mid)
+        else:
+            store.out_state(mid, PUBCOMP_WAIT)
+    store.in_put(9, 2, True, "in/9", b"nine")
+    store.commit()
+    stats = store.stats()
+    assert stats['compactions'] >= 2      # Once on opening, once here.
+    assert stats['out'] == 4 and stats['in'] == 1
+    assert stats['records'] == 5
+    store.close()
+
+    size = os.path.getsize(path)
+    store = FileSessionStore(path, fsync=False, compact_min=4)
+    (out, incoming) = store.load()
+    assert out == [(mid, PUBCOMP_WAIT, 1, False, "t/%d" % mid, b"x" * mid) for mid in (5, 10, 15, 20)]
+    assert incoming == [(9, 0, 2, True, "in/9", b"nine")]
+    assert os.path.getsize(path) == size
+    assert not os.path.exists(path + ".tmp")
+
+
+def test_client_resumes_session_after_restart(broker, tmp_path):
+    path = str(tmp_path / "session")
+    client = umqtt2.Client("store", clean_session=False)
+    client.session_store_set(FileSessionStore(path))
+    conn = connect(client, broker)
+    infos = [client.publish("out/%d" % i, b"p%d" % i, qos=1 + (i % 2)) for i in range(4)]
+    sent = conn.packets(4, client)
+    assert [parse_publish(c, b)[3] for (c, b) in sent] == [info.mid for info in infos]
+    # The first QoS 2 message gets as far as PUBREL.
+    conn.ack(PUBREC, infos[1].mid)
+    assert conn.packets(1, client)[0] == (PUBREL | 0x02, ack_packet(PUBREL, infos[1].mid)[2:])
+    # An incoming QoS 2 message waits for its PUBREL.
+    conn.send(publish_packet("in/q2", b"held", qos=2, mid=40))
+    assert conn.expect(PUBREC, client) == b"\x00\x28"
+    last_mid = infos[-1].mid
+
+    # The process dies: the client and the connection are dropped without a
+    # DISCONNECT and the store is never closed.
+    conn.close()
+    client = umqtt2.Client("store", clean_session=False)
+    client.session_store_set(FileSessionStore(path))
+    got = []
+    client.on_message = lambda c, u, m: got.append((m.topic, bytes(m.payload)))
+    conn = connect(client, broker)
+    resent = conn.packets(4, client)
+    publishes = [parse_publish(c, b) for (c, b) in resent if c & 0xF0 == PUBLISH]
+    assert sorted((p[0], p[3], p[4]) for p in publishes) == sorted(
+        ("out/%d" % i, infos[i].mid, True) for i in (0, 2, 3))
+    assert (PUBREL | 0x0A, b"\x00" + bytes((infos[1].mid,))) in resent
+
+    # New messages carry on from the last mid handed out.
+    assert client.publish("out/new", b"n", qos=1).mid == last_mid + 1
+    conn.expect(PUBLISH, client)
+
+    conn.send(ack_packet(PUBREL | 0x02, 40))
+    assert conn.expect(PUBCOMP, client) == b"\x00\x28"
+    pump(client, lambda: got)
+    assert got == [("in/q2", b"held")]
+
+
+def drain(queue):
+    out = []
+    while True:
+        message = queue.get()
+        if message is None:
+            return out
+        out.append(message)
+
+
+def test_spill_queue_keeps_order_across_the_file(tmp_path):
+    path = str(tmp_path / "spill")
+    queue = SpillQueue(3, 1000, path, 1 << 20)
+    for i in range(10):
+        assert queue.put("t/%d" % i, b"p%d" % i, i % 3, bool(i % 2), i)
+    assert queue.stats()['messages'] == 3
+    assert queue.stats()['file_messages'] == 7
+    assert len(queue) == 10
+
+    # Taking one moves the head of the file into memory, and a new message
+    # goes behind the ones still in the file even though memory has room.
+    got = [queue.get()]
+    assert queue.put("t/10", b"p10", 1, False, 10)
+    got += drain(queue)
+    assert [m[4] for m in got] == list(range(11))
+    assert [(m[0], m[1], m[2], m[3]) for m in got] == [
+        ("t/%d" % i, b"p%d" % i, i % 3, bool(i % 2)) for i in range(11)]
+    assert queue.stats()['spilled'] == 8
+    # The file is emptied once everything in it has been read.
+    assert queue.stats()['file_bytes'] == 0
+    queue.close()
+    assert not os.path.exists(path)
+
+
+def test_spill_queue_interleaved(tmp_path):
+    queue = SpillQueue(4, 30, str(tmp_path / "spill"), 1 << 20)
+    expected = []
+    got = []
+    n = 0
+    for step in range(200):
+        # Puts run ahead of gets, so messages keep crossing into the file
+        # and back while both hold some.
+        for i in range(step % 3 + 1):
+            assert queue.put("t/%d" % n, b"x" * (n % 17), 1, False, n)
+            expected.append(n)
+            n += 1
+        for i in range(step % 2 + 1):
+            message = queue.get()
+            if message is not None:
+                # An empty payload comes back from the file as None.
+                assert (message[1] or b"") == b"x" * (message[4] % 17)
+                got.append(message[4])
+        stats = queue.stats()
+        assert stats['messages'] <= 4
+        assert stats['bytes'] <= 30 or stats['messages'] == 1
+    got += [m[4] for m in drain(queue)]
+    assert got == expected
+    assert queue.stats()['spilled'] > 0
+    queue.close()
+
+
+def test_spill_queue_full(tmp_path):
+    queue = SpillQueue(2, 1000)
+    assert queue.put("a", b"1", 0, False, 1)
+    assert queue.put("b", b"2", 0, False, 2)
+    assert not queue.put("c", b"3", 0, False, 3)
+
+    queue = SpillQueue(1, 1000, str(tmp_path / "spill"), 20)
+    assert queue.put("a", b"1", 0, False, 1)
+    assert queue.put("b", b"2", 0, False, 2)
+    assert not queue.put("c", b"x" * 20, 0, False, 3)
+    assert [m[4] for m in drain(queue)] == [1, 2]
+    queue.close()
+
+
+def test_client_sends_offline_queue_in_order(broker, tmp_path):
+    client = umqtt2.Client("spill")
+    client.offline_queue_set(4, spill_path=str(tmp_path / "spill"))
+    infos = [client.publish("q/%d" % i, b"%d" % i, qos=i % 3) for i in range(30)]
+    assert all(info.rc == umqtt2.MQTT_ERR_SUCCESS for info in infos)
+    assert client.offline_stats()['file_messages'] == 26
+
+    conn = connect(client, broker)
+    sent = []
+    released = 0
+    while len(sent) < 30 or released < 10:
+        for (command, body) in conn.packets(1, client):
+            if command & 0xF0 == PUBLISH:
+                (topic, payload, qos, mid, dup, retain) = parse_publish(command, body)
+                sent.append((topic, payload, qos))
+                if qos == 1:
+                    conn.ack(PUBACK, mid)
+                elif qos == 2:
+                    conn.ack(PUBREC, mid)
+            else:
+                assert command == PUBREL | 0x02
+                conn.send(bytes((PUBCOMP, 2)) + body)
+                released += 1
+    pump(client, lambda: all(info.is_published() for info in infos))
+    assert sent == [("q/%d" % i, b"%d" % i, i % 3) for i in range(30)]
+    assert client.offline_stats()['spilled'] == 26
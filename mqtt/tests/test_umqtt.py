@@ -0,0 +1,248 @@
+"""umqtt.Client, the MicroPython client, against the fake broker."""
+import threading
+import time
+
+import umqtt
+from fakebroker import (CONNECT, DISCONNECT, PINGREQ, PINGRESP, PUBACK, PUBCOMP, PUBLISH, PUBREC, PUBREL,
+                        SUBACK, SUBSCRIBE,
+                        ack_packet, connect, packet, parse_publish, publish_packet, pump)
+
+
+def test_publish_qos0_1_2(broker):
+    client = umqtt.Client("u")
+    published = []
+    client.on_publish = lambda c, u, mid: published.append(mid)
+    conn = connect(client, broker)
+
+    info0 = client.publish("a/0", b"zero", qos=0)
+    assert parse_publish(*conn.packets(1, client)[0]) == ("a/0", b"zero", 0, 0, False, False)
+    pump(client, info0.is_published)
+
+    info1 = client.publish("a/1", b"one", qos=1, retain=True)
+    assert parse_publish(*conn.packets(1, client)[0]) == ("a/1", b"one", 1, info1.mid, False, True)
+    assert not info1.is_published()
+    conn.ack(PUBACK, info1.mid)
+    pump(client, info1.is_published)
+
+    info2 = client.publish("a/2", b"two", qos=2)
+    assert parse_publish(*conn.packets(1, client)[0]) == ("a/2", b"two", 2, info2.mid, False, False)
+    conn.ack(PUBREC, info2.mid)
+    assert conn.packets(1, client) == [(PUBREL | 0x02, ack_packet(PUBREL, info2.mid)[2:])]
+    assert not info2.is_published()
+    conn.ack(PUBCOMP, info2.mid)
+    pump(client, info2.is_published)
+    assert published == [info0.mid, info1.mid, info2.mid]
+    assert len({info0.mid, info1.mid, info2.mid}) == 3
+
+    # A second PUBACK for a finished message is ignored.
+    conn.ack(PUBACK, info1.mid)
+    assert conn.quiet(client) == []
+    assert published == [info0.mid, info1.mid, info2.mid]
+
+
+def test_receive_qos0_1_2(broker):
+    client = umqtt.Client("u")
+    got = []
+    client.on_message = lambda c, u, m: got.append((m.topic, bytes(m.payload), m.qos, m.retain))
+    conn = connect(client, broker)
+    (rc, mid) = client.subscribe("in/#", 2)
+    assert conn.expect(SUBSCRIBE, client)[:2] == bytes((mid >> 8, mid & 0xFF))
+    conn.send(packet(SUBACK, ack_packet(0, mid)[2:] + b"\x02"))
+
+    conn.send(publish_packet("in/0", b"zero", qos=0))
+    conn.send(publish_packet("in/1", b"one", qos=1, mid=11, retain=True))
+    assert conn.packets(1, client) == [(PUBACK, b"\x00\x0b")]
+    pump(client, lambda: len(got) == 2)
+    assert got == [("in/0", b"zero", 0, 0), ("in/1", b"one", 1, 1)]
+
+    # QoS 2 is only delivered on PUBREL, and only once.
+    conn.send(publish_packet("in/2", b"two", qos=2, mid=12))
+    assert conn.packets(1, client) == [(PUBREC, b"\x00\x0c")]
+    conn.send(publish_packet("in/2", b"two", qos=2, mid=12, dup=True))
+    assert conn.packets(1, client) == [(PUBREC, b"\x00\x0c")]
+    assert len(got) == 2
+    conn.send(ack_packet(PUBREL | 0x02, 12))
+    assert conn.packets(1, client) == [(PUBCOMP, b"\x00\x0c")]
+    conn.send(ack_packet(PUBREL | 0x02, 12))
+    conn.quiet(client)
+    assert got[2:] == [("in/2", b"two", 2, 0)]
+
+
+def test_filtered_callbacks(broker):
+    client = umqtt.Client("u")
+    got = []
+    client.message_callback_add("a/+", lambda c, u, m: got.append(("plus", m.topic)))
+    client.message_callback_add("a/#", lambda c, u, m: got.append(("hash", m.topic)))
+    client.on_message = lambda c, u, m: got.append(("any", m.topic))
+    conn = connect(client, broker)
+    for topic in ("a/b", "a/b/c", "x"):
+        conn.send(publish_packet(topic, b"p"))
+    pump(client, lambda: ("any", "x") in got)
+    assert sorted(got) == [("any", "x"), ("hash", "a/b"), ("hash", "a/b/c"), ("plus", "a/b")]
+
+
+def test_inflight_window(broker):
+    client = umqtt.Client("u")
+    client.max_inflight_messages_set(2)
+    conn = connect(client, broker)
+    infos = [client.publish("w/%d" % i, b"%d" % i, qos=1) for i in range(5)]
+    first = conn.packets(2, client)
+    assert conn.quiet(client) == []
+    conn.ack(PUBACK, parse_publish(*first[0])[3])
+    (third,) = conn.packets(1, client)
+    assert parse_publish(*third)[0] == "w/2"
+    for (command, body) in first[1:] + [third]:
+        conn.ack(PUBACK, parse_publish(command, body)[3])
+    rest = conn.packets(2, client)
+    assert [parse_publish(*p)[0] for p in rest] == ["w/3", "w/4"]
+    for p in rest:
+        conn.ack(PUBACK, parse_publish(*p)[3])
+    pump(client, lambda: all(info.is_published() for info in infos))
+
+
+def test_publish_many(broker):
+    client = umqtt.Client("u")
+    conn = connect(client, broker)
+    infos = client.publish_many([("m/0", b"a"), ("m/1", b"b", 1), ("m/2", b"c", 2, True)])
+    sent = [parse_publish(*p) for p in conn.packets(3, client)]
+    assert sent == [("m/0", b"a", 0, 0, False, False),
+                    ("m/1", b"b", 1, infos[1].mid, False, False),
+                    ("m/2", b"c", 2, infos[2].mid, False, True)]
+    assert infos[0].is_published()
+    assert [info.mid for info in infos] == [infos[0].mid + i for i in range(3)]
+
+
+def test_resend_after_reconnect(broker):
+    client = umqtt.Client("u", clean_session=False)
+    conn = connect(client, broker)
+    info1 = client.publish("r/1", b"one", qos=1)
+    info2 = client.publish("r/2", b"two", qos=2)
+    conn.packets(2, client)
+    conn.ack(PUBREC, info2.mid)
+    conn.expect(PUBREL, client)
+    conn.close()
+    pump(client, lambda: client.loop(0.01) != umqtt.MQTT_ERR_SUCCESS)
+
+    conn = connect(client, broker)
+    resent = conn.packets(2, client)
+    assert parse_publish(*resent[0]) == ("r/1", b"one", 1, info1.mid, True, False)
+    assert resent[1] == (PUBREL | 0x0A, ack_packet(0, info2.mid)[2:])
+    conn.ack(PUBACK, info1.mid)
+    conn.ack(PUBCOMP, info2.mid)
+    pump(client, lambda: info1.is_published() and info2.is_published())
+
+
+def test_retry_after_message_retry_set(broker):
+    client = umqtt.Client("u")
+    conn = connect(client, broker)
+    info1 = client.publish("r/1", b"one", qos=1)
+    info2 = client.publish("r/2", b"two", qos=2)
+    conn.packets(2, client)
+    conn.ack(PUBREC, info2.mid)
+    conn.expect(PUBREL, client)
+    conn.send(publish_packet("in/2", b"held", qos=2, mid=30))
+    conn.expect(PUBREC, client)
+    # Nothing is due for 20 seconds.
+    assert conn.quiet(client, 0.3) == []
+
+    # Shortening the timeout reschedules what is already in flight.
+    client.message_retry_set(0.2)
+    retried = conn.packets(3, client, timeout=2.0)
+    assert sorted(retried) == sorted([
+        (PUBLISH | 0x0A, publish_packet("r/1", b"one", qos=1, mid=info1.mid)[2:]),
+        (PUBREL | 0x0A, ack_packet(0, info2.mid)[2:]),
+        (PUBREC, b"\x00\x1e")])
+
+    # Each is retried again after another timeout, not straight away.
+    assert conn.quiet(client, 0.1) == []
+    assert len(conn.packets(3, client, timeout=2.0)) == 3
+
+    # Finished messages are not retried.
+    conn.ack(PUBACK, info1.mid)
+    conn.ack(PUBCOMP, info2.mid)
+    conn.send(ack_packet(PUBREL | 0x02, 30))
+    conn.expect(PUBCOMP, client)
+    pump(client, lambda: info1.is_published() and info2.is_published())
+    assert conn.quiet(client, 0.5) == []
+
+
+def test_retry_of_zero(broker):
+    client = umqtt.Client("u")
+    client.message_retry_set(0)
+    conn = connect(client, broker)
+    info = client.publish("r/0", b"zero", qos=1)
+    conn.packets(1, client)
+    # Every pass of loop() resends it once, and loop() still returns.
+    assert client.loop(0.01) == umqtt.MQTT_ERR_SUCCESS
+    assert client.loop(0.01) == umqtt.MQTT_ERR_SUCCESS
+    resent = conn.packets(2, client)
+    assert all(parse_publish(*p)[3:5] == (info.mid, True) for p in resent)
+    conn.ack(PUBACK, info.mid)
+    pump(client, info.is_published)
+
+
+def run_forever(client):
+    """Start client.loop_forever() on a thread. It runs until a message on
+    the topic "stop" arrives."""
+    def on_message(client_, userdata, message):
+        if message.topic == "stop":
+            client_.disconnect()
+    client.on_message = on_message
+    thread = threading.Thread(target=client.loop_forever)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def stop(conn, thread):
+    conn.send(publish_packet("stop"))
+    conn.expect(DISCONNECT)
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_loop_forever_backoff(broker):
+    client = umqtt.Client("u")
+    client.reconnect_delay_set(0.1, 0.4)
+    connect(client, broker).close()
+    thread = run_forever(client)
+
+    # Connections dropped before the CONNACK count as failed attempts, so
+    # the wait doubles up to the maximum.
+    times = [time.time()]
+    for i in range(4):
+        conn = broker.accept(timeout=2.0)
+        times.append(time.time())
+        conn.expect(CONNECT)
+        conn.close()
+    waits = [b - a for (a, b) in zip(times, times[1:])]
+    for (wait, expected) in zip(waits, (0.1, 0.2, 0.4, 0.4)):
+        assert expected - 0.02 <= wait < expected + 0.15, waits
+
+    # A CONNACK resets it to the minimum.
+    conn = broker.accept(timeout=2.0)
+    conn.expect(CONNECT)
+    conn.connack()
+    conn.quiet(duration=0.1)
+    start = time.time()
+    conn.close()
+    conn = broker.accept(timeout=2.0)
+    assert time.time() - start < 0.25
+    conn.expect(CONNECT)
+    conn.connack()
+    stop(conn, thread)
+
+
+def test_loop_forever_waits_for_keepalive(broker):
+    client = umqtt.Client("u")
+    conn = connect(client, broker, keepalive=1)
+    start = time.time()
+    thread = run_forever(client)
+    conn.expect(PINGREQ)
+    assert 0.9 <= time.time() - start < 1.5
+    conn.send(packet(PINGRESP))
+    # Answered, so the connection stays up and the next PINGREQ is a
+    # keepalive later.
+    conn.expect(PINGREQ)
+    assert 1.9 <= time.time() - start < 2.5
+    stop(conn, thread)
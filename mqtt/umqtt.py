@@ -18,44 +18,66 @@ This is an MQTT v3.1 client module. MQTT is a lightweight pub/sub messaging
 protocol that is easy to implement and suitable for low powered devices.
 """
 import errno
-import sys
 import select
 import socket
-import ustruct as struct
-import utime as time
+try:
+    from ucollections import OrderedDict
+except ImportError:
+    from collections import OrderedDict
+try:
+    import utime as time
+except ImportError:
+    import time
+
+from umqtt_codec import split_frames, topic_matches_sub
+from umqtt_core import (MQTTv31, MQTTv311, PROTOCOL_NAMEv31, PROTOCOL_NAMEv311, CONNECT,
+                        CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP, SUBSCRIBE, SUBACK,
+                        UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT, MQTT_LOG_INFO,
+                        MQTT_LOG_NOTICE, MQTT_LOG_WARNING, MQTT_LOG_ERR, MQTT_LOG_DEBUG,
+                        mqtt_cs_new, mqtt_cs_connected, mqtt_cs_disconnecting,
+                        mqtt_cs_connect_async, mqtt_ms_invalid, mqtt_ms_publish,
+                        mqtt_ms_wait_for_puback, mqtt_ms_wait_for_pubrec, mqtt_ms_resend_pubrel,
+                        mqtt_ms_wait_for_pubrel, mqtt_ms_resend_pubcomp, mqtt_ms_wait_for_pubcomp,
+                        mqtt_ms_send_pubrec, mqtt_ms_queued, Message, MQTTMessageInfo,
+                        MQTTSession, encode_payload)
 
 EAGAIN = errno.EAGAIN
 
-MQTTv31 = 3
-MQTTv311 = 4
+# Clock for keepalive and retry deadlines. utime.ticks_ms() wraps around, so
+# the retry heap in umqtt_core.MQTTSession couldn't order on it.
+time_func = getattr(time, 'monotonic', time.time)
 
-PROTOCOL_NAMEv31 = b"MQIsdp"
-PROTOCOL_NAMEv311 = b"MQTT"
+if hasattr(select.epoll, 'modify'):
+    class _epoll(object):
+        # CPython's epoll, made to behave like the MicroPython one that
+        # Client is written for: poll() takes milliseconds, and register()
+        # of a registered fd changes its events.
+        __slots__ = ('_ep', '_fds')
+
+        def __init__(self):
+            self._ep = select.epoll()
+            self._fds = set()
+
+        def register(self, fd, eventmask):
+            if fd in self._fds:
+                self._ep.modify(fd, eventmask)
+            else:
+                self._ep.register(fd, eventmask)
+                self._fds.add(fd)
+
+        def poll(self, timeout_ms=-1):
+            return self._ep.poll(timeout_ms / 1000.0 if timeout_ms >= 0 else -1)
+
+        def close(self):
+            self._ep.close()
+else:
+    _epoll = select.epoll
 
 PROTOCOL_VERSION = 3
 
-# Message types
-CONNECT = 0x10
-CONNACK = 0x20
-PUBLISH = 0x30
-PUBACK = 0x40
-PUBREC = 0x50
-PUBREL = 0x60
-PUBCOMP = 0x70
-SUBSCRIBE = 0x80
-SUBACK = 0x90
-UNSUBSCRIBE = 0xA0
-UNSUBACK = 0xB0
-PINGREQ = 0xC0
-PINGRESP = 0xD0
-DISCONNECT = 0xE0
-
-# Log levels
-MQTT_LOG_INFO = 0x01
-MQTT_LOG_NOTICE = 0x02
-MQTT_LOG_WARNING = 0x04
-MQTT_LOG_ERR = 0x08
-MQTT_LOG_DEBUG = 0x10
+# The log levels from least to most severe. Client.log_level_set() enables a
+# level and all those after it.
+_LOG_SEVERITY = (MQTT_LOG_DEBUG, MQTT_LOG_INFO, MQTT_LOG_NOTICE, MQTT_LOG_WARNING, MQTT_LOG_ERR)
 
 # CONNACK codes
 CONNACK_ACCEPTED = 0
@@ -65,23 +87,10 @@ CONNACK_REFUSED_SERVER_UNAVAILABLE = 3
 CONNACK_REFUSED_BAD_USERNAME_PASSWORD = 4
 CONNACK_REFUSED_NOT_AUTHORIZED = 5
 
-# Connection state
-mqtt_cs_new = 0
-mqtt_cs_connected = 1
-mqtt_cs_disconnecting = 2
-mqtt_cs_connect_async = 3
-
-# Message state
-mqtt_ms_invalid = 0
-mqtt_ms_publish= 1
-mqtt_ms_wait_for_puback = 2
-mqtt_ms_wait_for_pubrec = 3
-mqtt_ms_resend_pubrel = 4
-mqtt_ms_wait_for_pubrel = 5
-mqtt_ms_resend_pubcomp = 6
-mqtt_ms_wait_for_pubcomp = 7
-mqtt_ms_send_pubrec = 8
-mqtt_ms_queued = 9
+# Packets that go out ahead of queued PUBLISHes, see _packet_queue(). Only
+# keepalive and acknowledgements: SUBSCRIBE, UNSUBSCRIBE and DISCONNECT stay
+# in order with the PUBLISHes around them.
+_PRIORITY_COMMANDS = (CONNECT, PUBACK, PUBREC, PUBREL, PUBCOMP, PINGREQ, PINGRESP)
 
 # Error values
 MQTT_ERR_AGAIN = -1
@@ -103,6 +112,17 @@ MQTT_ERR_ERRNO = 14
 
 sockpair_data = b"0"
 
+# Size of the receive buffer. A packet that does not fit is received into a
+# buffer of its own.
+READ_CHUNK_SIZE = 1024
+
+# Number of spent _OutPacket objects kept for reuse.
+OUT_PACKET_POOL_SIZE = 32
+
+# Default number of incoming topics whose decoded string and matching
+# callbacks are cached, see Client.topic_cache_set().
+TOPIC_CACHE_SIZE = 16
+
 def error_string(mqtt_errno):
     """Return the error string associated with an mqtt error number."""
     if mqtt_errno == MQTT_ERR_SUCCESS:
@@ -157,145 +177,218 @@ def connack_string(connack_code):
         return "Connection Refused: unknown reason."
 
 
-def topic_matches_sub(sub, topic):
-    """Check whether a topic matches a subscription.
-
-    For example:
-
-    foo/bar would match the subscription foo/# or +/bar
-    non/matching would not match the subscription non/+/+
-    """
-    result = True
-    multilevel_wildcard = False
-
-    slen = len(sub)
-    tlen = len(topic)
-
-    if slen > 0 and tlen > 0:
-        if (sub[0] == '$' and topic[0] != '$') or (topic[0] == '$' and sub[0] != '$'):
-            return False
-
-    spos = 0
-    tpos = 0
-
-    while spos < slen and tpos < tlen:
-        if sub[spos] == topic[tpos]:
-            if tpos == tlen-1:
-                # Check for e.g. foo matching foo/#
-                if spos == slen-3 and sub[spos+1] == '/' and sub[spos+2] == '#':
-                    result = True
-                    multilevel_wildcard = True
-                    break
-
-            spos += 1
-            tpos += 1
-
-            if tpos == tlen and spos == slen-1 and sub[spos] == '+':
-                spos += 1
-                result = True
-                break
-        else:
-            if sub[spos] == '+':
-                spos += 1
-                while tpos < tlen and topic[tpos] != '/':
-                    tpos += 1
-                if tpos == tlen and spos == slen:
-                    result = True
-                    break
-
-            elif sub[spos] == '#':
-                multilevel_wildcard = True
-                if spos+1 != slen:
-                    result = False
-                    break
-                else:
-                    result = True
-                    break
-
-            else:
-                result = False
-                break
-
-    if not multilevel_wildcard and (tpos < tlen or spos < slen):
-        result = False
-
-    return result
-
-class MQTTMessage:
+class MQTTMessage(Message):
     """ This is a class that describes an incoming message. It is passed to the
     on_message callback as the message parameter.
     """
+    __slots__ = ()
+
+
+class _OutPacket(object):
+    """A packet waiting in the outgoing queue and how much of it has been
+    written so far. Instances are recycled through Client._out_packet_pool."""
+    __slots__ = ('command', 'mid', 'qos', 'pos', 'to_process', 'packet', 'info', 'topic')
+
+    def set(self, command, packet, mid, qos, info=None):
+        # info is the MQTTMessageInfo of a QoS 0 PUBLISH, to be marked
+        # published once written, or a list of them for a publish_many() batch
+        # or a coalesced PUBLISH. topic is set while a coalesced PUBLISH can
+        # still be replaced.
+        self.command = command
+        self.mid = mid
+        self.qos = qos
+        self.info = info
+        self.topic = None
+        self.pos = 0
+        self.to_process = len(packet)
+        self.packet = packet
+
+class MQTTMatcher(object):
+    """Values stored against topic filters, such as the callbacks given to
+    Client.message_callback_add().
+
+    The filters are kept in a trie with one level of the filter per node, and
+    '+' and '#' as ordinary child names. match() finds every filter that
+    matches a topic in a single walk of the trie, so its cost depends on the
+    depth of the topic rather than the number of filters.
+
+    matcher[sub] = value, matcher[sub] and del matcher[sub] add, look up and
+    remove the value for an exact filter string.
+    """
+    class Node(object):
+        # plus and hash are the '+' and '#' children, also in children, kept
+        # to hand so that match() doesn't have to look them up at every node.
+        __slots__ = ('children', 'value', 'seq', 'plus', 'hash')
+
+        def __init__(self):
+            self.children = {}
+            self.value = None
+            self.seq = 0
+            self.plus = None
+            self.hash = None
+
     def __init__(self):
-        self.timestamp = 0
-        self.state = mqtt_ms_invalid
-        self.dup = False
-        self.mid = 0
-        self.topic = ""
-        self.payload = None
-        self.qos = 0
-        self.retain = False
-
-class Client(object):
+        self._root = MQTTMatcher.Node()
+        self._seq = 0
+
+    def __setitem__(self, sub, value):
+        node = self._root
+        for level in sub.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = MQTTMatcher.Node()
+                if level == '+':
+                    node.plus = child
+                elif level == '#':
+                    node.hash = child
+            node = child
+        if node.value is None:
+            # Replacing a value keeps the filter's place in the match order.
+            self._seq += 1
+            node.seq = self._seq
+        node.value = value
+
+    def __getitem__(self, sub):
+        node = self._root
+        for level in sub.split('/'):
+            node = node.children.get(level)
+            if node is None:
+                raise KeyError(sub)
+        if node.value is None:
+            raise KeyError(sub)
+        return node.value
+
+    def __delitem__(self, sub):
+        path = []
+        node = self._root
+        for level in sub.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                raise KeyError(sub)
+            path.append((node, level))
+            node = child
+        if node.value is None:
+            raise KeyError(sub)
+        node.value = None
+        # Prune the branch back to the last node still in use.
+        while path and not node.children and node.value is None:
+            node, level = path.pop()
+            del node.children[level]
+            if level == '+':
+                node.plus = None
+            elif level == '#':
+                node.hash = None
+
+    def match(self, topic):
+        """Return the values of all filters matching topic, in the order the
+        filters were added."""
+        levels = topic.split('/')
+        found = []
+        # Wildcards don't match the first level of a topic starting with $,
+        # see topic_matches_sub().
+        self._match(self._root, levels, 0, len(levels), topic[:1] != '$', found)
+        n = len(found)
+        if n == 0:
+            return found
+        if n == 1:
+            return [found[0].value]
+        if n == 2:
+            (a, b) = found
+            if a.seq < b.seq:
+                return [a.value, b.value]
+            return [b.value, a.value]
+        found.sort(key=lambda node: node.seq)
+        return [node.value for node in found]
+
+    def _match(self, node, levels, i, n, wild, found):
+        # Add the nodes below node of the filters matching levels[i:] to
+        # found. The exact level names are followed in a loop and only a '+'
+        # child costs a call, so the walk is a few attribute loads and one
+        # dict lookup per level for each '+' it branches at.
+        while True:
+            if wild:
+                # foo/# matches foo/bar as well as foo.
+                child = node.hash
+                if child is not None and child.value is not None:
+                    found.append(child)
+                child = node.plus
+                if child is not None and i < n:
+                    self._match(child, levels, i+1, n, True, found)
+            if i == n:
+                if node.value is not None:
+                    found.append(node)
+                return
+            node = node.children.get(levels[i])
+            if node is None:
+                return
+            i += 1
+            wild = True
+
+class Client(MQTTSession):
     """MQTT version 3.1/3.1.1 client class.
 
-    This is the main class for use communicating with an MQTT broker.
+    This is the main class for use communicating with an MQTT broker. The
+    protocol itself is umqtt_core.MQTTSession's; Client adds the socket, the
+    outgoing queue and the callbacks.
     """
+    _message_class = MQTTMessage
+
     def __init__(self, client_id="", clean_session=True, userdata=None, protocol=MQTTv31):
         if not clean_session and (client_id == "" or client_id is None):
             raise ValueError('A client id must be provided if clean session is False.')
 
-        self._protocol = protocol
+        if client_id == "" or client_id is None:
+            client_id = "umqtt"
+        MQTTSession.__init__(self, client_id, clean_session, protocol)
         self._userdata = userdata
         self._sock = None
-        self._keepalive = 60
-        self._message_retry = 20
-        self._last_retry_check = 0
-        self._clean_session = clean_session
-        if client_id == "" or client_id is None:
-            self._client_id = "umqtt"
-        else:
-            self._client_id = client_id
-
-        self._username = ""
-        self._password = ""
-        self._in_packet = {
-            "command": 0,
-            "have_remaining": 0,
-            "remaining_count": [],
-            "remaining_mult": 1,
-            "remaining_length": 0,
-            "packet": b"",
-            "to_process": 0,
-            "pos": 0}
+        self._ssl = None
+        # Clock reading for the current pass of loop().
+        self._now = time_func()
+        self._in_buf = bytearray(READ_CHUNK_SIZE)
+        self._in_view = memoryview(self._in_buf)
+        self._in_start = 0
+        self._in_end = 0
+        self._in_command = 0
+        self._in_body = None
+        self._in_body_pos = 0
+        # Outgoing packets in two lanes: _out_control for _PRIORITY_COMMANDS,
+        # which is always taken from first, and _out_packet for everything
+        # else.
+        self._out_control = []
         self._out_packet = []
+        self._out_control_max = 0
+        self._out_packet_max = 0
+        # Unwritten QoS 0 PUBLISH packets by topic, see coalesce_set().
+        self._coalesce = False
+        self._coalesce_pending = {}
+        self._coalesced = 0
+        self._out_packet_pool = []
         self._current_out_packet = None
-        self._last_msg_in = time.time()
-        self._last_msg_out = time.time()
-        self._ping_t = 0
-        self._last_mid = 0
-        self._state = mqtt_cs_new
-        self._out_messages = []
-        self._in_messages = []
-        self._max_inflight_messages = 20
-        self._inflight_messages = 0
-        self._will = False
-        self._will_topic = ""
-        self._will_payload = None
-        self._will_qos = 0
-        self._will_retain = False
+        self._last_msg_in = self._now
+        self._last_msg_out = self._now
         self.on_disconnect = None
         self.on_connect = None
         self.on_publish = None
         self.on_message = None
-        self.on_message_filtered = []
+        self._on_message_filtered = MQTTMatcher()
+        self._topic_cache = OrderedDict()
+        self._topic_cache_size = TOPIC_CACHE_SIZE
+        self._topic_cache_hits = 0
+        self._topic_cache_misses = 0
         self.on_subscribe = None
         self.on_unsubscribe = None
-        self.on_log = None #None
+        self._on_log = None
+        self._log_level = MQTT_LOG_DEBUG
         self._host = ""
         self._port = 1883
         self._bind_address = ""
         self._in_callback = False
-        self._strict_protocol = False
+        self.ep = None
+        self._ep_out = False
+        self._reconnect_min_delay = 1
+        self._reconnect_max_delay = 120
+        self._reconnect_delay = None
 
     def __del__(self):
         pass
@@ -310,7 +403,6 @@ class Client(object):
     def connect(self, host, port=1883, keepalive=60, bind_address=""):
         """Connect to a remote broker.
         """
-        print("connect")
         self.connect_async(host, port, keepalive, bind_address)
         return self.reconnect()
 
@@ -319,7 +411,6 @@ class Client(object):
         connect call that can be used with loop_start() to provide very quick
         start.
         """
-        print("connect_async")
         if host is None or len(host) == 0:
             raise ValueError('Invalid host.')
         if port <= 0:
@@ -337,35 +428,37 @@ class Client(object):
     def reconnect(self):
         """Reconnect the client after a disconnect. Can only be called after
         connect()/connect_async()."""
-        print("reconnect")
         if len(self._host) == 0:
             raise ValueError('Invalid host.')
         if self._port <= 0:
             raise ValueError('Invalid port number.')
 
-        self._in_packet = {
-            "command": 0,
-            "have_remaining": 0,
-            "remaining_count": [],
-            "remaining_mult": 1,
-            "remaining_length": 0,
-            "packet": b"",
-            "to_process": 0,
-            "pos": 0}
+        self._in_buf = bytearray(READ_CHUNK_SIZE)
+        self._in_view = memoryview(self._in_buf)
+        self._in_start = 0
+        self._in_end = 0
+        self._in_command = 0
+        self._in_body = None
+        self._in_body_pos = 0
 
+        self._out_control = []
         self._out_packet = []
+        self._coalesce_pending = {}
 
         self._current_out_packet = None
 
-        self._last_msg_in = time.time()
-        self._last_msg_out = time.time()
+        self._now = time_func()
+        self._last_msg_in = self._now
+        self._last_msg_out = self._now
 
         self._ping_t = 0
         self._state = mqtt_cs_new
         if self._sock:
             self._sock.close()
             self._sock = None
-            print("self._sock == None")
+        if self.ep:
+            self.ep.close()
+            self.ep = None
 
         # Put messages in progress in a valid state.
         self._messages_reconnect_reset()
@@ -373,132 +466,182 @@ class Client(object):
         sock = socket.create_connection((self._host, self._port), source_address=(self._bind_address, 0))
         self._sock = sock
         self._sock.setblocking(0)
-        self.ep = select.epoll()
+        self.ep = _epoll()
         self.fileno = self._sock.fileno()
-        self.ep.register(self.fileno)
-
-        print("self._sock =", self._sock)
+        # EPOLLOUT is only asked for while there is something to write, see
+        # loop(). The socket is nearly always writable, so with it set all the
+        # time poll() would never wait.
+        self.ep.register(self.fileno, select.EPOLLIN)
+        self._ep_out = False
 
         return self._send_connect(self._keepalive, self._clean_session)
 
     def loop(self, timeout=1.0, max_packets=1):
         """Process network events.
+
+        Waits up to timeout seconds for the socket to become readable, or
+        writable if there is output pending. timeout=None waits until it does.
         """
-        print("loop")
-        if timeout < 0.0:
+        if timeout is None:
+            timeout_ms = -1
+        elif timeout < 0.0:
             raise ValueError('Invalid timeout.')
+        else:
+            # Round up, waking early would just mean going round again.
+            timeout_ms = int(timeout * 1000)
+            if timeout_ms < timeout * 1000:
+                timeout_ms += 1
 
-        print("self._current_out_packet =", self._current_out_packet)
-        print("self._out_packet =", self._out_packet)
-        if self._current_out_packet is None and len(self._out_packet) > 0:
-            self._current_out_packet = self._out_packet.pop(0)
-        print("self._current_out_packet =", self._current_out_packet)
+        if self._sock is None:
+            return MQTT_ERR_NO_CONN
+
+        if self._current_out_packet is None:
+            self._current_out_packet = self._out_next()
 
-        events = self.ep.poll(1)
-        print("events = ", events)
+        want_out = self._current_out_packet is not None
+        if want_out != self._ep_out:
+            if want_out:
+                self.ep.register(self.fileno, select.EPOLLIN | select.EPOLLOUT)
+            else:
+                self.ep.register(self.fileno, select.EPOLLIN)
+            self._ep_out = want_out
+
+        events = self.ep.poll(timeout_ms)
+        # The one clock reading for everything done on this pass.
+        self._now = time_func()
         for fileno, ev in events:
             if ev & select.EPOLLIN:
-                rc = self.loop_read(max_packets)
+                rc = self._loop_read(max_packets)
                 if rc or (self._sock is None):
                     return rc
 
             if ev & select.EPOLLOUT and self._current_out_packet:
-                rc = self.loop_write(max_packets)
+                rc = self._loop_write(max_packets)
                 if rc or (self._sock is None):
                     return rc
 
-        return self.loop_misc()
+        return self._loop_misc()
+
+    def loop_forever(self, max_packets=1, retry_first_connection=False):
+        """Call loop() until disconnect() is called, reconnecting whenever the
+        connection is lost.
+
+        Between packets it waits in poll() for exactly as long as nothing else
+        needs doing: until the next PINGREQ is due, a PINGRESP is overdue or
+        a message needs retrying. While disconnected it sleeps until the next
+        reconnect attempt, see reconnect_delay_set().
+
+        retry_first_connection: Should the first connection attempt be retried
+        on failure. Only applies if connect_async() was used, otherwise the
+        socket error from the first attempt is raised."""
+        while self._state == mqtt_cs_connect_async:
+            try:
+                self.reconnect()
+            except socket.error:
+                if not retry_first_connection:
+                    raise
+                self._easy_log(MQTT_LOG_DEBUG, "Connection failed, retrying")
+                self._reconnect_wait()
+
+        while True:
+            rc = MQTT_ERR_SUCCESS
+            while rc == MQTT_ERR_SUCCESS:
+                rc = self.loop(self._loop_timeout(), max_packets)
+
+            if self._state == mqtt_cs_disconnecting:
+                return rc
+            self._reconnect_wait()
+            if self._state == mqtt_cs_disconnecting:
+                return rc
+            try:
+                self.reconnect()
+            except socket.error:
+                self._easy_log(MQTT_LOG_DEBUG, "Connection failed, retrying")
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        """Set how long loop_forever() waits before reconnecting. The first
+        attempt after a connection is lost waits min_delay seconds, and each
+        failed attempt doubles the wait, up to max_delay seconds."""
+        if min_delay < 0 or max_delay < min_delay:
+            raise ValueError('Invalid reconnect delay.')
+        self._reconnect_min_delay = min_delay
+        self._reconnect_max_delay = max_delay
+        self._reconnect_delay = None
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        """Publish a message on a topic.
+
+        This causes a message to be sent to the broker and subsequently from
+        the broker to any clients subscribing to matching topics.
+
+        topic: The topic that the message should be published on.
+        payload: The actual message to send. If not given, or set to None a
+        zero length message will be used. Passing an int or float will result
+        in the payload being converted to a string representing that number. If
+        you wish to send a true int/float, use struct.pack() to create the
+        payload you require.
+        qos: The quality of service level to use.
+        retain: If set to true, the message will be set as the "last known
+        good"/retained message for the topic.
+
+        Returns a MQTTMessageInfo, which unpacks as the tuple (result, mid).
+        result is MQTT_ERR_SUCCESS to indicate success or MQTT_ERR_NO_CONN if
+        the client is not currently connected. mid is the message ID for the
+        publish request. The mid value can be used to track the publish
+        request by checking against the mid argument in the on_publish()
+        callback if it is defined.
+
+        A ValueError will be raised if topic is None, has zero length or is
+        invalid (contains a wildcard), if qos is not one of 0, 1 or 2, or if
+        the length of the payload is greater than 268435455 bytes."""
+        if topic is None or len(topic) == 0:
+            raise ValueError('Invalid topic.')
+        if qos<0 or qos>2:
+            raise ValueError('Invalid QoS level.')
+        local_payload = encode_payload(payload)
+
+        if self._topic_wildcard_len_check(topic) != MQTT_ERR_SUCCESS:
+            raise ValueError('Publish topic cannot contain wildcards.')
+
+        local_mid = self._mid_generate()
+        info = MQTTMessageInfo(local_mid)
+
+        info.rc = self._publish(local_mid, topic, local_payload, qos, retain, info)
+        return info
+
+    def publish_many(self, messages):
+        """Publish a batch of messages.
+
+        messages: An iterable of (topic, payload, qos, retain) tuples, with
+        the same meaning as the arguments to publish(). qos and retain may be
+        left off, defaulting to 0 and False.
+
+        This does the same as calling publish() for each message, but the
+        whole batch is encoded into one buffer and handed to the network in
+        one go, rather than paying for a queue entry and a write attempt per
+        message. Use it for bursts of small messages, e.g. a set of sensor
+        readings taken together.
+
+        Returns a list with a MQTTMessageInfo for each message, in order.
+
+        Raises the same errors as publish(). All messages are checked before
+        any is queued, so on error nothing has been sent."""
+        batch = []
+        for item in messages:
+            topic = item[0]
+            payload = item[1] if len(item) > 1 else None
+            qos = item[2] if len(item) > 2 else 0
+            retain = item[3] if len(item) > 3 else False
+            if topic is None or len(topic) == 0:
+                raise ValueError('Invalid topic.')
+            if qos<0 or qos>2:
+                raise ValueError('Invalid QoS level.')
+            if self._topic_wildcard_len_check(topic) != MQTT_ERR_SUCCESS:
+                raise ValueError('Publish topic cannot contain wildcards.')
+            batch.append((topic, encode_payload(payload), qos, retain))
+
+        return self._publish_many(batch, self._sock is not None)
 
-#    def publish(self, topic, payload=None, qos=0, retain=False):
-#        """Publish a message on a topic.
-#
-#        This causes a message to be sent to the broker and subsequently from
-#        the broker to any clients subscribing to matching topics.
-#
-#        topic: The topic that the message should be published on.
-#        payload: The actual message to send. If not given, or set to None a
-#        zero length message will be used. Passing an int or float will result
-#        in the payload being converted to a string representing that number. If
-#        you wish to send a true int/float, use struct.pack() to create the
-#        payload you require.
-#        qos: The quality of service level to use.
-#        retain: If set to true, the message will be set as the "last known
-#        good"/retained message for the topic.
-#
-#        Returns a tuple (result, mid), where result is MQTT_ERR_SUCCESS to
-#        indicate success or MQTT_ERR_NO_CONN if the client is not currently
-#        connected.  mid is the message ID for the publish request. The mid
-#        value can be used to track the publish request by checking against the
-#        mid argument in the on_publish() callback if it is defined.
-#
-#        A ValueError will be raised if topic is None, has zero length or is
-#        invalid (contains a wildcard), if qos is not one of 0, 1 or 2, or if
-#        the length of the payload is greater than 268435455 bytes."""
-#        if topic is None or len(topic) == 0:
-#            raise ValueError('Invalid topic.')
-#        if qos<0 or qos>2:
-#            raise ValueError('Invalid QoS level.')
-#        if isinstance(payload, str) or isinstance(payload, bytearray):
-#            local_payload = payload
-#        elif sys.version_info[0] < 3 and isinstance(payload, unicode):
-#            local_payload = payload
-#        elif isinstance(payload, int) or isinstance(payload, float):
-#            local_payload = str(payload)
-#        elif payload is None:
-#            local_payload = None
-#        else:
-#            raise TypeError('payload must be a string, bytearray, int, float or None.')
-#
-#        if local_payload is not None and len(local_payload) > 268435455:
-#            raise ValueError('Payload too large.')
-#
-#        if self._topic_wildcard_len_check(topic) != MQTT_ERR_SUCCESS:
-#            raise ValueError('Publish topic cannot contain wildcards.')
-#
-#        local_mid = self._mid_generate()
-#
-#        if qos == 0:
-#            rc = self._send_publish(local_mid, topic, local_payload, qos, retain, False)
-#            return (rc, local_mid)
-#        else:
-#            message = MQTTMessage()
-#            message.timestamp = time.time()
-#
-#            message.mid = local_mid
-#            message.topic = topic
-#            if local_payload is None or len(local_payload) == 0:
-#                message.payload = None
-#            else:
-#                message.payload = local_payload
-#
-#            message.qos = qos
-#            message.retain = retain
-#            message.dup = False
-#
-#            self._out_message_mutex.acquire()
-#            self._out_messages.append(message)
-#            if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
-#                self._inflight_messages = self._inflight_messages+1
-#                if qos == 1:
-#                    message.state = mqtt_ms_wait_for_puback
-#                elif qos == 2:
-#                    message.state = mqtt_ms_wait_for_pubrec
-#                self._out_message_mutex.release()
-#
-#                rc = self._send_publish(message.mid, message.topic, message.payload, message.qos, message.retain, message.dup)
-#
-#                # remove from inflight messages so it will be send after a connection is made
-#                if rc is MQTT_ERR_NO_CONN:
-#                    with self._out_message_mutex:
-#                        self._inflight_messages -= 1
-#                        message.state = mqtt_ms_publish
-#
-#                return (rc, local_mid)
-#            else:
-#                message.state = mqtt_ms_queued;
-#                self._out_message_mutex.release()
-#                return (MQTT_ERR_SUCCESS, local_mid)
-#
 #    def username_pw_set(self, username, password=None):
 #        """Set a username and optionally a password for broker authentication.
 #
@@ -522,7 +665,6 @@ class Client(object):
 
     def subscribe(self, topic, qos=0):
         """Subscribe the client to one or more topics."""
-        print("subscribe")
         topic_qos_list = None
         if isinstance(topic, str):
             if qos<0 or qos>2:
@@ -579,11 +721,14 @@ class Client(object):
 
     def loop_read(self, max_packets=1):
         """Process read network events. """
-        print("loop_read")
+        self._now = time_func()
+        return self._loop_read(max_packets)
+
+    def _loop_read(self, max_packets=1):
         if self._sock is None and self._ssl is None:
             return MQTT_ERR_NO_CONN
 
-        max_packets = len(self._out_messages) + len(self._in_messages)
+        max_packets = len(self._out_messages) + len(self._out_message_queue) + len(self._in_messages)
         if max_packets < 1:
             max_packets = 1
 
@@ -597,11 +742,14 @@ class Client(object):
 
     def loop_write(self, max_packets=1):
         """Process write network events.""" 
-        print("loop_write")
+        self._now = time_func()
+        return self._loop_write(max_packets)
+
+    def _loop_write(self, max_packets=1):
         if self._sock is None and self._ssl is None:
             return MQTT_ERR_NO_CONN
 
-        max_packets = len(self._out_packet) + 1
+        max_packets = len(self._out_control) + len(self._out_packet) + 1
         if max_packets < 1:
             max_packets = 1
 
@@ -615,20 +763,16 @@ class Client(object):
 
     def loop_misc(self):
         """Process miscellaneous network events.""" 
-        print("loop_misc")
+        self._now = time_func()
+        return self._loop_misc()
+
+    def _loop_misc(self):
         if self._sock is None: # and self._ssl is None:
             return MQTT_ERR_NO_CONN
 
-        now = time.time()
-        self._check_keepalive()
-        if self._last_retry_check+1 < now:
-            # Only check once a second at most
-            self._message_retry_check()
-            self._last_retry_check = now
-
-        if self._ping_t > 0 and now - self._ping_t >= self._keepalive:
-            # client->ping_t != 0 means we are waiting for a pingresp.
-            # This hasn't happened in the keepalive time so we should disconnect.
+        if self._check_keepalive() != MQTT_ERR_SUCCESS:
+            # No CONNACK or PINGRESP in the keepalive time, so the broker or
+            # the network is gone.
             if self._sock:
                 self._sock.close()
                 self._sock = None
@@ -642,6 +786,9 @@ class Client(object):
                 self.on_disconnect(self, self._userdata, rc)
                 self._in_callback = False
             return MQTT_ERR_CONN_LOST
+        heap = self._retry_heap
+        if heap and heap[0][0] <= self._now:
+            self._message_retry_check()
         return MQTT_ERR_SUCCESS
 
     def max_inflight_messages_set(self, inflight):
@@ -658,6 +805,79 @@ class Client(object):
             raise ValueError('Invalid retry.')
 
         self._message_retry = retry
+        self._retry_rebuild()
+
+    def coalesce_set(self, enabled):
+        """Turn latest value wins coalescing of QoS 0 messages on or off.
+
+        While it is on, a QoS 0 PUBLISH still waiting in the outgoing queue
+        is replaced in place by a newer one on the same topic, so a topic
+        published faster than the link can carry it, such as a volume level,
+        only sends its latest value. A replaced message counts as published
+        once the one that replaced it is written. queue_stats() counts the
+        messages replaced. Off by default."""
+        self._coalesce = bool(enabled)
+        if not enabled:
+            for mpkt in self._coalesce_pending.values():
+                mpkt.topic = None
+            self._coalesce_pending = {}
+
+    def topic_cache_set(self, size):
+        """Set how many incoming topics to remember. Each is kept as the raw
+        topic bytes mapped to the decoded topic string and the
+        message_callback_add() callbacks matching it, so messages on a known
+        topic skip both. The least recently used topic is dropped first.
+        Defaults to 16, 0 disables the cache."""
+        if size < 0:
+            raise ValueError('Invalid size.')
+        self._topic_cache_size = size
+        self._topic_cache.clear()
+
+    def queue_stats(self):
+        """Return a dict with the number of packets waiting in each lane of
+        the outgoing queue, and the most there have been since the client
+        was created. control is acknowledgements, PINGREQ and CONNECT, which
+        are sent ahead of the packets in publish. coalesced is the number of
+        QoS 0 messages replaced in the queue by a newer one, see
+        coalesce_set()."""
+        return {
+            'control': len(self._out_control),
+            'publish': len(self._out_packet),
+            'control_max': self._out_control_max,
+            'publish_max': self._out_packet_max,
+            'coalesced': self._coalesced}
+
+    def topic_cache_stats(self):
+        """Return a dict with the number of topic cache hits and misses
+        since the client was created, and the current and maximum number of
+        entries."""
+        return {
+            'hits': self._topic_cache_hits,
+            'misses': self._topic_cache_misses,
+            'entries': len(self._topic_cache),
+            'size': self._topic_cache_size}
+
+    def log_level_set(self, level):
+        """Set the least severe level of log message passed on, one of
+        MQTT_LOG_DEBUG (the default, everything), MQTT_LOG_INFO,
+        MQTT_LOG_NOTICE, MQTT_LOG_WARNING or MQTT_LOG_ERR.
+
+        Messages below the level are never formatted. Raising it above
+        MQTT_LOG_DEBUG takes logging out of the per-packet cost even while
+        on_log is set."""
+        if level not in _LOG_SEVERITY:
+            raise ValueError('Invalid log level.')
+        self._log_level = level
+        self._log_update()
+
+    @property
+    def on_log(self):
+        return self._on_log
+
+    @on_log.setter
+    def on_log(self, func):
+        self._on_log = func
+        self._log_update()
 
     def user_data_set(self, userdata):
         """Set the user data variable passed to callbacks. May be any data type."""
@@ -729,12 +949,8 @@ class Client(object):
         if callback is None or sub is None:
             raise ValueError("sub and callback must both be defined.")
 
-        for i in range(0, len(self.on_message_filtered)):
-            if self.on_message_filtered[i][0] == sub:
-                self.on_message_filtered[i] = (sub, callback)
-                return
-
-        self.on_message_filtered.append((sub, callback))
+        self._on_message_filtered[sub] = callback
+        self._topic_cache.clear()
 
     def message_callback_remove(self, sub):
         """Remove a message callback previously registered with
@@ -742,10 +958,12 @@ class Client(object):
         if sub is None:
             raise ValueError("sub must defined.")
 
-        for i in range(0, len(self.on_message_filtered)):
-            if self.on_message_filtered[i][0] == sub:
-                self.on_message_filtered.pop(i)
-                return
+        try:
+            del self._on_message_filtered[sub]
+        except KeyError:
+            # Not registered, nothing to do.
+            return
+        self._topic_cache.clear()
 
     # ============================================================
     # Private functions
@@ -770,123 +988,111 @@ class Client(object):
         return rc
 
     def _packet_read(self):
-        # This gets called if pselect() indicates that there is network data
-        # available - ie. at least one byte.  What we do depends on what data we
-        # already have.
-        # If we've not got a command, attempt to read one and save it. This should
-        # always work because it's only a single byte.
-        # Then try to read the remaining length. This may fail because it is may
-        # be more than one byte - will need to save data pending next read if it
-        # does fail.
-        # Then try to read the remaining payload, where 'payload' here means the
-        # combined variable header and actual payload. This is the most likely to
-        # fail due to longer length, so save current data and current position.
-        # After all data is read, send to _mqtt_handle_packet() to deal with.
-        # Finally, free the memory and reset everything to starting conditions.
-        print("_packet_read")
-        if self._in_packet['command'] == 0:
-            try:
-                command = self._sock.recv(1)
-            except socket.error as err:
-                if err.errno == EAGAIN:
-                    return MQTT_ERR_AGAIN
-                print(err)
+        # This gets called if select() indicates that there is network data
+        # available - ie. at least one byte.  Rather than reading the command,
+        # the remaining length and the payload with separate recv() calls, pull
+        # as much as the socket has into _in_buf with a single recv() and then
+        # hand every complete packet it holds to _packet_handle(). Whatever is
+        # left over is the start of a packet that a later read will complete.
+        # A packet too big for _in_buf gets a body of its own, _in_body, which
+        # is allocated once at its final size and filled in place.
+        if self._in_body is not None:
+            nbytes = len(self._in_body) - self._in_body_pos
+        else:
+            nbytes = len(self._in_buf) - self._in_end
+        try:
+            data = self._sock.recv(nbytes)
+        except socket.error as err:
+            if err.errno == EAGAIN:
+                return MQTT_ERR_AGAIN
+            self._easy_log(MQTT_LOG_ERR, "Failed to receive on socket: %s", err)
+            return 1
+        else:
+            nbytes = len(data)
+            if nbytes == 0:
                 return 1
-            else:
-                if len(command) == 0:
-                    return 1
-                command = struct.unpack("!B", command)
-                self._in_packet['command'] = command[0]
-
-        if self._in_packet['have_remaining'] == 0:
-            # Read remaining
-            # Algorithm for decoding taken from pseudo code at
-            # http://publib.boulder.ibm.com/infocenter/wmbhelp/v6r0m0/topic/com.ibm.etools.mft.doc/ac10870_.htm
-            while True:
-                try:
-                    byte = self._sock.recv(1)
-                except socket.error as err:
-                    if err.errno == EAGAIN:
-                        return MQTT_ERR_AGAIN
-                    print(err)
-                    return 1
-                else:
-                    byte = struct.unpack("!B", byte)
-                    byte = byte[0]
-                    self._in_packet['remaining_count'].append(byte)
-                    # Max 4 bytes length for remaining length as defined by protocol.
-                     # Anything more likely means a broken/malicious client.
-                    if len(self._in_packet['remaining_count']) > 4:
-                        return MQTT_ERR_PROTOCOL
-
-                    self._in_packet['remaining_length'] = self._in_packet['remaining_length'] + (byte & 127)*self._in_packet['remaining_mult']
-                    self._in_packet['remaining_mult'] = self._in_packet['remaining_mult'] * 128
-
-                if (byte & 128) == 0:
-                    break
 
-            self._in_packet['have_remaining'] = 1
-            self._in_packet['to_process'] = self._in_packet['remaining_length']
+        if self._in_body is None:
+            self._in_buf[self._in_end:self._in_end+nbytes] = data
+            self._in_end += nbytes
+            return self._packet_split()
 
-        while self._in_packet['to_process'] > 0:
-            try:
-                data = self._sock.recv(self._in_packet['to_process'])
-            except socket.error as err:
-                if err.errno == EAGAIN:
-                    return MQTT_ERR_AGAIN
-                print(err)
-                return 1
-            else:
-                self._in_packet['to_process'] = self._in_packet['to_process'] - len(data)
-                self._in_packet['packet'] = self._in_packet['packet'] + data
-
-        # All data for this packet is read.
-        self._in_packet['pos'] = 0
-        rc = self._packet_handle()
-
-        # Free data and reset values
-        self._in_packet = dict(
-            command=0,
-            have_remaining=0,
-            remaining_count=[],
-            remaining_mult=1,
-            remaining_length=0,
-            packet=b"",
-            to_process=0,
-            pos=0)
-
-        self._last_msg_in = time.time()
+        self._in_body[self._in_body_pos:self._in_body_pos+nbytes] = data
+        self._in_body_pos += nbytes
+        if self._in_body_pos < len(self._in_body):
+            return MQTT_ERR_SUCCESS
+        body = self._in_body
+        self._in_body = None
+        return self._packet_handle(self._in_command, memoryview(body))
+
+    def _packet_split(self):
+        # Carve complete packets out of _in_buf. Each one is handed on as a
+        # memoryview into the buffer, so nothing is copied; the buffer is only
+        # ever overwritten, never resized, so those views stay valid until the
+        # next read. _packet_handle() may end up in reconnect() (CONNACK
+        # downgrade) or close the socket from a callback, in which case the
+        # rest of the buffer belongs to a dead connection.
+        buf = self._in_buf
+        end = self._in_end
+        frames, pos, remaining_length, start = split_frames(buf, self._in_start, end)
+        rc = MQTT_ERR_SUCCESS
+        for command, body_start, body_end in frames:
+            self._in_start = body_end
+            rc = self._packet_handle(command, self._in_view[body_start:body_end])
+            if rc or buf is not self._in_buf or self._sock is None:
+                return rc
+
+        if remaining_length < 0:
+            if start < 0:
+                return MQTT_ERR_PROTOCOL
+            # Length bytes not all here yet.
+        elif start - pos + remaining_length > len(buf):
+            # Will never fit, move what we have into a body of its own.
+            self._in_command = buf[pos]
+            self._in_body = bytearray(remaining_length)
+            self._in_body_pos = end - start
+            self._in_body[:self._in_body_pos] = self._in_view[start:end]
+            pos = end
+
+        # Keep the partial packet, if any, at the front of the buffer so the
+        # next recv() has the rest of it to fill.
+        if pos == end:
+            self._in_start = self._in_end = 0
+        elif pos > 0:
+            buf[:end-pos] = buf[pos:end]
+            self._in_start = 0
+            self._in_end = end - pos
         return rc
 
     def _packet_write(self):
-        print("_packet_write")
-
         while self._current_out_packet:
             packet = self._current_out_packet
 
             try:
-                write_length = self._sock.send(packet['packet'][packet['pos']:])
+                write_length = self._sock.send(packet.packet[packet.pos:])
             except AttributeError:
                 return MQTT_ERR_SUCCESS
             except socket.error as err:
                 if err.errno == EAGAIN:
                     return MQTT_ERR_AGAIN
-                print(err)
+                self._easy_log(MQTT_LOG_ERR, "Failed to send on socket: %s", err)
                 return 1
 
             if write_length > 0:
-                packet['to_process'] = packet['to_process'] - write_length
-                packet['pos'] = packet['pos'] + write_length
-
-                if packet['to_process'] == 0:
-                    if (packet['command'] & 0xF0) == PUBLISH and packet['qos'] == 0:
-                        if self.on_publish:
-                            self._in_callback = True
-                            self.on_publish(self, self._userdata, packet['mid'])
-                            self._in_callback = False
-
-                    if (packet['command'] & 0xF0) == DISCONNECT:
-                        self._last_msg_out = time.time()
+                packet.to_process = packet.to_process - write_length
+                packet.pos = packet.pos + write_length
+
+                if packet.to_process == 0:
+                    if packet.info is not None:
+                        # A QoS 0 PUBLISH is done once it is written.
+                        if isinstance(packet.info, list):
+                            for info in packet.info:
+                                self._publish_complete(info)
+                        else:
+                            self._publish_complete(packet.info)
+
+                    if (packet.command & 0xF0) == DISCONNECT:
+                        self._last_msg_out = self._now
                         if self.on_disconnect:
                             self._in_callback = True
                             self.on_disconnect(self, self._userdata, 0)
@@ -897,342 +1103,98 @@ class Client(object):
                             self._sock = None
                         return MQTT_ERR_SUCCESS
 
-                    if len(self._out_packet) > 0:
-                        self._current_out_packet = self._out_packet.pop(0)
-                    else:
-                        self._current_out_packet = None
+                    packet.packet = None
+                    packet.info = None
+                    if len(self._out_packet_pool) < OUT_PACKET_POOL_SIZE:
+                        self._out_packet_pool.append(packet)
+
+                    self._current_out_packet = self._out_next()
             else:
                 break
 
-        self._last_msg_out = time.time()
-        print("self._current_out_packet =", self._current_out_packet)
+        self._last_msg_out = self._now
         return MQTT_ERR_SUCCESS
 
-    def _easy_log(self, level, buf):
-        if self.on_log:
-            self.on_log(self, self._userdata, level, buf)
-
-    def _check_keepalive(self):
-        now = time.time()
-        last_msg_out = self._last_msg_out
-        last_msg_in = self._last_msg_in
-        if (self._sock is not None or self._ssl is not None) and (now - last_msg_out >= self._keepalive or now - last_msg_in >= self._keepalive):
-            if self._state == mqtt_cs_connected and self._ping_t == 0:
-                self._send_pingreq()
-                self._last_msg_out = now
-                self._last_msg_in = now
-            else:
-                if self._sock:
-                    self._sock.close()
-                    self._sock = None
-
-                if self._state == mqtt_cs_disconnecting:
-                    rc = MQTT_ERR_SUCCESS
-                else:
-                    rc = 1
-                if self.on_disconnect:
-                    self._in_callback = True
-                    self.on_disconnect(self, self._userdata, rc)
-                    self._in_callback = False
-
-    def _mid_generate(self):
-        self._last_mid = self._last_mid + 1
-        if self._last_mid == 65536:
-            self._last_mid = 1
-        return self._last_mid
-
-    def _topic_wildcard_len_check(self, topic):
-        # Search for + or # in a topic. Return MQTT_ERR_INVAL if found.
-         # Also returns MQTT_ERR_INVAL if the topic string is too long.
-         # Returns MQTT_ERR_SUCCESS if everything is fine.
-        if '+' in topic or '#' in topic or len(topic) == 0 or len(topic) > 65535:
-            return MQTT_ERR_INVAL
-        else:
-            return MQTT_ERR_SUCCESS
-
-    def _send_pingreq(self):
-        self._easy_log(MQTT_LOG_DEBUG, "Sending PINGREQ")
-        rc = self._send_simple_command(PINGREQ)
-        if rc == MQTT_ERR_SUCCESS:
-            self._ping_t = time.time()
-        return rc
-
-    def _send_pingresp(self):
-        self._easy_log(MQTT_LOG_DEBUG, "Sending PINGRESP")
-        return self._send_simple_command(PINGRESP)
-
-    def _send_puback(self, mid):
-        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBACK (Mid: "+str(mid)+")")
-        return self._send_command_with_mid(PUBACK, mid, False)
-
-    def _send_pubcomp(self, mid):
-        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBCOMP (Mid: "+str(mid)+")")
-        return self._send_command_with_mid(PUBCOMP, mid, False)
-
-    def _pack_remaining_length(self, packet, remaining_length):
-        remaining_bytes = []
-        while True:
-            byte = remaining_length % 128
-            remaining_length = remaining_length // 128
-            # If there are more digits to encode, set the top bit of this digit
-            if remaining_length > 0:
-                byte = byte | 0x80
-
-            remaining_bytes.append(byte)
-            packet.extend(struct.pack("!B", byte))
-            if remaining_length == 0:
-                # FIXME - this doesn't deal with incorrectly large payloads
-                return packet
-
-    def _pack_str16(self, packet, data):
-        if isinstance(data, bytearray) or isinstance(data, bytes):
-            packet.extend(struct.pack("!H", len(data)))
-            packet.extend(data)
-        elif isinstance(data, str):
-            udata = data.encode('utf-8')
-            pack_format = "!H" + str(len(udata)) + "s"
-            packet.extend(struct.pack(pack_format, len(udata), udata))
+    def _easy_log(self, level, fmt, *args):
+        # fmt is only formatted with args if on_log wants this level. Per
+        # packet callers test self._log_mask first, so that with logging off
+        # they don't even build the arguments.
+        if self._log_mask & level:
+            self._on_log(self, self._userdata, level, fmt % args if args else fmt)
+
+    def _log_update(self):
+        # _log_mask has a bit set for each level that is passed on, none if
+        # there is nowhere to pass it.
+        mask = 0
+        if self._on_log is not None:
+            for level in reversed(_LOG_SEVERITY):
+                mask |= level
+                if level == self._log_level:
+                    break
+        self._log_mask = mask
+
+    def _loop_timeout(self):
+        # Seconds until loop_misc() next has work to do: a PINGREQ to send, a
+        # PINGRESP that is overdue or a message to retry. None if there is
+        # nothing it will ever do without network traffic first.
+        deadline = self._next_deadline()
+        if deadline is None:
+            return None
+        return max(0, deadline - time_func())
+
+    def _reconnect_wait(self):
+        if self._reconnect_delay is None:
+            self._reconnect_delay = self._reconnect_min_delay
         else:
-            raise TypeError
+            self._reconnect_delay = min(self._reconnect_delay * 2, self._reconnect_max_delay)
+        time.sleep(self._reconnect_delay)
 
-    def _send_publish(self, mid, topic, payload=None, qos=0, retain=False, dup=False):
-        if self._sock is None and self._ssl is None:
+    def _packet_queue(self, command, packet, mid, qos, info=None, topic=None):
+        # While coalescing, if an earlier QoS 0 PUBLISH on topic is still
+        # queued, its packet takes this one's place, otherwise this one can be
+        # replaced until it is taken off the queue.
+        if self._sock is None:
             return MQTT_ERR_NO_CONN
+        if not self._coalesce:
+            topic = None
+        elif topic is not None:
+            mpkt = self._coalesce_pending.get(topic)
+            if mpkt is not None:
+                mpkt.packet = packet
+                mpkt.to_process = len(packet)
+                if isinstance(mpkt.info, list):
+                    mpkt.info.append(info)
+                else:
+                    mpkt.info = [mpkt.info, info]
+                self._coalesced += 1
+                return MQTT_ERR_SUCCESS
 
-        utopic = topic.encode('utf-8')
-        command = PUBLISH | ((dup&0x1)<<3) | (qos<<1) | retain
-        packet = bytearray()
-        packet.extend(struct.pack("!B", command))
-        if payload is None:
-            remaining_length = 2+len(utopic)
-            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d"+str(dup)+", q"+str(qos)+", r"+str(int(retain))+", m"+str(mid)+", '"+topic+"' (NULL payload)")
+        if self._out_packet_pool:
+            mpkt = self._out_packet_pool.pop()
         else:
-            if isinstance(payload, str):
-                upayload = payload.encode('utf-8')
-                payloadlen = len(upayload)
-            elif isinstance(payload, bytearray):
-                payloadlen = len(payload)
-            elif isinstance(payload, unicode):
-                upayload = payload.encode('utf-8')
-                payloadlen = len(upayload)
-
-            remaining_length = 2+len(utopic) + payloadlen
-            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d"+str(dup)+", q"+str(qos)+", r"+str(int(retain))+", m"+str(mid)+", '"+topic+"', ... ("+str(payloadlen)+" bytes)")
-
-        if qos > 0:
-            # For message id
-            remaining_length = remaining_length + 2
-
-        self._pack_remaining_length(packet, remaining_length)
-        self._pack_str16(packet, topic)
-
-        if qos > 0:
-            # For message id
-            packet.extend(struct.pack("!H", mid))
-
-        if payload is not None:
-            if isinstance(payload, str):
-                pack_format = str(payloadlen) + "s"
-                packet.extend(struct.pack(pack_format, upayload))
-            elif isinstance(payload, bytearray):
-                packet.extend(payload)
-            elif isinstance(payload, unicode):
-                pack_format = str(payloadlen) + "s"
-                packet.extend(struct.pack(pack_format, upayload))
-            else:
-                raise TypeError('payload must be a string, unicode or a bytearray.')
-
-        return self._packet_queue(PUBLISH, packet, mid, qos)
-
-    def _send_pubrec(self, mid):
-        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBREC (Mid: "+str(mid)+")")
-        return self._send_command_with_mid(PUBREC, mid, False)
-
-    def _send_pubrel(self, mid, dup=False):
-        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBREL (Mid: "+str(mid)+")")
-        return self._send_command_with_mid(PUBREL|2, mid, dup)
-
-    def _send_command_with_mid(self, command, mid, dup):
-        # For PUBACK, PUBCOMP, PUBREC, and PUBREL
-        if dup:
-            command = command | 8
-
-        remaining_length = 2
-        packet = struct.pack('!BBH', command, remaining_length, mid)
-        return self._packet_queue(command, packet, mid, 1)
-
-    def _send_simple_command(self, command):
-        # For DISCONNECT, PINGREQ and PINGRESP
-        remaining_length = 0
-        packet = struct.pack('!BB', command, remaining_length)
-        return self._packet_queue(command, packet, 0, 0)
-
-    def _send_connect(self, keepalive, clean_session):
-        print("_send_connect")
-        if self._protocol == MQTTv31:
-            protocol = PROTOCOL_NAMEv31
-            proto_ver = 3
+            mpkt = _OutPacket()
+        mpkt.set(command, packet, mid, qos, info)
+
+        # Acknowledgements and PINGREQs go in a lane of their own that is
+        # taken from first, so that they aren't held up behind a burst of
+        # PUBLISHes and the broker doesn't time us out. A packet already
+        # partly written is always finished first.
+        if command & 0xF0 in _PRIORITY_COMMANDS:
+            lane = self._out_control
+            lane.append(mpkt)
+            if len(lane) > self._out_control_max:
+                self._out_control_max = len(lane)
         else:
-            protocol = PROTOCOL_NAMEv311
-            proto_ver = 4
-        remaining_length = 2+len(protocol) + 1+1+2 + 2+len(self._client_id)
-        connect_flags = 0
-        if clean_session:
-            connect_flags = connect_flags | 0x02
-
-        if self._will:
-            if self._will_payload is not None:
-                remaining_length = remaining_length + 2+len(self._will_topic) + 2+len(self._will_payload)
-            else:
-                remaining_length = remaining_length + 2+len(self._will_topic) + 2
-
-            connect_flags = connect_flags | 0x04 | ((self._will_qos&0x03) << 3) | ((self._will_retain&0x01) << 5)
+            lane = self._out_packet
+            lane.append(mpkt)
+            if len(lane) > self._out_packet_max:
+                self._out_packet_max = len(lane)
+            if topic is not None:
+                mpkt.topic = topic
+                self._coalesce_pending[topic] = mpkt
+        if self._current_out_packet is None:
+            self._current_out_packet = self._out_next()
 
-        if self._username:
-            remaining_length = remaining_length + 2+len(self._username)
-            connect_flags = connect_flags | 0x80
-            if self._password:
-                connect_flags = connect_flags | 0x40
-                remaining_length = remaining_length + 2+len(self._password)
-
-        command = CONNECT
-        packet = bytearray()
-        packet.extend(struct.pack("!B", command))
-
-        self._pack_remaining_length(packet, remaining_length)
-        packet.extend(struct.pack("!H"+str(len(protocol))+"sBBH", len(protocol), protocol, proto_ver, connect_flags, keepalive))
-
-        self._pack_str16(packet, self._client_id)
-
-        if self._will:
-            self._pack_str16(packet, self._will_topic)
-            if self._will_payload is None or len(self._will_payload) == 0:
-                packet.extend(struct.pack("!H", 0))
-            else:
-                self._pack_str16(packet, self._will_payload)
-
-        if self._username:
-            self._pack_str16(packet, self._username)
-
-            if self._password:
-                self._pack_str16(packet, self._password)
-
-        self._keepalive = keepalive
-        return self._packet_queue(command, packet, 0, 0)
-
-    def _send_disconnect(self):
-        return self._send_simple_command(DISCONNECT)
-
-    def _send_subscribe(self, dup, topics):
-        print("_send_subscribe")
-        remaining_length = 2
-        for t in topics:
-            remaining_length = remaining_length + 2+len(t[0])+1
-
-        command = SUBSCRIBE | (dup<<3) | (1<<1)
-        packet = bytearray()
-        packet.extend(struct.pack("!B", command))
-        self._pack_remaining_length(packet, remaining_length)
-        local_mid = self._mid_generate()
-        packet.extend(struct.pack("!H", local_mid))
-        for t in topics:
-            self._pack_str16(packet, t[0])
-            packet.extend(struct.pack("B", t[1]))
-        return (self._packet_queue(command, packet, local_mid, 1), local_mid)
-
-    def _send_unsubscribe(self, dup, topics):
-        remaining_length = 2
-        for t in topics:
-            remaining_length = remaining_length + 2+len(t)
-
-        command = UNSUBSCRIBE | (dup<<3) | (1<<1)
-        packet = bytearray()
-        packet.extend(struct.pack("!B", command))
-        self._pack_remaining_length(packet, remaining_length)
-        local_mid = self._mid_generate()
-        packet.extend(struct.pack("!H", local_mid))
-        for t in topics:
-            self._pack_str16(packet, t)
-        return (self._packet_queue(command, packet, local_mid, 1), local_mid)
-
-    def _message_retry_check_actual(self, messages):
-        print("_message_retry_check_actual") #needed
-        now = time.time()
-        for m in messages:
-            if m.timestamp + self._message_retry < now:
-                if m.state == mqtt_ms_wait_for_puback or m.state == mqtt_ms_wait_for_pubrec:
-                    m.timestamp = now
-                    m.dup = True
-                    self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
-                elif m.state == mqtt_ms_wait_for_pubrel:
-                    m.timestamp = now
-                    m.dup = True
-                    self._send_pubrec(m.mid)
-                elif m.state == mqtt_ms_wait_for_pubcomp:
-                    m.timestamp = now
-                    m.dup = True
-                    self._send_pubrel(m.mid, True)
-
-    def _message_retry_check(self):
-        print("_message_retry_check") #needed
-        self._message_retry_check_actual(self._out_messages)
-        self._message_retry_check_actual(self._in_messages)
-
-    def _messages_reconnect_reset_out(self):
-        print("_messages_reconnect_reset_out") #needed
-        self._inflight_messages = 0
-        for m in self._out_messages:
-            m.timestamp = 0
-            if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
-                if m.qos == 0:
-                    m.state = mqtt_ms_publish
-                elif m.qos == 1:
-                    #self._inflight_messages = self._inflight_messages + 1
-                    if m.state == mqtt_ms_wait_for_puback:
-                        m.dup = True
-                    m.state = mqtt_ms_publish
-                elif m.qos == 2:
-                    #self._inflight_messages = self._inflight_messages + 1
-                    if m.state == mqtt_ms_wait_for_pubcomp:
-                        m.state = mqtt_ms_resend_pubrel
-                        m.dup = True
-                    else:
-                        if m.state == mqtt_ms_wait_for_pubrec:
-                            m.dup = True
-                        m.state = mqtt_ms_publish
-            else:
-                m.state = mqtt_ms_queued
-
-    def _messages_reconnect_reset_in(self):
-        print("_messages_reconnect_reset_in") #needed
-        for m in self._in_messages:
-            m.timestamp = 0
-            if m.qos != 2:
-                self._in_messages.pop(self._in_messages.index(m))
-            else:
-                # Preserve current state
-                pass
-
-    def _messages_reconnect_reset(self):
-        print("_messages_reconnect_reset") #needed
-        self._messages_reconnect_reset_out()
-        self._messages_reconnect_reset_in()
-
-    def _packet_queue(self, command, packet, mid, qos):
-        print("_packet_queue") #needed
-        mpkt = dict(
-            command = command,
-            mid = mid,
-            qos = qos,
-            pos = 0,
-            to_process = len(packet),
-            packet = packet)
-
-        self._out_packet.append(mpkt)
-        if self._current_out_packet is None and len(self._out_packet) > 0:
-            self._current_out_packet = self._out_packet.pop(0)
-
-        print("self._out_packet =", self._out_packet)
         # Write a single byte to sockpairW (connected to sockpairR) to break
         # out of select() if in threaded mode.
         #try:
@@ -1240,61 +1202,32 @@ class Client(object):
         #except socket.error as err:
         #    if err.errno != EAGAIN:
         #        raise
-        print("self._in_callback =", self._in_callback)
         if not self._in_callback: 
-            return self.loop_write()
+            return self._loop_write()
         else:
-            print(MQTT_ERR_SUCCESS)
             return MQTT_ERR_SUCCESS
 
-    def _packet_handle(self):
-        print("_packet_handle")
-        cmd = self._in_packet['command']&0xF0
-        if cmd == PINGREQ:
-            return self._handle_pingreq()
-        elif cmd == PINGRESP:
-            return self._handle_pingresp()
-        elif cmd == PUBACK:
-            return self._handle_pubackcomp("PUBACK")
-        elif cmd == PUBCOMP:
-            return self._handle_pubackcomp("PUBCOMP")
-        elif cmd == PUBLISH: #appear to need PUBLISH
-            return self._handle_publish()
-        elif cmd == PUBREC:
-            return self._handle_pubrec()
-        elif cmd == PUBREL:
-            return self._handle_pubrel()
-        elif cmd == CONNACK:
-            return self._handle_connack()
-        elif cmd == SUBACK:
-            return self._handle_suback()
-        elif cmd == UNSUBACK:
-            return self._handle_unsuback()
-        else:
-            # If we don't recognise the command, return an error straight away.
-            self._easy_log(MQTT_LOG_ERR, "Error: Unrecognised command "+str(cmd))
-            return MQTT_ERR_PROTOCOL
-
-    def _handle_connack(self):
-        print("_handle_connack") #needed
-        if self._strict_protocol:
-            if self._in_packet['remaining_length'] != 2:
-                return MQTT_ERR_PROTOCOL
-
-        if len(self._in_packet['packet']) != 2:
-            return MQTT_ERR_PROTOCOL
-
-        (flags, result) = struct.unpack("!BB", self._in_packet['packet'])
-        if result == CONNACK_REFUSED_PROTOCOL_VERSION and self._protocol == MQTTv311:
-            self._easy_log(MQTT_LOG_DEBUG, "Received CONNACK ("+str(flags)+", "+str(result)+"), attempting downgrade to MQTT v3.1.")
-            # Downgrade to MQTT v3.1
-            self._protocol = MQTTv31
-            return self.reconnect()
+    def _out_next(self):
+        if self._out_control:
+            return self._out_control.pop(0)
+        if self._out_packet:
+            packet = self._out_packet.pop(0)
+            if packet.topic is not None:
+                # About to be written, it can't be replaced any more.
+                del self._coalesce_pending[packet.topic]
+                packet.topic = None
+            return packet
+        return None
+
+    def _time(self):
+        return time_func()
+
+    def _connect_retry(self):
+        return self.reconnect()
 
+    def _on_connack(self, flags, result):
         if result == 0:
-            self._state = mqtt_cs_connected
-
-        self._easy_log(MQTT_LOG_DEBUG, "Received CONNACK ("+str(flags)+", "+str(result)+")")
+            self._reconnect_delay = None
         if self.on_connect:
             self._in_callback = True
 
@@ -1302,240 +1235,58 @@ class Client(object):
             flags_dict['session present'] = flags & 0x01
             self.on_connect(self, self._userdata, flags_dict, result)
             self._in_callback = False
-        if result == 0:
-            rc = 0
-            for m in self._out_messages:
-                m.timestamp = time.time()
-                if m.state == mqtt_ms_queued:
-                    self.loop_write() # Process outgoing messages that have just been queued up
-                    return MQTT_ERR_SUCCESS
-
-                if m.qos == 0:
-                    self._in_callback = True # Don't call loop_write after _send_publish()
-                    rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
-                    self._in_callback = False
-                    if rc != 0:
-                        return rc
-                elif m.qos == 1:
-                    if m.state == mqtt_ms_publish:
-                        self._inflight_messages = self._inflight_messages + 1
-                        m.state = mqtt_ms_wait_for_puback
-                        self._in_callback = True # Don't call loop_write after _send_publish()
-                        rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
-                        self._in_callback = False
-                        if rc != 0:
-                            return rc
-                elif m.qos == 2:
-                    if m.state == mqtt_ms_publish:
-                        self._inflight_messages = self._inflight_messages + 1
-                        m.state = mqtt_ms_wait_for_pubrec
-                        self._in_callback = True # Don't call loop_write after _send_publish()
-                        rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
-                        self._in_callback = False
-                        if rc != 0:
-                            return rc
-                    elif m.state == mqtt_ms_resend_pubrel:
-                        self._inflight_messages = self._inflight_messages + 1
-                        m.state = mqtt_ms_wait_for_pubcomp
-                        self._in_callback = True # Don't call loop_write after _send_pubrel()
-                        rc = self._send_pubrel(m.mid, m.dup)
-                        self._in_callback = False
-                        if rc != 0:
-                            return rc
-                self.loop_write() # Process outgoing messages that have just been queued up
-            return rc
-        elif result > 0 and result < 6:
-            return MQTT_ERR_CONN_REFUSED
-        else:
-            return MQTT_ERR_PROTOCOL
-
-    def _handle_suback(self):
-        print("_handle_suback") #needed after _packet_handle
-        self._easy_log(MQTT_LOG_DEBUG, "Received SUBACK")
-        pack_format = "!H" + str(len(self._in_packet['packet'])-2) + 's'
-        (mid, packet) = struct.unpack(pack_format, self._in_packet['packet'])
-        pack_format = "!" + "B"*len(packet)
-        granted_qos = struct.unpack(pack_format, packet)
 
+    def _on_suback(self, mid, granted_qos):
         if self.on_subscribe:
             self._in_callback = True
             self.on_subscribe(self, self._userdata, mid, granted_qos)
             self._in_callback = False
 
-        return MQTT_ERR_SUCCESS
-
-    def _handle_publish(self):
-        rc = 0
-        print("_handle_publish") #needed after packet_handle
-        header = self._in_packet['command']
-        message = MQTTMessage()
-        message.dup = (header & 0x08)>>3
-        message.qos = (header & 0x06)>>1
-        message.retain = (header & 0x01)
-
-        pack_format = "!H" + str(len(self._in_packet['packet'])-2) + 's'
-        (slen, packet) = struct.unpack(pack_format, self._in_packet['packet'])
-        pack_format = '!' + str(slen) + 's' + str(len(packet)-slen) + 's'
-        (message.topic, packet) = struct.unpack(pack_format, packet)
-
-        if len(message.topic) == 0:
-            return MQTT_ERR_PROTOCOL
-
-        if sys.version_info[0] >= 3:
-            message.topic = message.topic.decode('utf-8')
-
-        if message.qos > 0:
-            pack_format = "!H" + str(len(packet)-2) + 's'
-            (message.mid, packet) = struct.unpack(pack_format, packet)
-
-        message.payload = packet
-
-        self._easy_log(
-            MQTT_LOG_DEBUG,
-            "Received PUBLISH (d"+str(message.dup)+
-            ", q"+str(message.qos)+", r"+str(message.retain)+
-            ", m"+str(message.mid)+", '"+message.topic+
-            "', ...  ("+str(len(message.payload))+" bytes)")
-
-        message.timestamp = time.time()
-        if message.qos == 0:
-            self._handle_on_message(message)
-            return MQTT_ERR_SUCCESS
-        elif message.qos == 1:
-            rc = self._send_puback(message.mid)
-            self._handle_on_message(message)
-            return rc
-        elif message.qos == 2:
-            rc = self._send_pubrec(message.mid)
-            message.state = mqtt_ms_wait_for_pubrel
-            self._in_message_mutex.acquire()
-            self._in_messages.append(message)
-            self._in_message_mutex.release()
-            return rc
-        else:
-            return MQTT_ERR_PROTOCOL
-
-    def _handle_pubrel(self):
-        if self._strict_protocol:
-            if self._in_packet['remaining_length'] != 2:
-                return MQTT_ERR_PROTOCOL
-
-        if len(self._in_packet['packet']) != 2:
-            return MQTT_ERR_PROTOCOL
-
-        mid = struct.unpack("!H", self._in_packet['packet'])
-        mid = mid[0]
-        self._easy_log(MQTT_LOG_DEBUG, "Received PUBREL (Mid: "+str(mid)+")")
-
-        self._in_message_mutex.acquire()
-        for i in range(len(self._in_messages)):
-            if self._in_messages[i].mid == mid:
-
-                # Only pass the message on if we have removed it from the queue - this
-                # prevents multiple callbacks for the same message.
-                self._handle_on_message(self._in_messages[i])
-                self._in_messages.pop(i)
-                self._inflight_messages = self._inflight_messages - 1
-                if self._max_inflight_messages > 0:
-                    rc = self._update_inflight()
-                    if rc != MQTT_ERR_SUCCESS:
-                        return rc
-
-                self._in_message_mutex.release()
-                return self._send_pubcomp(mid)
-
-        return MQTT_ERR_SUCCESS
-
-    def _update_inflight(self):
-        # Dont lock message_mutex here
-        for m in self._out_messages:
-            if self._inflight_messages < self._max_inflight_messages:
-                if m.qos > 0 and m.state == mqtt_ms_queued:
-                    self._inflight_messages = self._inflight_messages + 1
-                    if m.qos == 1:
-                        m.state = mqtt_ms_wait_for_puback
-                    elif m.qos == 2:
-                        m.state = mqtt_ms_wait_for_pubrec
-                    rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
-                    if rc != 0:
-                        return rc
-            else:
-                return MQTT_ERR_SUCCESS
-        return MQTT_ERR_SUCCESS
-
-    def _handle_pubrec(self):
-        if self._strict_protocol:
-            if self._in_packet['remaining_length'] != 2:
-                return MQTT_ERR_PROTOCOL
-
-        mid = struct.unpack("!H", self._in_packet['packet'])
-        mid = mid[0]
-        self._easy_log(MQTT_LOG_DEBUG, "Received PUBREC (Mid: "+str(mid)+")")
-
-        for m in self._out_messages:
-            if m.mid == mid:
-                m.state = mqtt_ms_wait_for_pubcomp
-                m.timestamp = time.time()
-                return self._send_pubrel(mid, False)
-
-        return MQTT_ERR_SUCCESS
-
-    def _handle_unsuback(self):
-        if self._strict_protocol:
-            if self._in_packet['remaining_length'] != 2:
-                return MQTT_ERR_PROTOCOL
-
-        mid = struct.unpack("!H", self._in_packet['packet'])
-        mid = mid[0]
-        self._easy_log(MQTT_LOG_DEBUG, "Received UNSUBACK (Mid: "+str(mid)+")")
+    def _on_unsuback(self, mid):
         if self.on_unsubscribe:
             self._in_callback = True
             self.on_unsubscribe(self, self._userdata, mid)
             self._in_callback = False
-        return MQTT_ERR_SUCCESS
 
-    def _handle_pubackcomp(self, cmd):
-        if self._strict_protocol:
-            if self._in_packet['remaining_length'] != 2:
-                return MQTT_ERR_PROTOCOL
-
-        mid = struct.unpack("!H", self._in_packet['packet'])
-        mid = mid[0]
-        self._easy_log(MQTT_LOG_DEBUG, "Received "+cmd+" (Mid: "+str(mid)+")")
-
-        for i in range(len(self._out_messages)):
-            try:
-                if self._out_messages[i].mid == mid:
-                    # Only inform the client the message has been sent once.
-                    if self.on_publish:
-                        self._in_callback = True
-                        self.on_publish(self, self._userdata, mid)
-                        self._in_callback = False
-
-                    self._out_messages.pop(i)
-                    self._inflight_messages = self._inflight_messages - 1
-                    if self._max_inflight_messages > 0:
-                        rc = self._update_inflight()
-                        if rc != MQTT_ERR_SUCCESS:
-                            return rc
-                    return MQTT_ERR_SUCCESS
-            except IndexError:
-                # Have removed item so i>count.
-                # Not really an error.
-                pass
-
-        return MQTT_ERR_SUCCESS
-
-    def _handle_on_message(self, message):
-        matched = False
-        for t in self.on_message_filtered:
-            if topic_matches_sub(t[0], message.topic):
-                self._in_callback = True
-                t[1](self, self._userdata, message)
-                self._in_callback = False
-                matched = True
+    def _publish_complete(self, info):
+        info._published = True
+        if self.on_publish:
+            self._in_callback = True
+            self.on_publish(self, self._userdata, info.mid)
+            self._in_callback = False
 
-        if matched == False and self.on_message:
+    def _topic_resolve(self, topic):
+        # Return (decoded topic, matching filtered callbacks) for the raw
+        # topic of an incoming PUBLISH, from the cache if possible.
+        key = bytes(topic)
+        cache = self._topic_cache
+        entry = cache.pop(key, None)
+        if entry is not None:
+            # Put it back as the most recently used.
+            cache[key] = entry
+            self._topic_cache_hits += 1
+            return entry
+
+        self._topic_cache_misses += 1
+        topic = key.decode('utf-8')
+        entry = (topic, self._on_message_filtered.match(topic))
+        if self._topic_cache_size > 0:
+            if len(cache) >= self._topic_cache_size:
+                del cache[next(iter(cache))]
+            cache[key] = entry
+        return entry
+
+    def _handle_on_message(self, message, callbacks=None):
+        # callbacks is the result of matching message.topic, if the caller
+        # already has it.
+        if callbacks is None:
+            callbacks = self._on_message_filtered.match(message.topic)
+        if callbacks:
+            self._in_callback = True
+            for callback in callbacks:
+                callback(self, self._userdata, message)
+            self._in_callback = False
+        elif self.on_message:
             self._in_callback = True
             self.on_message(self, self._userdata, message)
             self._in_callback = False
@@ -16,50 +16,57 @@
 This is an MQTT v3.1 client module. MQTT is a lightweight pub/sub messaging
 protocol that is easy to implement and suitable for low powered devices.
 """
+import collections
 import errno
+import heapq
+import itertools
+import logging
+import os
 import platform
 import random
 import select
+import selectors
 import socket
-import struct
 import sys
+import threading
 import time
+
+from umqtt_codec import split_frames, topic_matches_sub
+from umqtt_core import (MQTTv31, MQTTv311, PROTOCOL_NAMEv31, PROTOCOL_NAMEv311, CONNECT,
+                        CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP, SUBSCRIBE, SUBACK,
+                        UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT, MQTT_LOG_INFO,
+                        MQTT_LOG_NOTICE, MQTT_LOG_WARNING, MQTT_LOG_ERR, MQTT_LOG_DEBUG,
+                        mqtt_cs_new, mqtt_cs_connected, mqtt_cs_disconnecting,
+                        mqtt_cs_connect_async, mqtt_ms_invalid, mqtt_ms_publish,
+                        mqtt_ms_wait_for_puback, mqtt_ms_wait_for_pubrec, mqtt_ms_resend_pubrel,
+                        mqtt_ms_wait_for_pubrel, mqtt_ms_resend_pubcomp, mqtt_ms_wait_for_pubcomp,
+                        mqtt_ms_send_pubrec, mqtt_ms_queued, Message, MQTTMessageInfo,
+                        MQTTSession)
+from umqtt_store import SpillQueue, read_messages, write_messages
+
+# All timestamps are taken from a clock that doesn't jump when the wall clock
+# is set.
+time_func = getattr(time, 'monotonic', time.time)
+
 #FIXME
 if platform.system() == 'Windows':
     EAGAIN = errno.WSAEWOULDBLOCK
 else:
     EAGAIN = errno.EAGAIN
 
-MQTTv31 = 3
-MQTTv311 = 4
-
-PROTOCOL_NAMEv31 = b"MQIsdp"
-PROTOCOL_NAMEv311 = b"MQTT"
-
 PROTOCOL_VERSION = 3
 
-# Message types
-CONNECT = 0x10
-CONNACK = 0x20
-PUBLISH = 0x30
-PUBACK = 0x40
-PUBREC = 0x50
-PUBREL = 0x60
-PUBCOMP = 0x70
-SUBSCRIBE = 0x80
-SUBACK = 0x90
-UNSUBSCRIBE = 0xA0
-UNSUBACK = 0xB0
-PINGREQ = 0xC0
-PINGRESP = 0xD0
-DISCONNECT = 0xE0
-
-# Log levels
-MQTT_LOG_INFO = 0x01
-MQTT_LOG_NOTICE = 0x02
-MQTT_LOG_WARNING = 0x04
-MQTT_LOG_ERR = 0x08
-MQTT_LOG_DEBUG = 0x10
+# The log levels from least to most severe. Client.log_level_set() enables a
+# level and all those after it.
+_LOG_SEVERITY = (MQTT_LOG_DEBUG, MQTT_LOG_INFO, MQTT_LOG_NOTICE, MQTT_LOG_WARNING, MQTT_LOG_ERR)
+
+# The logging module level used for each of the above by enable_logger().
+LOGGING_LEVEL = {
+    MQTT_LOG_DEBUG: logging.DEBUG,
+    MQTT_LOG_INFO: logging.INFO,
+    MQTT_LOG_NOTICE: logging.INFO,
+    MQTT_LOG_WARNING: logging.WARNING,
+    MQTT_LOG_ERR: logging.ERROR}
 
 # CONNACK codes
 CONNACK_ACCEPTED = 0
@@ -69,23 +76,10 @@ CONNACK_REFUSED_SERVER_UNAVAILABLE = 3
 CONNACK_REFUSED_BAD_USERNAME_PASSWORD = 4
 CONNACK_REFUSED_NOT_AUTHORIZED = 5
 
-# Connection state
-mqtt_cs_new = 0
-mqtt_cs_connected = 1
-mqtt_cs_disconnecting = 2
-mqtt_cs_connect_async = 3
-
-# Message state
-mqtt_ms_invalid = 0
-mqtt_ms_publish= 1
-mqtt_ms_wait_for_puback = 2
-mqtt_ms_wait_for_pubrec = 3
-mqtt_ms_resend_pubrel = 4
-mqtt_ms_wait_for_pubrel = 5
-mqtt_ms_resend_pubcomp = 6
-mqtt_ms_wait_for_pubcomp = 7
-mqtt_ms_send_pubrec = 8
-mqtt_ms_queued = 9
+# Packets that go out ahead of queued PUBLISHes, see _packet_queue(). Only
+# keepalive and acknowledgements: SUBSCRIBE, UNSUBSCRIBE and DISCONNECT stay
+# in order with the PUBLISHes around them.
+_PRIORITY_COMMANDS = frozenset((CONNECT, PUBACK, PUBREC, PUBREL, PUBCOMP, PINGREQ, PINGRESP))
 
 # Error values
 MQTT_ERR_AGAIN = -1
@@ -104,9 +98,51 @@ MQTT_ERR_AUTH = 11
 MQTT_ERR_ACL_DENIED = 12
 MQTT_ERR_UNKNOWN = 13
 MQTT_ERR_ERRNO = 14
+MQTT_ERR_QUEUE_SIZE = 15
+
+# What to do with a message published when the offline queue is full, see
+# Client.offline_queue_set().
+OFFLINE_DROP_OLDEST = 0
+OFFLINE_BLOCK = 1
 
 sockpair_data = b"0"
 
+# Size of the receive buffer. A packet that does not fit is received into a
+# buffer of its own.
+READ_CHUNK_SIZE = 65536
+
+# Number of spent _OutPacket objects kept for reuse.
+OUT_PACKET_POOL_SIZE = 32
+
+# Default number of incoming topics whose decoded string and matching
+# callbacks are cached, see Client.topic_cache_set().
+TOPIC_CACHE_SIZE = 256
+
+# Seconds a host name's addresses are kept before it is looked up again.
+ADDRESS_CACHE_TTL = 60.0
+
+# Most addresses of a host connected to at once, and seconds to wait for one
+# of them to answer.
+CONNECT_ATTEMPTS = 4
+CONNECT_TIMEOUT = 10.0
+
+# Number of recent PUBLISH round trip times kept for Client.inflight_stats().
+INFLIGHT_RTT_SAMPLES = 256
+
+# Offline queue messages are only moved to the outgoing queue while it holds
+# fewer PUBLISH packets than this, i.e. while the socket keeps up.
+OFFLINE_DRAIN_BACKLOG = 64
+
+# Most buffers handed to one sendmsg() call, IOV_MAX on Linux.
+SENDMSG_MAX_BUFFERS = 1024
+_HAVE_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+try:
+    _intern = sys.intern
+except AttributeError:
+    # Python 2
+    _intern = intern
+
 def error_string(mqtt_errno):
     """Return the error string associated with an mqtt error number."""
     if mqtt_errno == MQTT_ERR_SUCCESS:
@@ -139,6 +175,8 @@ def error_string(mqtt_errno):
         return "Unknown error."
     elif mqtt_errno == MQTT_ERR_ERRNO:
         return "Error defined by errno."
+    elif mqtt_errno == MQTT_ERR_QUEUE_SIZE:
+        return "Message queue full."
     else:
         return "Unknown error."
 
@@ -161,69 +199,26 @@ def connack_string(connack_code):
         return "Connection Refused: unknown reason."
 
 
-def topic_matches_sub(sub, topic):
-    """Check whether a topic matches a subscription.
-
-    For example:
-
-    foo/bar would match the subscription foo/# or +/bar
-    non/matching would not match the subscription non/+/+
-    """
-    result = True
-    multilevel_wildcard = False
-
-    slen = len(sub)
-    tlen = len(topic)
-
-    if slen > 0 and tlen > 0:
-        if (sub[0] == '$' and topic[0] != '$') or (topic[0] == '$' and sub[0] != '$'):
-            return False
-
-    spos = 0
-    tpos = 0
-
-    while spos < slen and tpos < tlen:
-        if sub[spos] == topic[tpos]:
-            if tpos == tlen-1:
-                # Check for e.g. foo matching foo/#
-                if spos == slen-3 and sub[spos+1] == '/' and sub[spos+2] == '#':
-                    result = True
-                    multilevel_wildcard = True
-                    break
-
-            spos += 1
-            tpos += 1
-
-            if tpos == tlen and spos == slen-1 and sub[spos] == '+':
-                spos += 1
-                result = True
-                break
-        else:
-            if sub[spos] == '+':
-                spos += 1
-                while tpos < tlen and topic[tpos] != '/':
-                    tpos += 1
-                if tpos == tlen and spos == slen:
-                    result = True
-                    break
-
-            elif sub[spos] == '#':
-                multilevel_wildcard = True
-                if spos+1 != slen:
-                    result = False
-                    break
-                else:
-                    result = True
-                    break
-
-            else:
-                result = False
-                break
-
-    if not multilevel_wildcard and (tpos < tlen or spos < slen):
-        result = False
+def _encode_payload(payload):
+    """Convert a publish() payload to bytes, or None for a zero length
+    message. Raises TypeError/ValueError for payloads that can't be sent."""
+    if isinstance(payload, (bytes, bytearray)):
+        local_payload = payload
+    elif isinstance(payload, memoryview):
+        # Most likely a received payload, which won't outlive the callback.
+        local_payload = bytes(payload)
+    elif isinstance(payload, str) or (sys.version_info[0] < 3 and isinstance(payload, unicode)):
+        local_payload = payload.encode('utf-8')
+    elif isinstance(payload, int) or isinstance(payload, float):
+        local_payload = str(payload).encode('ascii')
+    elif payload is None:
+        local_payload = None
+    else:
+        raise TypeError('payload must be a string, bytes, bytearray, int, float or None.')
 
-    return result
+    if local_payload is not None and len(local_payload) > 268435455:
+        raise ValueError('Payload too large.')
+    return local_payload
 
 
 def _socketpair_compat():
@@ -247,29 +242,386 @@ def _socketpair_compat():
     return (sock1, sock2)
 
 
-class MQTTMessage:
+class _Wakeup(object):
+    """Breaks a thread out of select() on fileno().
+
+    Uses an eventfd on Linux and a pipe on other POSIX systems. Windows
+    select() only takes sockets, so there it falls back to a TCP socketpair.
+    Only the first set() after a clear() writes anything, so a burst of
+    packets queued from other threads costs one wakeup, not one each. The
+    waiting thread must clear() before it looks at what was queued."""
+    __slots__ = ('_r', '_w', '_pending', 'writes')
+
+    def __init__(self):
+        self._pending = False
+        self.writes = 0
+        if platform.system() == 'Windows':
+            self._r, self._w = _socketpair_compat()
+        elif hasattr(os, 'eventfd'):
+            self._r = self._w = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self._r, self._w = os.pipe()
+            if hasattr(os, 'set_blocking'):
+                os.set_blocking(self._r, False)
+                os.set_blocking(self._w, False)
+            else:
+                import fcntl
+                for fd in (self._r, self._w):
+                    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def fileno(self):
+        if isinstance(self._r, int):
+            return self._r
+        return self._r.fileno()
+
+    def set(self):
+        if self._pending:
+            return
+        self._pending = True
+        self.writes += 1
+        try:
+            if not isinstance(self._w, int):
+                self._w.send(sockpair_data)
+            elif self._w == self._r:
+                os.eventfd_write(self._w, 1)
+            else:
+                os.write(self._w, sockpair_data)
+        except (OSError, socket.error) as err:
+            # Full, so the reader is going to wake anyway.
+            if err.errno != errno.EAGAIN and err.errno != EAGAIN:
+                raise
+
+    def clear(self):
+        try:
+            if isinstance(self._r, int):
+                os.read(self._r, 4096)
+            else:
+                self._r.recv(4096)
+        except (OSError, socket.error) as err:
+            if err.errno != errno.EAGAIN and err.errno != EAGAIN:
+                raise
+        # Only after draining, or a set() in between would have its write
+        # swallowed and leave _pending stuck with nothing to wake the reader.
+        self._pending = False
+
+    def close(self):
+        if isinstance(self._r, int):
+            os.close(self._r)
+            if self._w != self._r:
+                os.close(self._w)
+        else:
+            self._r.close()
+            self._w.close()
+
+
+class _AddressCache(object):
+    """getaddrinfo() results by (host, port), kept for ttl seconds.
+
+    Only one lookup of a name is ever in progress. Anyone wanting it while
+    it is under way waits for that lookup rather than starting another, so
+    a thousand clients reconnecting to the same broker at once cost one
+    getaddrinfo() call, not a thousand."""
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get(self, host, port):
+        """Return the cached addresses of host, or None."""
+        entry = self._entries.get((host, port))
+        if entry is not None and entry[0] > time_func():
+            return entry[1]
+        return None
+
+    def put(self, host, port, addresses):
+        with self._lock:
+            self._entries[(host, port)] = (time_func() + self.ttl, addresses)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def resolve(self, host, port):
+        """Return the addresses of host, looking them up in this thread if
+        they are not cached. Raises socket.error if the lookup fails."""
+        addresses = self.get(host, port)
+        if addresses is not None:
+            return addresses
+        done = threading.Event()
+        result = []
+
+        def callback(key, addresses, error):
+            result.append((addresses, error))
+            done.set()
+        if self._wait((host, port), callback):
+            self._lookup((host, port))
+        done.wait()
+        (addresses, error) = result[0]
+        if error is not None:
+            raise error
+        return addresses
+
+    def resolve_async(self, host, port, callback):
+        """Look up host on a thread of its own and call
+        callback((host, port), addresses, error) from it when done. addresses
+        is None if the lookup failed."""
+        if self._wait((host, port), callback):
+            thread = threading.Thread(target=self._lookup, args=((host, port),))
+            thread.daemon = True
+            thread.start()
+
+    def _wait(self, key, callback):
+        # Add callback to those waiting for key. True if no lookup of key is
+        # under way, in which case the caller must start one.
+        with self._lock:
+            waiters = self._pending.get(key)
+            if waiters is not None:
+                waiters.append(callback)
+                return False
+            self._pending[key] = [callback]
+            return True
+
+    def _lookup(self, key):
+        addresses = None
+        error = None
+        try:
+            addresses = socket.getaddrinfo(key[0], key[1], 0, socket.SOCK_STREAM)
+            if not addresses:
+                error = socket.error("getaddrinfo returned no addresses for %s" % key[0])
+        except socket.error as err:
+            error = err
+        with self._lock:
+            if error is None:
+                self._entries[key] = (time_func() + self.ttl, addresses)
+            waiters = self._pending.pop(key)
+        for callback in waiters:
+            callback(key, addresses, error)
+
+
+# Shared by every client, so a name is looked up once however many clients
+# connect to it.
+_address_cache = _AddressCache(ADDRESS_CACHE_TTL)
+
+
+class MQTTMessage(Message):
     """ This is a class that describes an incoming message. It is passed to the
     on_message callback as the message parameter.
 
     Members:
 
     topic : String. topic that the message was published on.
-    payload : String/bytes the message payload.
+    payload : memoryview of the message payload, only valid inside on_message
+              unless detach() is called.
     qos : Integer. The message Quality of Service 0, 1 or 2.
     retain : Boolean. If true, the message is a retained message and not fresh.
     mid : Integer. The message id.
     """
+    __slots__ = ()
+
+
+def _last_value_message(entry):
+    # An MQTTMessage for a last value cache entry, see
+    # Client._last_value_put().
+    m = MQTTMessage()
+    (m.topic, m.payload, m.qos, m.retain, m.mid, m.timestamp) = entry
+    return m
+
+
+class _OutPacket(object):
+    """A packet waiting in the outgoing queue and how much of it has been
+    written so far. Instances are recycled through Client._out_packet_pool."""
+    __slots__ = ('command', 'mid', 'qos', 'pos', 'to_process', 'packet', 'info', 'topic')
+
+    def set(self, command, packet, mid, qos, info=None):
+        # info is the MQTTMessageInfo of a QoS 0 PUBLISH, to be marked
+        # published once written, or a list of them for a publish_many() batch
+        # or a coalesced PUBLISH. topic is set while a coalesced PUBLISH can
+        # still be replaced.
+        self.command = command
+        self.mid = mid
+        self.qos = qos
+        self.info = info
+        self.topic = None
+        self.pos = 0
+        self.to_process = len(packet)
+        self.packet = packet
+
+
+class MQTTMatcher(object):
+    """Values stored against topic filters, such as the callbacks given to
+    Client.message_callback_add().
+
+    The filters are kept in a trie with one level of the filter per node, and
+    '+' and '#' as ordinary child names. match() finds every filter that
+    matches a topic in a single walk of the trie, so its cost depends on the
+    depth of the topic rather than the number of filters.
+
+    matcher[sub] = value, matcher[sub] and del matcher[sub] add, look up and
+    remove the value for an exact filter string.
+    """
+    class Node(object):
+        # plus and hash are the '+' and '#' children, also in children, kept
+        # to hand so that match() doesn't have to look them up at every node.
+        __slots__ = ('children', 'value', 'seq', 'plus', 'hash')
+
+        def __init__(self):
+            self.children = {}
+            self.value = None
+            self.seq = 0
+            self.plus = None
+            self.hash = None
+
     def __init__(self):
-        self.timestamp = 0
-        self.state = mqtt_ms_invalid
-        self.dup = False
-        self.mid = 0
-        self.topic = ""
-        self.payload = None
-        self.qos = 0
-        self.retain = False
-
-class Client(object):
+        self._root = MQTTMatcher.Node()
+        self._seq = 0
+
+    def __setitem__(self, sub, value):
+        node = self._root
+        for level in sub.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = MQTTMatcher.Node()
+                if level == '+':
+                    node.plus = child
+                elif level == '#':
+                    node.hash = child
+            node = child
+        if node.value is None:
+            # Replacing a value keeps the filter's place in the match order.
+            self._seq += 1
+            node.seq = self._seq
+        node.value = value
+
+    def __getitem__(self, sub):
+        node = self._root
+        for level in sub.split('/'):
+            node = node.children.get(level)
+            if node is None:
+                raise KeyError(sub)
+        if node.value is None:
+            raise KeyError(sub)
+        return node.value
+
+    def __delitem__(self, sub):
+        path = []
+        node = self._root
+        for level in sub.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                raise KeyError(sub)
+            path.append((node, level))
+            node = child
+        if node.value is None:
+            raise KeyError(sub)
+        node.value = None
+        # Prune the branch back to the last node still in use.
+        while path and not node.children and node.value is None:
+            node, level = path.pop()
+            del node.children[level]
+            if level == '+':
+                node.plus = None
+            elif level == '#':
+                node.hash = None
+
+    def match(self, topic):
+        """Return the values of all filters matching topic, in the order the
+        filters were added."""
+        levels = topic.split('/')
+        found = []
+        # Wildcards don't match the first level of a topic starting with $,
+        # see topic_matches_sub().
+        self._match(self._root, levels, 0, len(levels), topic[:1] != '$', found)
+        n = len(found)
+        if n == 0:
+            return found
+        if n == 1:
+            return [found[0].value]
+        if n == 2:
+            (a, b) = found
+            if a.seq < b.seq:
+                return [a.value, b.value]
+            return [b.value, a.value]
+        found.sort(key=lambda node: node.seq)
+        return [node.value for node in found]
+
+    def _match(self, node, levels, i, n, wild, found):
+        # Add the nodes below node of the filters matching levels[i:] to
+        # found. The exact level names are followed in a loop and only a '+'
+        # child costs a call, so the walk is a few attribute loads and one
+        # dict lookup per level for each '+' it branches at.
+        while True:
+            if wild:
+                # foo/# matches foo/bar as well as foo.
+                child = node.hash
+                if child is not None and child.value is not None:
+                    found.append(child)
+                child = node.plus
+                if child is not None and i < n:
+                    self._match(child, levels, i+1, n, True, found)
+            if i == n:
+                if node.value is not None:
+                    found.append(node)
+                return
+            node = node.children.get(levels[i])
+            if node is None:
+                return
+            i += 1
+            wild = True
+
+    def match_filter(self, sub):
+        """Return the values stored against topics that the filter sub
+        matches. The reverse of match(): the keys are topics, and sub may
+        contain wildcards. In no particular order."""
+        levels = sub.split('/')
+        nlevels = len(levels)
+        found = []
+        stack = [(self._root, 0)]
+        while stack:
+            node, i = stack.pop()
+            if i == nlevels:
+                if node.value is not None:
+                    found.append(node.value)
+                continue
+            level = levels[i]
+            if level == '#':
+                # foo/# matches foo as well as everything below it.
+                if i > 0 and node.value is not None:
+                    found.append(node.value)
+                below = [child for (name, child) in node.children.items()
+                         if i > 0 or name[:1] != '$']
+                while below:
+                    node = below.pop()
+                    if node.value is not None:
+                        found.append(node.value)
+                    below.extend(node.children.values())
+            elif level == '+':
+                for (name, child) in node.children.items():
+                    # Wildcards don't match the first level of a topic
+                    # starting with $.
+                    if i > 0 or name[:1] != '$':
+                        stack.append((child, i+1))
+            else:
+                child = node.children.get(level)
+                if child is not None:
+                    stack.append((child, i+1))
+        return found
+
+    def items(self):
+        """Return a list of (sub, value) for every filter stored, in no
+        particular order."""
+        found = []
+        stack = [(self._root, None)]
+        while stack:
+            node, sub = stack.pop()
+            if node.value is not None:
+                found.append((sub, node.value))
+            for (name, child) in node.children.items():
+                stack.append((child, name if sub is None else sub + '/' + name))
+        return found
+
+
+class Client(MQTTSession):
     """MQTT version 3.1/3.1.1 client class.
 
     This is the main class for use communicating with an MQTT broker.
@@ -357,8 +709,15 @@ class Client(object):
       to allow debugging. The level variable gives the severity of the message
       and will be one of MQTT_LOG_INFO, MQTT_LOG_NOTICE, MQTT_LOG_WARNING,
       MQTT_LOG_ERR, and MQTT_LOG_DEBUG. The message itself is in buf.
+      Use log_level_set() to choose which levels are passed on, or
+      enable_logger() to use the logging module instead.
 
+    The protocol itself, packet handling, acknowledgements, retries and
+    keepalive, is umqtt_core.MQTTSession's. Client is the transport around
+    it: the socket, the outgoing queue, the threads and the callbacks.
     """
+    _message_class = MQTTMessage
+
     def __init__(self, client_id="", clean_session=True, userdata=None, protocol=MQTTv31):
         """client_id is the unique client id string used when connecting to the
         broker. If client_id is zero length or None, then one will be randomly
@@ -388,74 +747,126 @@ class Client(object):
         if not clean_session and (client_id == "" or client_id is None):
             raise ValueError('A client id must be provided if clean session is False.')
 
-        self._protocol = protocol
+        if client_id == "" or client_id is None:
+            client_id = "paho/" + "".join(random.choice("0123456789ADCDEF") for x in range(23-5))
+        MQTTSession.__init__(self, client_id, clean_session, protocol)
         self._userdata = userdata
         self._sock = None
-        self._sockpairR, self._sockpairW = _socketpair_compat()
-        print("self._sockpairR = ", self._sockpairR)
-        self._keepalive = 60
-        self._message_retry = 20
-        self._last_retry_check = 0
-        self._clean_session = clean_session
-        if client_id == "" or client_id is None:
-            self._client_id = "paho/" + "".join(random.choice("0123456789ADCDEF") for x in range(23-5))
-        else:
-            self._client_id = client_id
-
-        self._username = ""
-        self._password = ""
-        self._in_packet = {
-            "command": 0,
-            "have_remaining": 0,
-            "remaining_count": [],
-            "remaining_mult": 1,
-            "remaining_length": 0,
-            "packet": b"",
-            "to_process": 0,
-            "pos": 0}
-        self._out_packet = []
-        self._current_out_packet = None
-        self._last_msg_in = time.time()
-        self._last_msg_out = time.time()
-        self._ping_t = 0
-        self._last_mid = 0
-        self._state = mqtt_cs_new
-        self._out_messages = []
-        self._in_messages = []
-        self._max_inflight_messages = 20
-        self._inflight_messages = 0
-        self._will = False
-        self._will_topic = ""
-        self._will_payload = None
-        self._will_qos = 0
-        self._will_retain = False
+        self._ssl = None
+        # Sockets of connect attempts under way, see _connect_begin().
+        self._connecting = []
+        self._connect_deadline = 0
+        # A standalone client's address lookup, see reconnect(): whether one
+        # is under way, its (addresses, error) once it is done, and the
+        # error of the last connect that failed.
+        self._resolving = False
+        self._resolved = None
+        self._connect_error = None
+        # Created by loop_start(), or by reconnect() for loop() to wait on
+        # the address lookup. Only the network thread needs waking.
+        self._wakeup = None
+        # The ClientGroup driving this client, if any, and the selector
+        # registration and timer it holds for it. See ClientGroup.
+        self._group = None
+        self._group_fd = -1
+        self._group_write = False
+        self._group_deadline = None
+        # The clock, read once per pass through the loop.
+        self._now = time_func()
+        self._in_buf = bytearray(READ_CHUNK_SIZE)
+        self._in_view = memoryview(self._in_buf)
+        self._in_start = 0
+        self._in_end = 0
+        self._in_command = 0
+        self._in_body = None
+        self._in_body_pos = 0
+        # Outgoing packets in two lanes: _out_control for _PRIORITY_COMMANDS,
+        # which is always written first, and _out_packet for everything else.
+        self._out_control = collections.deque()
+        self._out_packet = collections.deque()
+        self._out_control_max = 0
+        self._out_packet_max = 0
+        # Unwritten QoS 0 PUBLISH packets by topic, see coalesce_set().
+        self._coalesce = False
+        self._coalesce_pending = {}
+        self._coalesced = 0
+        self._out_packet_pool = []
+        self._write_deferred = False
+        self._write_calls = 0
+        self._write_bytes = 0
+        self._write_packets = 0
+        self._last_write = (0, 0)
+        self._last_msg_in = self._now
+        self._last_msg_out = self._now
+        # Round trip times of recently acknowledged messages, and the state
+        # of the adaptive window, see max_inflight_messages_auto().
+        self._rtt_samples = collections.deque(maxlen=INFLIGHT_RTT_SAMPLES)
+        self._inflight_target = None
+        self._inflight_min = 1
+        self._inflight_limit = 0
+        self._inflight_slow_start = True
+        self._inflight_acks = 0
+        self._inflight_hold = 0
+        self._inflight_increases = 0
+        self._inflight_decreases = 0
+        # Last message received on each topic, see last_value_cache_set().
+        # Each topic has a slot, a one item list holding its
+        # (topic, payload, qos, retain, mid, timestamp), in both the trie and
+        # the dict, so a message on a topic already seen only costs a dict
+        # lookup.
+        self._last_values = None
+        self._last_value_slots = None
+        self._last_value_path = None
+        self._last_value_mutex = threading.Lock()
+        # Messages published while disconnected, see offline_queue_set().
+        self._offline = None
+        self._offline_policy = OFFLINE_DROP_OLDEST
+        self._offline_rate = 0
+        self._offline_tokens = 0.0
+        self._offline_time = 0
+        self._offline_dropped = 0
         self.on_disconnect = None
         self.on_connect = None
         self.on_publish = None
         self.on_message = None
-        self.on_message_filtered = []
+        self._on_message_filtered = MQTTMatcher()
+        self._topic_cache = collections.OrderedDict()
+        self._topic_cache_size = TOPIC_CACHE_SIZE
+        self._topic_cache_hits = 0
+        self._topic_cache_misses = 0
         self.on_subscribe = None
         self.on_unsubscribe = None
-        self.on_log = None #None
+        self._on_log = None
+        self._logger = None
+        self._log_level = MQTT_LOG_DEBUG
         self._host = ""
         self._port = 1883
         self._bind_address = ""
         self._in_callback = False
-        self._strict_protocol = False
+        self._thread = None
+        self._thread_terminate = False
+        # Taken in this order when more than one is needed.
+        self._out_message_mutex = threading.RLock()
+        self._out_packet_mutex = threading.Lock()
+        self._mid_generate_mutex = threading.Lock()
+        # Notified when the offline queue has room, for OFFLINE_BLOCK.
+        self._offline_room = threading.Condition(self._out_message_mutex)
 
     def __del__(self):
         pass
 
     def reinitialise(self, client_id="", clean_session=True, userdata=None):
+        if self._group is not None:
+            self._group.remove(self)
         if self._sock:
             self._sock.close()
             self._sock = None
-        if self._sockpairR:
-            self._sockpairR.close()
-            self._sockpairR = None
-        if self._sockpairW:
-            self._sockpairW.close()
-            self._sockpairW = None
+        self._connect_abort()
+        if self._wakeup:
+            self._wakeup.close()
+            self._wakeup = None
+        if self._offline is not None:
+            self._offline.close()
 
         self.__init__(client_id, clean_session, userdata)
 
@@ -469,8 +880,9 @@ class Client(object):
         keepalive: Maximum period in seconds between communications with the
         broker. If no other messages are being exchanged, this controls the
         rate at which the client will send ping messages to the broker.
+
+        Returns once the connection is started, see reconnect().
         """
-        print("connect")
         self.connect_async(host, port, keepalive, bind_address)
         return self.reconnect()
 
@@ -487,7 +899,6 @@ class Client(object):
         broker. If no other messages are being exchanged, this controls the
         rate at which the client will send ping messages to the broker.
         """
-        print("connect_async")
         if host is None or len(host) == 0:
             raise ValueError('Invalid host.')
         if port <= 0:
@@ -507,51 +918,180 @@ class Client(object):
 
     def reconnect(self):
         """Reconnect the client after a disconnect. Can only be called after
-        connect()/connect_async()."""
-        print("reconnect")
+        connect()/connect_async().
+
+        Starts the connection and returns without waiting for it. loop()
+        carries it on and sends CONNECT once it is made. The broker's
+        addresses are looked up on a thread of their own and cached for
+        ADDRESS_CACHE_TTL seconds. Up to CONNECT_ATTEMPTS of them are tried
+        at once, and the first to accept the connection is used. If none
+        does within CONNECT_TIMEOUT seconds, or the lookup fails, loop()
+        returns MQTT_ERR_NO_CONN. Raises socket.error if no attempt could be
+        started at all."""
         if len(self._host) == 0:
             raise ValueError('Invalid host.')
         if self._port <= 0:
             raise ValueError('Invalid port number.')
 
-        self._in_packet = {
-            "command": 0,
-            "have_remaining": 0,
-            "remaining_count": [],
-            "remaining_mult": 1,
-            "remaining_length": 0,
-            "packet": b"",
-            "to_process": 0,
-            "pos": 0}
+        self._reconnect_reset()
+        addresses = _address_cache.get(self._host, self._port)
+        if addresses is None:
+            if self._wakeup is None:
+                self._wakeup = _Wakeup()
+            self._resolving = True
+            _address_cache.resolve_async(self._host, self._port, self._resolve_done)
+        else:
+            self._connect_begin(addresses)
+        return MQTT_ERR_SUCCESS
 
-        self._out_packet = []
+    def _resolve_done(self, key, addresses, error):
+        # Called on the resolver's thread.
+        self._resolved = (addresses, error)
+        self._wakeup.set()
+
+    def _loop_connect(self, timeout):
+        # loop() while connecting: wait up to timeout for the address lookup
+        # or for one of the connect attempts to finish. This is the same
+        # writable socket state machine that ClientGroup runs.
+        rlist = [self._wakeup] if self._wakeup is not None else []
+        if self._connecting:
+            timeout = max(0.0, min(timeout, self._connect_deadline - time_func()))
+        socklist = select.select(rlist, self._connecting, [], timeout)
+        self._now = time_func()
+        if socklist[0]:
+            self._wakeup.clear()
+        if self._state == mqtt_cs_disconnecting:
+            self._connect_abort()
+            self._resolving = False
+            return MQTT_ERR_NO_CONN
 
-        self._current_out_packet = None
+        if self._resolving:
+            if self._resolved is None:
+                return MQTT_ERR_SUCCESS
+            (addresses, error) = self._resolved
+            self._resolving = False
+            self._resolved = None
+            if error is not None:
+                return self._connect_failed(error)
+            try:
+                self._connect_begin(addresses)
+            except socket.error as err:
+                return self._connect_failed(err)
+            return MQTT_ERR_SUCCESS
 
-        self._last_msg_in = time.time()
-        self._last_msg_out = time.time()
+        for sock in socklist[1]:
+            try:
+                rc = self._connect_complete(sock)
+            except socket.error as err:
+                return self._connect_failed(err)
+            if rc != MQTT_ERR_AGAIN:
+                return rc
+        if self._connecting and self._now >= self._connect_deadline:
+            self._connect_abort()
+            return self._connect_failed(socket.timeout('timed out'))
+        return MQTT_ERR_SUCCESS
+
+    def _connect_failed(self, error):
+        self._connect_error = error
+        self._easy_log(MQTT_LOG_DEBUG, "Connection failed: %s", error)
+        return MQTT_ERR_NO_CONN
+
+    def _connect_begin(self, addresses):
+        # Start a non-blocking connect to each of the first CONNECT_ATTEMPTS
+        # addresses at once. The caller waits for them to become writable
+        # and hands each that does to _connect_complete(), the first to
+        # connect wins. Raises socket.error if none of them could be started.
+        error = None
+        for (family, socktype, proto, canonname, sockaddr) in addresses[:CONNECT_ATTEMPTS]:
+            sock = socket.socket(family, socktype, proto)
+            try:
+                sock.setblocking(0)
+                if self._bind_address:
+                    sock.bind((self._bind_address, 0))
+                err = sock.connect_ex(sockaddr)
+            except socket.error as e:
+                sock.close()
+                error = e
+                continue
+            if err == 0 or err == errno.EINPROGRESS or err == errno.EWOULDBLOCK or err == EAGAIN:
+                self._connecting.append(sock)
+            else:
+                sock.close()
+                error = socket.error(err, os.strerror(err))
+        if not self._connecting:
+            if error is None:
+                error = socket.error("getaddrinfo returned no addresses for %s" % self._host)
+            raise error
+        self._connect_deadline = self._now + CONNECT_TIMEOUT
+
+    def _connect_complete(self, sock):
+        # sock, one of _connecting, has become writable, so its connect has
+        # finished one way or the other. Returns MQTT_ERR_AGAIN if it failed
+        # and other attempts are still going, otherwise what sending CONNECT
+        # returned. Raises socket.error if it was the last attempt and failed.
+        self._connecting.remove(sock)
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err == 0:
+            for other in self._connecting:
+                other.close()
+            self._connecting = []
+            return self._connect_socket(sock)
+        sock.close()
+        if self._connecting:
+            return MQTT_ERR_AGAIN
+        raise socket.error(err, os.strerror(err))
+
+    def _connect_abort(self):
+        for sock in self._connecting:
+            sock.close()
+        self._connecting = []
+
+    def _reconnect_reset(self):
+        self._in_buf = bytearray(READ_CHUNK_SIZE)
+        self._in_view = memoryview(self._in_buf)
+        self._in_start = 0
+        self._in_end = 0
+        self._in_command = 0
+        self._in_body = None
+        self._in_body_pos = 0
+
+        self._out_control = collections.deque()
+        self._out_packet = collections.deque()
+        self._coalesce_pending = {}
+
+        self._now = time_func()
+        self._last_msg_in = self._now
+        self._last_msg_out = self._now
 
         self._ping_t = 0
         self._state = mqtt_cs_new
         if self._sock:
             self._sock.close()
             self._sock = None
-            print("self._sock == None")
+        self._connect_abort()
+        self._resolving = False
+        self._resolved = None
+        self._connect_error = None
 
         # Put messages in progress in a valid state.
         self._messages_reconnect_reset()
 
-        try:
-            sock = socket.create_connection((self._host, self._port), source_address=(self._bind_address, 0))
-        except socket.error as err:
-            if err.errno != errno.EINPROGRESS and err.errno != errno.EWOULDBLOCK and err.errno != EAGAIN:
-                raise
+    def _connect_retry(self):
+        # Drop the connection and connect again straight away, for the MQTT
+        # v3.1 fallback. On its own the client starts the new connection in
+        # reconnect(), for loop() to finish. In a ClientGroup it is left in
+        # mqtt_cs_connect_async for the group to connect, and
+        # MQTT_ERR_AGAIN stops the read of the dead socket.
+        if self._group is None:
+            return self.reconnect()
+        self._reconnect_reset()
+        self._state = mqtt_cs_connect_async
+        return MQTT_ERR_AGAIN
 
+    def _connect_socket(self, sock):
         self._sock = sock
         self._sock.setblocking(0)
 
-        print("self._sock =", self._sock)
-
         return self._send_connect(self._keepalive, self._clean_session)
 
     def loop(self, timeout=1.0, max_packets=1):
@@ -573,27 +1113,31 @@ class Client(object):
         Returns MQTT_ERR_SUCCESS on success.
         Returns >0 on error.
 
+        While a connection is being made, loop() waits for that instead,
+        see reconnect(). After connect_async() the first call to loop()
+        starts it.
+
         A ValueError will be raised if timeout < 0"""
-        print("loop")
         if timeout < 0.0:
             raise ValueError('Invalid timeout.')
 
-        print("self._current_out_packet =", self._current_out_packet)
-        print("self._out_packet =", self._out_packet)
-        if self._current_out_packet is None and len(self._out_packet) > 0:
-            self._current_out_packet = self._out_packet.pop(0)
-        print("self._current_out_packet =", self._current_out_packet)
-        if self._current_out_packet:
+        if self._sock is None:
+            if self._state == mqtt_cs_connect_async and self._group is None:
+                self.reconnect()
+            if self._connecting or self._resolving:
+                return self._loop_connect(timeout)
+
+        if self._out_control or self._out_packet:
             wlist = [self.socket()]
         else:
             wlist = []
 
-        # sockpairR is used to break out of select() before the timeout, on a
-        # call to publish() etc.
-        rlist = [self.socket(), self._sockpairR]
-        print("self._sockpairR = ", self._sockpairR)
-        print("rlist =",rlist)
-        print("wlist =", wlist)
+        # _wakeup is used to break out of select() before the timeout, on a
+        # call to publish() etc. from another thread.
+        if self._wakeup is not None:
+            rlist = [self.socket(), self._wakeup]
+        else:
+            rlist = [self.socket()]
         try:
             socklist = select.select(rlist, wlist, [], timeout)
         except TypeError:
@@ -605,120 +1149,113 @@ class Client(object):
             return MQTT_ERR_CONN_LOST
         except:
             return MQTT_ERR_UNKNOWN
-        print("self.socket() =",self.socket())
-        print("socklist =",socklist)
+
+        # The one clock reading for everything done on this pass.
+        self._now = time_func()
         if self.socket() in socklist[0]:
-            rc = self.loop_read(max_packets)
+            rc = self._loop_read(max_packets)
             if rc or (self._sock is None):
                 return rc
 
-        #if self._sockpairR in socklist[0]:
-        #    # Stimulate output write even though we didn't ask for it, because
-        #    # at that point the publish or other command wasn't present.
-        #    socklist[1].insert(0, self.socket())
-        #    # Clear sockpairR - only ever a single byte written.
-        #    try:
-        #        self._sockpairR.recv(1)
-        #    except socket.error as err:
-        #        if err.errno != EAGAIN:
-        #            raise
-
-        #if self.socket() in socklist[1]:
-        #    rc = self.loop_write(max_packets)
-        #    if rc or (self._sock is None):
-        #        return rc
-        return self.loop_misc()
-
-#    def publish(self, topic, payload=None, qos=0, retain=False):
-#        """Publish a message on a topic.
-#
-#        This causes a message to be sent to the broker and subsequently from
-#        the broker to any clients subscribing to matching topics.
-#
-#        topic: The topic that the message should be published on.
-#        payload: The actual message to send. If not given, or set to None a
-#        zero length message will be used. Passing an int or float will result
-#        in the payload being converted to a string representing that number. If
-#        you wish to send a true int/float, use struct.pack() to create the
-#        payload you require.
-#        qos: The quality of service level to use.
-#        retain: If set to true, the message will be set as the "last known
-#        good"/retained message for the topic.
-#
-#        Returns a tuple (result, mid), where result is MQTT_ERR_SUCCESS to
-#        indicate success or MQTT_ERR_NO_CONN if the client is not currently
-#        connected.  mid is the message ID for the publish request. The mid
-#        value can be used to track the publish request by checking against the
-#        mid argument in the on_publish() callback if it is defined.
-#
-#        A ValueError will be raised if topic is None, has zero length or is
-#        invalid (contains a wildcard), if qos is not one of 0, 1 or 2, or if
-#        the length of the payload is greater than 268435455 bytes."""
-#        if topic is None or len(topic) == 0:
-#            raise ValueError('Invalid topic.')
-#        if qos<0 or qos>2:
-#            raise ValueError('Invalid QoS level.')
-#        if isinstance(payload, str) or isinstance(payload, bytearray):
-#            local_payload = payload
-#        elif sys.version_info[0] < 3 and isinstance(payload, unicode):
-#            local_payload = payload
-#        elif isinstance(payload, int) or isinstance(payload, float):
-#            local_payload = str(payload)
-#        elif payload is None:
-#            local_payload = None
-#        else:
-#            raise TypeError('payload must be a string, bytearray, int, float or None.')
-#
-#        if local_payload is not None and len(local_payload) > 268435455:
-#            raise ValueError('Payload too large.')
-#
-#        if self._topic_wildcard_len_check(topic) != MQTT_ERR_SUCCESS:
-#            raise ValueError('Publish topic cannot contain wildcards.')
-#
-#        local_mid = self._mid_generate()
-#
-#        if qos == 0:
-#            rc = self._send_publish(local_mid, topic, local_payload, qos, retain, False)
-#            return (rc, local_mid)
-#        else:
-#            message = MQTTMessage()
-#            message.timestamp = time.time()
-#
-#            message.mid = local_mid
-#            message.topic = topic
-#            if local_payload is None or len(local_payload) == 0:
-#                message.payload = None
-#            else:
-#                message.payload = local_payload
-#
-#            message.qos = qos
-#            message.retain = retain
-#            message.dup = False
-#
-#            self._out_message_mutex.acquire()
-#            self._out_messages.append(message)
-#            if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
-#                self._inflight_messages = self._inflight_messages+1
-#                if qos == 1:
-#                    message.state = mqtt_ms_wait_for_puback
-#                elif qos == 2:
-#                    message.state = mqtt_ms_wait_for_pubrec
-#                self._out_message_mutex.release()
-#
-#                rc = self._send_publish(message.mid, message.topic, message.payload, message.qos, message.retain, message.dup)
-#
-#                # remove from inflight messages so it will be send after a connection is made
-#                if rc is MQTT_ERR_NO_CONN:
-#                    with self._out_message_mutex:
-#                        self._inflight_messages -= 1
-#                        message.state = mqtt_ms_publish
-#
-#                return (rc, local_mid)
-#            else:
-#                message.state = mqtt_ms_queued;
-#                self._out_message_mutex.release()
-#                return (MQTT_ERR_SUCCESS, local_mid)
-#
+        if self._wakeup is not None and self._wakeup in socklist[0]:
+            # Stimulate output write even though we didn't ask for it, because
+            # at that point the publish or other command wasn't present.
+            socklist[1].insert(0, self.socket())
+            self._wakeup.clear()
+
+        if self.socket() in socklist[1]:
+            rc = self._loop_write(max_packets)
+            if rc or (self._sock is None):
+                return rc
+        return self._loop_misc()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        """Publish a message on a topic.
+
+        This causes a message to be sent to the broker and subsequently from
+        the broker to any clients subscribing to matching topics.
+
+        topic: The topic that the message should be published on.
+        payload: The actual message to send. If not given, or set to None a
+        zero length message will be used. Passing an int or float will result
+        in the payload being converted to a string representing that number. If
+        you wish to send a true int/float, use struct.pack() to create the
+        payload you require.
+        qos: The quality of service level to use.
+        retain: If set to true, the message will be set as the "last known
+        good"/retained message for the topic.
+
+        Returns a MQTTMessageInfo, which unpacks as the tuple (result, mid).
+        result is MQTT_ERR_SUCCESS to indicate success or MQTT_ERR_NO_CONN if
+        the client is not currently connected. mid is the message ID for the
+        publish request. The mid value can be used to track the publish
+        request by checking against the mid argument in the on_publish()
+        callback if it is defined.
+
+        A ValueError will be raised if topic is None, has zero length or is
+        invalid (contains a wildcard), if qos is not one of 0, 1 or 2, or if
+        the length of the payload is greater than 268435455 bytes."""
+        if topic is None or len(topic) == 0:
+            raise ValueError('Invalid topic.')
+        if qos<0 or qos>2:
+            raise ValueError('Invalid QoS level.')
+        local_payload = _encode_payload(payload)
+
+        if self._topic_wildcard_len_check(topic) != MQTT_ERR_SUCCESS:
+            raise ValueError('Publish topic cannot contain wildcards.')
+
+        local_mid = self._mid_generate()
+        info = MQTTMessageInfo(local_mid)
+
+        if self._offline is not None:
+            with self._out_message_mutex:
+                if self._offline_active():
+                    return self._offline_put(topic, local_payload, qos, retain, info)
+
+        info.rc = self._publish(local_mid, topic, local_payload, qos, retain, info)
+        return info
+
+    def publish_many(self, messages):
+        """Publish a batch of messages.
+
+        messages: An iterable of (topic, payload, qos, retain) tuples, with
+        the same meaning as the arguments to publish(). qos and retain may be
+        left off, defaulting to 0 and False.
+
+        This does the same as calling publish() for each message, but the
+        whole batch is encoded into one buffer and handed to the network in
+        one go, rather than paying for a queue entry and a write attempt per
+        message. Use it for bursts of small messages, e.g. a set of sensor
+        readings taken together.
+
+        Returns a list with a MQTTMessageInfo for each message, in order.
+
+        Raises the same errors as publish(). All messages are checked before
+        any is queued, so on error nothing has been sent."""
+        batch = []
+        for item in messages:
+            topic = item[0]
+            payload = item[1] if len(item) > 1 else None
+            qos = item[2] if len(item) > 2 else 0
+            retain = item[3] if len(item) > 3 else False
+            if topic is None or len(topic) == 0:
+                raise ValueError('Invalid topic.')
+            if qos<0 or qos>2:
+                raise ValueError('Invalid QoS level.')
+            if self._topic_wildcard_len_check(topic) != MQTT_ERR_SUCCESS:
+                raise ValueError('Publish topic cannot contain wildcards.')
+            batch.append((topic, _encode_payload(payload), qos, retain))
+        if not batch:
+            return []
+
+        if self._offline is not None:
+            with self._out_message_mutex:
+                if self._offline_active():
+                    return [self._offline_put(topic, payload, qos, retain, MQTTMessageInfo(self._mid_generate()))
+                            for topic, payload, qos, retain in batch]
+
+        return self._publish_many(batch, self._sock is not None)
+
 #    def username_pw_set(self, username, password=None):
 #        """Set a username and optionally a password for broker authentication.
 #
@@ -732,10 +1269,16 @@ class Client(object):
 #        self._password = password
 
     def disconnect(self):
-        """Disconnect a connected client from the broker."""
+        """Disconnect a connected client from the broker. Saves the last
+        value cache if it has a file, see last_value_cache_set()."""
         self._state = mqtt_cs_disconnecting
+        if self._last_value_path is not None:
+            self.last_value_save()
 
         if self._sock is None:
+            if self._wakeup is not None:
+                # Stop a connect under way in the network thread.
+                self._wakeup.set()
             return MQTT_ERR_NO_CONN
 
         return self._send_disconnect()
@@ -783,7 +1326,6 @@ class Client(object):
         Raises a ValueError if qos is not 0, 1 or 2, or if topic is None or has
         zero string length, or if topic is not a string, tuple or list.
         """
-        print("subscribe")
         topic_qos_list = None
         if isinstance(topic, str):
             if qos<0 or qos>2:
@@ -860,20 +1402,32 @@ class Client(object):
         on.
 
         Do not use if you are using the threaded interface loop_start()."""
-        print("loop_read")
+        self._now = time_func()
+        return self._loop_read(max_packets)
+
+    def _loop_read(self, max_packets=1):
         if self._sock is None and self._ssl is None:
             return MQTT_ERR_NO_CONN
 
-        max_packets = len(self._out_messages) + len(self._in_messages)
+        max_packets = len(self._out_messages) + len(self._out_message_queue) + len(self._in_messages)
         if max_packets < 1:
             max_packets = 1
 
-        for i in range(0, max_packets):
-            rc = self._packet_read()
-            if rc > 0:
-                return self._loop_rc_handle(rc)
-            elif rc == MQTT_ERR_AGAIN:
-                return MQTT_ERR_SUCCESS
+        # Replies generated while reading (PUBACK, PUBREC, ...) are queued
+        # and go out together in a single flush once the read is done.
+        self._write_deferred = True
+        try:
+            for i in range(0, max_packets):
+                rc = self._packet_read()
+                if rc != MQTT_ERR_SUCCESS:
+                    break
+        finally:
+            self._write_deferred = False
+
+        if rc > 0:
+            return self._loop_rc_handle(rc)
+        if (self._out_control or self._out_packet) and not self._in_callback:
+            return self._loop_write()
         return MQTT_ERR_SUCCESS
 
     def loop_write(self, max_packets=1):
@@ -886,11 +1440,14 @@ class Client(object):
         Use want_write() to determine if there is data waiting to be written.
 
         Do not use if you are using the threaded interface loop_start()."""
-        print("loop_write")
+        self._now = time_func()
+        return self._loop_write(max_packets)
+
+    def _loop_write(self, max_packets=1):
         if self._sock is None and self._ssl is None:
             return MQTT_ERR_NO_CONN
 
-        max_packets = len(self._out_packet) + 1
+        max_packets = len(self._out_control) + len(self._out_packet) + 1
         if max_packets < 1:
             max_packets = 1
 
@@ -907,7 +1464,7 @@ class Client(object):
     #    Useful if you are calling select() yourself rather than using loop().
     #    """
     #    print("want_write")
-    #    if self._current_out_packet or len(self._out_packet) > 0:
+    #    if len(self._out_packet) > 0:
     #        return True
     #    else:
     #        return False
@@ -917,20 +1474,20 @@ class Client(object):
         wish to call select() or equivalent on.
 
         Do not use if you are using the threaded interface loop_start()."""
-        print("loop_misc")
+        self._now = time_func()
+        return self._loop_misc()
+
+    def _loop_misc(self):
+        if self._store is not None:
+            self._store.commit()
         if self._sock is None: # and self._ssl is None:
             return MQTT_ERR_NO_CONN
 
-        now = time.time()
-        self._check_keepalive()
-        if self._last_retry_check+1 < now:
-            # Only check once a second at most
-            self._message_retry_check()
-            self._last_retry_check = now
-
-        if self._ping_t > 0 and now - self._ping_t >= self._keepalive:
-            # client->ping_t != 0 means we are waiting for a pingresp.
-            # This hasn't happened in the keepalive time so we should disconnect.
+        if self._offline:
+            self._offline_drain()
+        if self._check_keepalive() != MQTT_ERR_SUCCESS:
+            # No CONNACK or PINGRESP in the keepalive time, so the broker or
+            # the network is gone.
             if self._sock:
                 self._sock.close()
                 self._sock = None
@@ -944,6 +1501,112 @@ class Client(object):
                 self.on_disconnect(self, self._userdata, rc)
                 self._in_callback = False
             return MQTT_ERR_CONN_LOST
+        heap = self._retry_heap
+        if heap and heap[0][0] <= self._now:
+            self._message_retry_check()
+        return MQTT_ERR_SUCCESS
+
+    def loop_forever(self, timeout=1.0, max_packets=1, retry_first_connection=False):
+        """This function call loop() for you in an infinite blocking loop. It
+        is useful for the case where you only want to run the MQTT client loop
+        in your program.
+
+        loop_forever() will handle reconnecting for you. If you call
+        disconnect() in a callback it will return.
+
+        Each call to loop() waits for network traffic until the next PINGREQ
+        or retry is due, or for timeout seconds if that is sooner.
+        max_packets is passed on to loop().
+        retry_first_connection: Should the first connection attempt be retried
+        on failure. If not, the socket error from the first attempt is
+        raised."""
+        run = True
+        # No connection has been made yet.
+        first = self._sock is None
+
+        while run:
+            if self._thread_terminate:
+                break
+            if self._state == mqtt_cs_connect_async:
+                try:
+                    self.reconnect()
+                except socket.error:
+                    if not retry_first_connection:
+                        raise
+                    self._easy_log(MQTT_LOG_DEBUG, "Connection failed, retrying")
+                    time.sleep(1)
+            else:
+                break
+
+        while run:
+            rc = MQTT_ERR_SUCCESS
+            while rc == MQTT_ERR_SUCCESS:
+                rc = self.loop(self._loop_timeout(timeout), max_packets)
+                if first and self._sock is not None:
+                    first = False
+                # Once loop_stop() has been called, keep going only until
+                # everything queued has been sent and acknowledged.
+                if (self._thread_terminate
+                        and len(self._out_control) == 0
+                        and len(self._out_packet) == 0
+                        and len(self._out_messages) == 0):
+                    rc = 1
+                    run = False
+
+            if first and self._connect_error is not None and not retry_first_connection:
+                raise self._connect_error
+            if self._state == mqtt_cs_disconnecting or run is False or self._thread_terminate:
+                run = False
+            else:
+                time.sleep(1)
+                if self._state == mqtt_cs_disconnecting or self._thread_terminate:
+                    run = False
+                else:
+                    try:
+                        self.reconnect()
+                    except socket.error:
+                        self._easy_log(MQTT_LOG_DEBUG, "Connection failed, retrying")
+        return rc
+
+    def loop_start(self):
+        """This is part of the threaded client interface. Call this once to
+        start a new thread to process network traffic. This provides an
+        alternative to repeatedly calling loop() yourself.
+
+        While the thread runs, publish(), subscribe(), unsubscribe() and
+        disconnect() may be called from any thread. They queue their packet
+        and wake the network thread, which sends it straight away.
+
+        Returns MQTT_ERR_INVAL if the thread is already running, or if the
+        client is in a ClientGroup."""
+        if self._thread is not None or self._group is not None:
+            return MQTT_ERR_INVAL
+
+        self._thread_terminate = False
+        if self._wakeup is None:
+            self._wakeup = _Wakeup()
+        self._thread = threading.Thread(target=self._thread_main)
+        self._thread.daemon = True
+        self._thread.start()
+        return MQTT_ERR_SUCCESS
+
+    def loop_stop(self, force=False):
+        """This is part of the threaded client interface. Call this once to
+        stop the network thread previously created with loop_start(). This call
+        will block until the network thread finishes, which is once everything
+        queued has been sent and, for QoS>0, acknowledged.
+
+        The force parameter is currently ignored.
+
+        Returns MQTT_ERR_INVAL if the thread is not running."""
+        if self._thread is None:
+            return MQTT_ERR_INVAL
+
+        self._thread_terminate = True
+        self._wakeup.set()
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+            self._thread = None
         return MQTT_ERR_SUCCESS
 
     def max_inflight_messages_set(self, inflight):
@@ -951,8 +1614,223 @@ class Client(object):
         through their network flow at once. Defaults to 20."""
         if inflight < 0:
             raise ValueError('Invalid inflight.')
+        self._inflight_target = None
         self._max_inflight_messages = inflight
 
+    def max_inflight_messages_auto(self, target_latency, minimum=1, maximum=1000):
+        """Size the in-flight window from measured round trip times instead
+        of a fixed number. Each PUBACK (PUBREC for QoS 2) that arrives
+        within target_latency seconds of its PUBLISH lets the window grow,
+        by one per ack at first and by one per window of acks once a late
+        ack has been seen. A late ack halves it, at most once per round
+        trip. The window stays between minimum and maximum, and only grows
+        while messages are queued waiting for room. Retransmitted messages
+        are not measured, their ack may be for either copy.
+
+        Pass None as target_latency to keep the current window as a fixed
+        one. max_inflight_messages_set() also turns this off."""
+        if target_latency is None:
+            self._inflight_target = None
+            return
+        if target_latency <= 0:
+            raise ValueError('Invalid target_latency.')
+        if minimum < 1 or maximum < minimum:
+            raise ValueError('Invalid minimum or maximum.')
+        window = self._max_inflight_messages or maximum
+        self._max_inflight_messages = min(max(window, minimum), maximum)
+        self._inflight_target = target_latency
+        self._inflight_min = minimum
+        self._inflight_limit = maximum
+        self._inflight_slow_start = True
+        self._inflight_acks = 0
+        self._inflight_hold = 0
+
+    def session_store_set(self, store):
+        """Keep QoS 1 and 2 messages that are part way through their flow
+        in store as well as in memory, so that they survive a restart, e.g.
+        in a umqtt_store.FileSessionStore. Call it before connecting, with
+        clean_session=False so that the broker keeps its half of the session.
+
+        Messages left in the store by an earlier run are taken over by the
+        client, ahead of any already published, and sent again once
+        reconnect() has connected. Changes are committed to the store in
+        groups, once per loop and before any packet is written, so a PUBLISH
+        or PUBREC never reaches the network ahead of its record. Pass None
+        to stop using a store."""
+        with self._out_message_mutex:
+            self._store = None
+            if store is None:
+                return
+            (out, incoming) = store.load()
+            messages = collections.OrderedDict()
+            queue = collections.deque()
+            for (mid, state, qos, retain, topic, payload) in out:
+                m = self._store_message(mid, state, qos, retain, topic, payload)
+                m.info = MQTTMessageInfo(mid)
+                if state == mqtt_ms_queued:
+                    queue.append(m)
+                else:
+                    messages[mid] = m
+            if out:
+                with self._mid_generate_mutex:
+                    self._last_mid = out[-1][0]
+            for m in self._out_messages.values():
+                store.out_put(m.mid, m.state, m.qos, m.retain, m.topic, m.payload)
+                messages[m.mid] = m
+            for m in self._out_message_queue:
+                store.out_put(m.mid, m.state, m.qos, m.retain, m.topic, m.payload)
+                queue.append(m)
+            self._out_messages = messages
+            self._out_message_queue = queue
+
+            for (mid, state, qos, retain, topic, payload) in incoming:
+                m = self._store_message(mid, mqtt_ms_wait_for_pubrel, qos, retain, topic, payload)
+                self._in_messages[mid] = m
+            for m in self._in_messages.values():
+                if m.state == mqtt_ms_wait_for_pubrel:
+                    store.in_put(m.mid, m.qos, m.retain, m.topic, m.payload)
+            self._store = store
+            self._retry_rebuild()
+
+    def _store_message(self, mid, state, qos, retain, topic, payload):
+        m = MQTTMessage()
+        m.mid = mid
+        m.state = state
+        m.qos = qos
+        m.retain = retain
+        m.topic = topic
+        m.payload = payload
+        # May have been sent before the restart.
+        m.dup = state != mqtt_ms_queued
+        return m
+
+    def offline_queue_set(self, max_messages, max_bytes=1048576, spill_path=None,
+                          spill_max_bytes=67108864, policy=OFFLINE_DROP_OLDEST, drain_rate=0):
+        """Queue messages published while the client is not connected,
+        instead of failing QoS 0 ones with MQTT_ERR_NO_CONN and holding any
+        number of QoS 1 and 2 ones in memory.
+
+        Up to max_messages messages, and max_bytes of their topics and
+        payloads, are kept in memory. With spill_path, the messages behind
+        those are written to a file there, up to spill_max_bytes of it. When
+        that is full too, policy decides. OFFLINE_DROP_OLDEST drops the
+        oldest message in the queue, setting the rc of its MQTTMessageInfo
+        to MQTT_ERR_QUEUE_SIZE. OFFLINE_BLOCK makes publish() wait for room,
+        which needs the network loop to be running in another thread, e.g.
+        through loop_start(). A publish() from the network thread itself is
+        refused with MQTT_ERR_QUEUE_SIZE rather than wait.
+
+        Once connected, the queue is sent in order, ahead of anything
+        published since, at up to drain_rate messages a second (0 for no
+        limit). Messages only leave it while the in-flight window has room
+        and the socket is keeping up, so a long queue is not all copied into
+        memory at once.
+
+        Messages are only written to the session store when they leave the
+        queue, so QoS 1 and 2 messages still queued when the process
+        restarts are lost.
+
+        Pass 0 as max_messages to stop queueing. Messages already queued are
+        moved to the new queue, and dropped if they don't fit."""
+        if max_messages < 0 or max_bytes <= 0 or spill_max_bytes < 0 or drain_rate < 0:
+            raise ValueError('Invalid offline queue limits.')
+        if policy != OFFLINE_DROP_OLDEST and policy != OFFLINE_BLOCK:
+            raise ValueError('Invalid policy.')
+        with self._out_message_mutex:
+            old = self._offline
+            self._offline = None
+            if max_messages > 0:
+                self._offline = SpillQueue(max_messages, max_bytes, spill_path, spill_max_bytes)
+            self._offline_policy = policy
+            self._offline_rate = drain_rate
+            self._offline_tokens = 0.0
+            self._offline_time = self._now
+            if old is not None:
+                while old:
+                    (topic, payload, qos, retain, info) = old.get()
+                    if self._offline is None or not self._offline.put(topic, payload, qos, retain, info):
+                        info.rc = MQTT_ERR_QUEUE_SIZE
+                        self._offline_dropped += 1
+                old.close()
+            self._offline_room.notify_all()
+
+    def offline_stats(self):
+        """Return a dict with the messages and bytes of them in the offline
+        queue, in memory and in its file, the number of messages ever spilled
+        to the file and the number dropped or refused because the queue was
+        full."""
+        with self._out_message_mutex:
+            if self._offline is None:
+                stats = {'messages': 0, 'bytes': 0, 'file_messages': 0, 'file_bytes': 0, 'spilled': 0}
+            else:
+                stats = self._offline.stats()
+            stats['dropped'] = self._offline_dropped
+            return stats
+
+    def _offline_active(self):
+        # Whether a message published now goes to the offline queue: while
+        # not connected, and while earlier ones are still in it.
+        return bool(self._offline) or self._sock is None or self._state != mqtt_cs_connected
+
+    def _offline_put(self, topic, payload, qos, retain, info):
+        # Called with _out_message_mutex held, which waiting for room
+        # releases. The queue may have been replaced or turned off by then.
+        while self._offline is not None:
+            queue = self._offline
+            if queue.put(topic, payload, qos, retain, info):
+                return info
+            if self._offline_policy == OFFLINE_DROP_OLDEST and queue:
+                queue.get()[4].rc = MQTT_ERR_QUEUE_SIZE
+                self._offline_dropped += 1
+            elif (self._offline_policy == OFFLINE_BLOCK and not self._in_callback
+                  and threading.current_thread() is not self._thread):
+                self._offline_room.wait()
+            else:
+                break
+        info.rc = MQTT_ERR_QUEUE_SIZE
+        self._offline_dropped += 1
+        return info
+
+    def _offline_due(self):
+        # When the offline queue can next be drained. None while it is empty
+        # or waiting on the network, for the in-flight window or the socket.
+        if (not self._offline or self._sock is None or self._state != mqtt_cs_connected
+                or self._out_message_queue or len(self._out_packet) >= OFFLINE_DRAIN_BACKLOG):
+            return None
+        if self._offline_rate and self._offline_tokens < 1:
+            return self._offline_time + (1 - self._offline_tokens) / self._offline_rate
+        return self._now
+
+    def _offline_drain(self):
+        # Publish messages from the offline queue while the rate, the
+        # in-flight window and the socket allow.
+        rc = MQTT_ERR_SUCCESS
+        with self._out_message_mutex:
+            if self._offline_due() is None:
+                return rc
+            queue = self._offline
+            rate = self._offline_rate
+            if rate:
+                tokens = min(self._offline_tokens + (self._now - self._offline_time) * rate, max(rate, 1))
+            else:
+                tokens = len(queue)
+            self._offline_time = self._now
+            while (queue and tokens >= 1 and not self._out_message_queue
+                   and len(self._out_packet) < OFFLINE_DRAIN_BACKLOG):
+                (topic, payload, qos, retain, info) = queue.get()
+                tokens -= 1
+                if qos > 0 and info.mid in self._out_messages:
+                    # Its mid has been handed out again since it was queued.
+                    info.mid = self._mid_generate()
+                rc = self._publish(info.mid, topic, payload, qos, retain, info)
+                if qos == 0:
+                    info.rc = rc
+                if rc != MQTT_ERR_SUCCESS:
+                    break
+            self._offline_tokens = tokens if rate else 0.0
+            self._offline_room.notify_all()
+        return rc
+
     def message_retry_set(self, retry):
         """Set the timeout in seconds before a message with QoS>0 is retried.
         20 seconds by default."""
@@ -960,6 +1838,173 @@ class Client(object):
             raise ValueError('Invalid retry.')
 
         self._message_retry = retry
+        self._retry_rebuild()
+
+    def coalesce_set(self, enabled):
+        """Turn latest value wins coalescing of QoS 0 messages on or off.
+
+        While it is on, a QoS 0 PUBLISH still waiting in the outgoing queue,
+        none of it written to the socket yet, is replaced in place by a newer
+        one on the same topic. Over a slow link a topic that is published
+        faster than it can be sent, such as a volume level, then only carries
+        its latest value, in the place in the queue of the oldest unsent one.
+        A replaced message counts as published once the one that replaced it
+        is written. queue_stats() counts the messages replaced. Off by
+        default."""
+        with self._out_packet_mutex:
+            self._coalesce = bool(enabled)
+            if not enabled:
+                for mpkt in self._coalesce_pending.values():
+                    mpkt.topic = None
+                self._coalesce_pending = {}
+
+    def last_value_cache_set(self, enabled, path=None):
+        """Keep the last message received on each topic, to be read with
+        get_last() and snapshot() without waiting for the next one. A
+        retained message with an empty payload, which clears the topic at the
+        broker, removes the topic. Messages are kept whether or not a
+        callback handles them.
+
+        With path, the cache is loaded from the file there now, if there is
+        one, so values from an earlier run are available as soon as the
+        client starts, and last_value_save() writes it back. disconnect()
+        calls last_value_save(). Loaded messages have a timestamp of 0.
+        Turning the cache off empties it.
+
+        The cache costs a copy of the payload for every message received,
+        and a lock and a trie insert the first time a topic is seen."""
+        with self._last_value_mutex:
+            if not enabled:
+                self._last_values = None
+                self._last_value_slots = None
+                self._last_value_path = None
+                return
+            self._last_values = MQTTMatcher()
+            self._last_value_slots = {}
+            self._last_value_path = path
+            if path is not None:
+                for (qos, retain, topic, payload) in read_messages(path):
+                    slot = [(topic, payload or b"", qos, retain, 0, 0)]
+                    self._last_values[topic] = slot
+                    self._last_value_slots[topic] = slot
+
+    def last_value_save(self):
+        """Write the last value cache to the file given to
+        last_value_cache_set(), replacing it."""
+        with self._last_value_mutex:
+            if self._last_values is None or self._last_value_path is None:
+                return
+            messages = []
+            for (topic, slot) in self._last_values.items():
+                entry = slot[0]
+                messages.append((entry[2], entry[3], topic, entry[1]))
+            write_messages(self._last_value_path, messages)
+
+    def get_last(self, topic):
+        """Return the last MQTTMessage received on topic, or None if there
+        hasn't been one or the last value cache is off. Its payload is
+        bytes."""
+        with self._last_value_mutex:
+            if self._last_value_slots is None:
+                return None
+            slot = self._last_value_slots.get(topic)
+            if slot is None:
+                return None
+            return _last_value_message(slot[0])
+
+    def snapshot(self, sub):
+        """Return a dict of the last MQTTMessage received on every topic
+        that the filter sub matches, keyed by topic."""
+        with self._last_value_mutex:
+            if self._last_values is None:
+                return {}
+            found = {}
+            for slot in self._last_values.match_filter(sub):
+                entry = slot[0]
+                found[entry[0]] = _last_value_message(entry)
+            return found
+
+    def _last_value_put(self, message):
+        topic = message.topic
+        if message.retain and not message.payload:
+            with self._last_value_mutex:
+                if self._last_values is not None and self._last_value_slots.pop(topic, None) is not None:
+                    del self._last_values[topic]
+            return
+        payload = message.payload
+        entry = (topic, bytes(payload) if payload is not None else b"",
+                 message.qos, message.retain, message.mid, message.timestamp)
+        slots = self._last_value_slots
+        if slots is None:
+            return
+        slot = slots.get(topic)
+        if slot is not None:
+            # A known topic. Only this thread adds and removes slots, and
+            # replacing the entry is a single store, so readers see either
+            # the old entry or the new one without the lock.
+            slot[0] = entry
+            return
+        with self._last_value_mutex:
+            if self._last_value_slots is slots:
+                slot = slots[topic] = [entry]
+                self._last_values[topic] = slot
+
+    def topic_cache_set(self, size):
+        """Set how many incoming topics to remember. Each is kept as the raw
+        topic bytes mapped to the decoded topic string and the
+        message_callback_add() callbacks matching it, so messages on a known
+        topic skip both. The least recently used topic is dropped first.
+        Defaults to 256, 0 disables the cache."""
+        if size < 0:
+            raise ValueError('Invalid size.')
+        self._topic_cache_size = size
+        self._topic_cache.clear()
+
+    def topic_cache_stats(self):
+        """Return a dict with the number of topic cache hits and misses
+        since the client was created, and the current and maximum number of
+        entries."""
+        return {
+            'hits': self._topic_cache_hits,
+            'misses': self._topic_cache_misses,
+            'entries': len(self._topic_cache),
+            'size': self._topic_cache_size}
+
+    def log_level_set(self, level):
+        """Set the least severe level of log message passed on, one of
+        MQTT_LOG_DEBUG (the default, everything), MQTT_LOG_INFO,
+        MQTT_LOG_NOTICE, MQTT_LOG_WARNING or MQTT_LOG_ERR.
+
+        Messages below the level are never formatted. Raising it above
+        MQTT_LOG_DEBUG takes logging out of the per-packet cost even while
+        on_log is set."""
+        if level not in _LOG_SEVERITY:
+            raise ValueError('Invalid log level.')
+        self._log_level = level
+        self._log_update()
+
+    def enable_logger(self, logger=None):
+        """Pass log messages to a logging.Logger as well as to on_log. If
+        logger is None the logger for this module is used. The MQTT_LOG_*
+        levels are mapped as in LOGGING_LEVEL."""
+        if logger is None:
+            logger = logging.getLogger(__name__)
+        self._logger = logger
+        self._log_update()
+
+    def disable_logger(self):
+        """Stop passing log messages to the logger set by enable_logger()."""
+        self._logger = None
+        self._log_update()
+
+    @property
+    def on_log(self):
+        return self._on_log
+
+    @on_log.setter
+    def on_log(self, func):
+        self._on_log = func
+        self._log_update()
 
     def user_data_set(self, userdata):
         """Set the user data variable passed to callbacks. May be any data type."""
@@ -1017,6 +2062,55 @@ class Client(object):
         """Return the socket or ssl object for this client."""
         return self._sock
 
+    def write_stats(self):
+        """Return a dict showing how well outgoing packets are being batched.
+
+        calls, bytes and packets are totals since the client was created, so
+        packets/calls is the average number of packets per send syscall.
+        last_bytes and last_packets describe the most recent flush."""
+        return {
+            'calls': self._write_calls,
+            'bytes': self._write_bytes,
+            'packets': self._write_packets,
+            'last_bytes': self._last_write[0],
+            'last_packets': self._last_write[1]}
+
+    def queue_stats(self):
+        """Return a dict with the number of packets waiting in each lane of
+        the outgoing queue, and the most there have been since the client
+        was created. control is acknowledgements, PINGREQ and CONNECT, which
+        are sent ahead of the packets in publish. coalesced is the number of
+        QoS 0 messages replaced in the queue by a newer one, see
+        coalesce_set()."""
+        return {
+            'control': len(self._out_control),
+            'publish': len(self._out_packet),
+            'control_max': self._out_control_max,
+            'publish_max': self._out_packet_max,
+            'coalesced': self._coalesced}
+
+    def inflight_stats(self):
+        """Return a dict describing the in-flight window. window is its
+        current size (0 for no limit), inflight and queued the messages in
+        it and waiting for room. rtt_p50, rtt_p90 and rtt_p99 are
+        percentiles in seconds of the PUBLISH to PUBACK (or PUBREC) times of
+        the last INFLIGHT_RTT_SAMPLES messages, None until one is
+        acknowledged. increases and decreases count changes made by
+        max_inflight_messages_auto()."""
+        rtts = sorted(self._rtt_samples)
+        n = len(rtts)
+        return {
+            'window': self._max_inflight_messages,
+            'inflight': self._inflight_messages,
+            'queued': len(self._out_message_queue),
+            'auto': self._inflight_target is not None,
+            'samples': n,
+            'rtt_p50': rtts[n // 2] if n else None,
+            'rtt_p90': rtts[min(n * 9 // 10, n - 1)] if n else None,
+            'rtt_p99': rtts[min(n * 99 // 100, n - 1)] if n else None,
+            'increases': self._inflight_increases,
+            'decreases': self._inflight_decreases}
+
     def message_callback_add(self, sub, callback):
         """Register a message callback for a specific topic.
         Messages that match 'sub' will be passed to 'callback'. Any
@@ -1031,12 +2125,8 @@ class Client(object):
         if callback is None or sub is None:
             raise ValueError("sub and callback must both be defined.")
 
-        for i in range(0, len(self.on_message_filtered)):
-            if self.on_message_filtered[i][0] == sub:
-                self.on_message_filtered[i] = (sub, callback)
-                return
-
-        self.on_message_filtered.append((sub, callback))
+        self._on_message_filtered[sub] = callback
+        self._topic_cache.clear()
 
     def message_callback_remove(self, sub):
         """Remove a message callback previously registered with
@@ -1044,10 +2134,12 @@ class Client(object):
         if sub is None:
             raise ValueError("sub must defined.")
 
-        for i in range(0, len(self.on_message_filtered)):
-            if self.on_message_filtered[i][0] == sub:
-                self.on_message_filtered.pop(i)
-                return
+        try:
+            del self._on_message_filtered[sub]
+        except KeyError:
+            # Not registered, nothing to do.
+            return
+        self._topic_cache.clear()
 
     # ============================================================
     # Private functions
@@ -1072,544 +2164,296 @@ class Client(object):
         return rc
 
     def _packet_read(self):
-        # This gets called if pselect() indicates that there is network data
-        # available - ie. at least one byte.  What we do depends on what data we
-        # already have.
-        # If we've not got a command, attempt to read one and save it. This should
-        # always work because it's only a single byte.
-        # Then try to read the remaining length. This may fail because it is may
-        # be more than one byte - will need to save data pending next read if it
-        # does fail.
-        # Then try to read the remaining payload, where 'payload' here means the
-        # combined variable header and actual payload. This is the most likely to
-        # fail due to longer length, so save current data and current position.
-        # After all data is read, send to _mqtt_handle_packet() to deal with.
-        # Finally, free the memory and reset everything to starting conditions.
-        print("_packet_read")
-        if self._in_packet['command'] == 0:
-            try:
-                command = self._sock.recv(1)
-            except socket.error as err:
-                if err.errno == EAGAIN:
-                    return MQTT_ERR_AGAIN
-                print(err)
+        # This gets called if select() indicates that there is network data
+        # available - ie. at least one byte.  Rather than reading the command,
+        # the remaining length and the payload with separate recv() calls, pull
+        # as much as the socket has into _in_buf with a single recv_into() and
+        # then hand every complete packet it holds to _packet_handle(). Whatever
+        # is left over is the start of a packet that a later read will complete.
+        # A packet too big for _in_buf gets a body of its own, _in_body, which
+        # is allocated once at its final size and received into directly.
+        if self._in_body is not None:
+            view = memoryview(self._in_body)[self._in_body_pos:]
+        else:
+            view = self._in_view[self._in_end:]
+        try:
+            nbytes = self._sock.recv_into(view)
+        except socket.error as err:
+            if err.errno == EAGAIN:
+                return MQTT_ERR_AGAIN
+            self._easy_log(MQTT_LOG_ERR, "Failed to receive on socket: %s", err)
+            return 1
+        else:
+            if nbytes == 0:
                 return 1
-            else:
-                if len(command) == 0:
-                    return 1
-                command = struct.unpack("!B", command)
-                self._in_packet['command'] = command[0]
-
-        if self._in_packet['have_remaining'] == 0:
-            # Read remaining
-            # Algorithm for decoding taken from pseudo code at
-            # http://publib.boulder.ibm.com/infocenter/wmbhelp/v6r0m0/topic/com.ibm.etools.mft.doc/ac10870_.htm
-            while True:
-                try:
-                    byte = self._sock.recv(1)
-                except socket.error as err:
-                    if err.errno == EAGAIN:
-                        return MQTT_ERR_AGAIN
-                    print(err)
-                    return 1
-                else:
-                    byte = struct.unpack("!B", byte)
-                    byte = byte[0]
-                    self._in_packet['remaining_count'].append(byte)
-                    # Max 4 bytes length for remaining length as defined by protocol.
-                     # Anything more likely means a broken/malicious client.
-                    if len(self._in_packet['remaining_count']) > 4:
-                        return MQTT_ERR_PROTOCOL
-
-                    self._in_packet['remaining_length'] = self._in_packet['remaining_length'] + (byte & 127)*self._in_packet['remaining_mult']
-                    self._in_packet['remaining_mult'] = self._in_packet['remaining_mult'] * 128
-
-                if (byte & 128) == 0:
-                    break
 
-            self._in_packet['have_remaining'] = 1
-            self._in_packet['to_process'] = self._in_packet['remaining_length']
+        if self._in_body is None:
+            self._in_end += nbytes
+            return self._packet_split()
 
-        while self._in_packet['to_process'] > 0:
-            try:
-                data = self._sock.recv(self._in_packet['to_process'])
-            except socket.error as err:
-                if err.errno == EAGAIN:
-                    return MQTT_ERR_AGAIN
-                print(err)
-                return 1
-            else:
-                self._in_packet['to_process'] = self._in_packet['to_process'] - len(data)
-                self._in_packet['packet'] = self._in_packet['packet'] + data
-
-        # All data for this packet is read.
-        self._in_packet['pos'] = 0
-        rc = self._packet_handle()
-
-        # Free data and reset values
-        self._in_packet = dict(
-            command=0,
-            have_remaining=0,
-            remaining_count=[],
-            remaining_mult=1,
-            remaining_length=0,
-            packet=b"",
-            to_process=0,
-            pos=0)
-
-        self._last_msg_in = time.time()
+        self._in_body_pos += nbytes
+        if self._in_body_pos < len(self._in_body):
+            return MQTT_ERR_SUCCESS
+        body = self._in_body
+        self._in_body = None
+        return self._packet_handle(self._in_command, memoryview(body))
+
+    def _packet_split(self):
+        # Carve complete packets out of _in_buf. Each one is handed on as a
+        # memoryview into the buffer, so nothing is copied; the buffer is only
+        # ever overwritten, never resized, so those views stay valid until the
+        # next read. _packet_handle() may end up in _connect_retry() (CONNACK
+        # downgrade) or close the socket from a callback, in which case the
+        # rest of the buffer belongs to a dead connection.
+        buf = self._in_buf
+        end = self._in_end
+        frames, pos, remaining_length, start = split_frames(buf, self._in_start, end)
+        rc = MQTT_ERR_SUCCESS
+        for command, body_start, body_end in frames:
+            self._in_start = body_end
+            rc = self._packet_handle(command, self._in_view[body_start:body_end])
+            if rc or buf is not self._in_buf or self._sock is None:
+                return rc
+
+        if remaining_length < 0:
+            if start < 0:
+                return MQTT_ERR_PROTOCOL
+            # Length bytes not all here yet.
+        elif start - pos + remaining_length > len(buf):
+            # Will never fit, move what we have into a body of its own.
+            self._in_command = buf[pos]
+            self._in_body = bytearray(remaining_length)
+            self._in_body_pos = end - start
+            self._in_body[:self._in_body_pos] = self._in_view[start:end]
+            pos = end
+
+        # Keep the partial packet, if any, at the front of the buffer so the
+        # next recv() has the rest of it to fill.
+        if pos == end:
+            self._in_start = self._in_end = 0
+        elif pos > 0:
+            buf[:end-pos] = buf[pos:end]
+            self._in_start = 0
+            self._in_end = end - pos
         return rc
 
     def _packet_write(self):
-        print("_packet_write")
-
-        while self._current_out_packet:
-            packet = self._current_out_packet
-
-            try:
-                write_length = self._sock.send(packet['packet'][packet['pos']:])
-            except AttributeError:
-                return MQTT_ERR_SUCCESS
-            except socket.error as err:
-                if err.errno == EAGAIN:
-                    return MQTT_ERR_AGAIN
-                print(err)
-                return 1
-
-            if write_length > 0:
-                packet['to_process'] = packet['to_process'] - write_length
-                packet['pos'] = packet['pos'] + write_length
-
-                if packet['to_process'] == 0:
-                    if (packet['command'] & 0xF0) == PUBLISH and packet['qos'] == 0:
-                        if self.on_publish:
-                            self._in_callback = True
-                            self.on_publish(self, self._userdata, packet['mid'])
-                            self._in_callback = False
-
-                    if (packet['command'] & 0xF0) == DISCONNECT:
-                        self._last_msg_out = time.time()
-                        if self.on_disconnect:
-                            self._in_callback = True
-                            self.on_disconnect(self, self._userdata, 0)
-                            self._in_callback = False
-
-                        if self._sock:
-                            self._sock.close()
-                            self._sock = None
-                        return MQTT_ERR_SUCCESS
-
-                    if len(self._out_packet) > 0:
-                        self._current_out_packet = self._out_packet.pop(0)
-                    else:
-                        self._current_out_packet = None
-            else:
-                break
+        # Hand as much of the queue as possible to the kernel in one sendmsg()
+        # call, so a run of small packets (PUBACKs, short PUBLISHes) costs one
+        # syscall rather than one each. A packet the kernel only took part of
+        # stays at the head of the queue with pos marking how far it got, and
+        # is resent from a memoryview at that offset rather than a copy.
+        # Packets are taken off the queue under _out_packet_mutex, but the
+        # callbacks for them are made once it has been released, so that they
+        # can queue more.
+        # The control lane goes ahead of the publish lane, except that a
+        # PUBLISH the kernel has taken part of must be finished first.
+        if self._store is not None:
+            self._store.commit()
+        control = self._out_control
+        out = self._out_packet
+        done = []
+        rc = MQTT_ERR_SUCCESS
+        flushed_bytes = 0
+        with self._out_packet_mutex:
+            while control or out:
+                if out and out[0].pos:
+                    runs = ((out, 0, 1), (control, 0, None), (out, 1, None))
+                else:
+                    runs = ((control, 0, None), (out, 0, None))
+                buffers = []
+                lanes = []
+                for (lane, first, last) in runs:
+                    for packet in itertools.islice(lane, first, last):
+                        if packet.pos:
+                            buffers.append(memoryview(packet.packet)[packet.pos:])
+                        else:
+                            buffers.append(packet.packet)
+                        lanes.append(lane)
+                        if len(buffers) == SENDMSG_MAX_BUFFERS:
+                            break
+                    if len(buffers) == SENDMSG_MAX_BUFFERS:
+                        break
 
-        self._last_msg_out = time.time()
-        print("self._current_out_packet =", self._current_out_packet)
-        return MQTT_ERR_SUCCESS
+                try:
+                    write_length = self._sock_sendmsg(buffers)
+                except AttributeError:
+                    return MQTT_ERR_SUCCESS
+                except socket.error as err:
+                    if err.errno != EAGAIN:
+                        self._easy_log(MQTT_LOG_ERR, "Failed to send on socket: %s", err)
+                        rc = 1
+                    break
 
-    def _easy_log(self, level, buf):
-        if self.on_log:
-            self.on_log(self, self._userdata, level, buf)
-
-    def _check_keepalive(self):
-        now = time.time()
-        last_msg_out = self._last_msg_out
-        last_msg_in = self._last_msg_in
-        if (self._sock is not None or self._ssl is not None) and (now - last_msg_out >= self._keepalive or now - last_msg_in >= self._keepalive):
-            if self._state == mqtt_cs_connected and self._ping_t == 0:
-                self._send_pingreq()
-                self._last_msg_out = now
-                self._last_msg_in = now
-            else:
-                if self._sock:
-                    self._sock.close()
-                    self._sock = None
+                if write_length <= 0:
+                    break
 
-                if self._state == mqtt_cs_disconnecting:
-                    rc = MQTT_ERR_SUCCESS
+                self._write_calls += 1
+                self._write_bytes += write_length
+                flushed_bytes += write_length
+                for lane in lanes:
+                    packet = lane[0]
+                    if packet.topic is not None:
+                        # Once any of it is written it can't be replaced.
+                        if self._coalesce_pending.get(packet.topic) is packet:
+                            del self._coalesce_pending[packet.topic]
+                        packet.topic = None
+                    if write_length < packet.to_process:
+                        packet.to_process = packet.to_process - write_length
+                        packet.pos = packet.pos + write_length
+                        break
+
+                    write_length = write_length - packet.to_process
+                    lane.popleft()
+                    done.append(packet)
+                    if write_length == 0:
+                        break
+
+        if flushed_bytes:
+            self._last_msg_out = self._now
+            self._last_write = (flushed_bytes, len(done))
+            self._write_packets += len(done)
+            if self._log_mask & MQTT_LOG_DEBUG:
+                self._easy_log(MQTT_LOG_DEBUG, "Flushed %d bytes, %d packets", flushed_bytes, len(done))
+
+        for packet in done:
+            if packet.info is not None:
+                # A QoS 0 PUBLISH is done once it is written.
+                if isinstance(packet.info, list):
+                    for info in packet.info:
+                        self._publish_complete(info)
                 else:
-                    rc = 1
+                    self._publish_complete(packet.info)
+
+            if (packet.command & 0xF0) == DISCONNECT:
                 if self.on_disconnect:
                     self._in_callback = True
-                    self.on_disconnect(self, self._userdata, rc)
+                    self.on_disconnect(self, self._userdata, 0)
                     self._in_callback = False
 
-    def _mid_generate(self):
-        self._last_mid = self._last_mid + 1
-        if self._last_mid == 65536:
-            self._last_mid = 1
-        return self._last_mid
-
-    def _topic_wildcard_len_check(self, topic):
-        # Search for + or # in a topic. Return MQTT_ERR_INVAL if found.
-         # Also returns MQTT_ERR_INVAL if the topic string is too long.
-         # Returns MQTT_ERR_SUCCESS if everything is fine.
-        if '+' in topic or '#' in topic or len(topic) == 0 or len(topic) > 65535:
-            return MQTT_ERR_INVAL
-        else:
-            return MQTT_ERR_SUCCESS
-
-    def _send_pingreq(self):
-        self._easy_log(MQTT_LOG_DEBUG, "Sending PINGREQ")
-        rc = self._send_simple_command(PINGREQ)
-        if rc == MQTT_ERR_SUCCESS:
-            self._ping_t = time.time()
-        return rc
-
-    def _send_pingresp(self):
-        self._easy_log(MQTT_LOG_DEBUG, "Sending PINGRESP")
-        return self._send_simple_command(PINGRESP)
-
-    def _send_puback(self, mid):
-        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBACK (Mid: "+str(mid)+")")
-        return self._send_command_with_mid(PUBACK, mid, False)
+                if self._sock:
+                    self._sock.close()
+                    self._sock = None
+                return MQTT_ERR_SUCCESS
 
-    def _send_pubcomp(self, mid):
-        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBCOMP (Mid: "+str(mid)+")")
-        return self._send_command_with_mid(PUBCOMP, mid, False)
+            packet.packet = None
+            packet.info = None
+            if len(self._out_packet_pool) < OUT_PACKET_POOL_SIZE:
+                self._out_packet_pool.append(packet)
 
-    def _pack_remaining_length(self, packet, remaining_length):
-        remaining_bytes = []
-        while True:
-            byte = remaining_length % 128
-            remaining_length = remaining_length // 128
-            # If there are more digits to encode, set the top bit of this digit
-            if remaining_length > 0:
-                byte = byte | 0x80
-
-            remaining_bytes.append(byte)
-            packet.extend(struct.pack("!B", byte))
-            if remaining_length == 0:
-                # FIXME - this doesn't deal with incorrectly large payloads
-                return packet
-
-    def _pack_str16(self, packet, data):
-        if isinstance(data, bytearray) or isinstance(data, bytes):
-            packet.extend(struct.pack("!H", len(data)))
-            packet.extend(data)
-        elif isinstance(data, str):
-            udata = data.encode('utf-8')
-            pack_format = "!H" + str(len(udata)) + "s"
-            packet.extend(struct.pack(pack_format, len(udata), udata))
-        else:
-            raise TypeError
+        if rc:
+            return rc
+        if control or out:
+            return MQTT_ERR_AGAIN
+        return MQTT_ERR_SUCCESS
 
-    def _send_publish(self, mid, topic, payload=None, qos=0, retain=False, dup=False):
-        if self._sock is None and self._ssl is None:
+    def _sock_sendmsg(self, buffers):
+        if _HAVE_SENDMSG:
+            return self._sock.sendmsg(buffers)
+        # No scatter-gather (Windows), one joined copy is still one syscall.
+        return self._sock.send(b"".join(buffers))
+
+    def _thread_main(self):
+        self.loop_forever(retry_first_connection=True)
+
+    def _easy_log(self, level, fmt, *args):
+        # fmt is only formatted with args if a sink wants this level, and the
+        # logger does its own formatting, only if its level lets the message
+        # through. Per packet callers test self._log_mask first, so that with
+        # logging off they don't even build the arguments.
+        if not self._log_mask & level:
+            return
+        if self._on_log is not None:
+            self._on_log(self, self._userdata, level, fmt % args if args else fmt)
+        if self._logger is not None:
+            self._logger.log(LOGGING_LEVEL[level], fmt, *args)
+
+    def _log_update(self):
+        # _log_mask has a bit set for each level that is passed on, none if
+        # there is nowhere to pass it.
+        mask = 0
+        if self._on_log is not None or self._logger is not None:
+            for level in reversed(_LOG_SEVERITY):
+                mask |= level
+                if level == self._log_level:
+                    break
+        self._log_mask = mask
+
+    def _next_deadline(self):
+        # As for the session, or sooner if the offline queue can be drained.
+        deadline = MQTTSession._next_deadline(self)
+        if self._offline:
+            due = self._offline_due()
+            if due is not None and (deadline is None or due < deadline):
+                deadline = due
+        return deadline
+
+    def _loop_timeout(self, timeout):
+        # Seconds until loop_misc() next has work to do, no more than timeout.
+        deadline = self._next_deadline()
+        if deadline is None:
+            return timeout
+        return max(0.0, min(timeout, deadline - time_func()))
+
+    def _packet_queue(self, command, packet, mid, qos, info=None, topic=None):
+        # While coalescing, if an earlier QoS 0 PUBLISH on topic hasn't been
+        # written yet, its packet takes this one's place in the queue,
+        # otherwise this one can be replaced until it is written.
+        if self._sock is None:
             return MQTT_ERR_NO_CONN
-
-        utopic = topic.encode('utf-8')
-        command = PUBLISH | ((dup&0x1)<<3) | (qos<<1) | retain
-        packet = bytearray()
-        packet.extend(struct.pack("!B", command))
-        if payload is None:
-            remaining_length = 2+len(utopic)
-            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d"+str(dup)+", q"+str(qos)+", r"+str(int(retain))+", m"+str(mid)+", '"+topic+"' (NULL payload)")
-        else:
-            if isinstance(payload, str):
-                upayload = payload.encode('utf-8')
-                payloadlen = len(upayload)
-            elif isinstance(payload, bytearray):
-                payloadlen = len(payload)
-            elif isinstance(payload, unicode):
-                upayload = payload.encode('utf-8')
-                payloadlen = len(upayload)
-
-            remaining_length = 2+len(utopic) + payloadlen
-            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d"+str(dup)+", q"+str(qos)+", r"+str(int(retain))+", m"+str(mid)+", '"+topic+"', ... ("+str(payloadlen)+" bytes)")
-
-        if qos > 0:
-            # For message id
-            remaining_length = remaining_length + 2
-
-        self._pack_remaining_length(packet, remaining_length)
-        self._pack_str16(packet, topic)
-
-        if qos > 0:
-            # For message id
-            packet.extend(struct.pack("!H", mid))
-
-        if payload is not None:
-            if isinstance(payload, str):
-                pack_format = str(payloadlen) + "s"
-                packet.extend(struct.pack(pack_format, upayload))
-            elif isinstance(payload, bytearray):
-                packet.extend(payload)
-            elif isinstance(payload, unicode):
-                pack_format = str(payloadlen) + "s"
-                packet.extend(struct.pack(pack_format, upayload))
-            else:
-                raise TypeError('payload must be a string, unicode or a bytearray.')
-
-        return self._packet_queue(PUBLISH, packet, mid, qos)
-
-    def _send_pubrec(self, mid):
-        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBREC (Mid: "+str(mid)+")")
-        return self._send_command_with_mid(PUBREC, mid, False)
-
-    def _send_pubrel(self, mid, dup=False):
-        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBREL (Mid: "+str(mid)+")")
-        return self._send_command_with_mid(PUBREL|2, mid, dup)
-
-    def _send_command_with_mid(self, command, mid, dup):
-        # For PUBACK, PUBCOMP, PUBREC, and PUBREL
-        if dup:
-            command = command | 8
-
-        remaining_length = 2
-        packet = struct.pack('!BBH', command, remaining_length, mid)
-        return self._packet_queue(command, packet, mid, 1)
-
-    def _send_simple_command(self, command):
-        # For DISCONNECT, PINGREQ and PINGRESP
-        remaining_length = 0
-        packet = struct.pack('!BB', command, remaining_length)
-        return self._packet_queue(command, packet, 0, 0)
-
-    def _send_connect(self, keepalive, clean_session):
-        print("_send_connect")
-        if self._protocol == MQTTv31:
-            protocol = PROTOCOL_NAMEv31
-            proto_ver = 3
-        else:
-            protocol = PROTOCOL_NAMEv311
-            proto_ver = 4
-        remaining_length = 2+len(protocol) + 1+1+2 + 2+len(self._client_id)
-        connect_flags = 0
-        if clean_session:
-            connect_flags = connect_flags | 0x02
-
-        if self._will:
-            if self._will_payload is not None:
-                remaining_length = remaining_length + 2+len(self._will_topic) + 2+len(self._will_payload)
-            else:
-                remaining_length = remaining_length + 2+len(self._will_topic) + 2
-
-            connect_flags = connect_flags | 0x04 | ((self._will_qos&0x03) << 3) | ((self._will_retain&0x01) << 5)
-
-        if self._username:
-            remaining_length = remaining_length + 2+len(self._username)
-            connect_flags = connect_flags | 0x80
-            if self._password:
-                connect_flags = connect_flags | 0x40
-                remaining_length = remaining_length + 2+len(self._password)
-
-        command = CONNECT
-        packet = bytearray()
-        packet.extend(struct.pack("!B", command))
-
-        self._pack_remaining_length(packet, remaining_length)
-        packet.extend(struct.pack("!H"+str(len(protocol))+"sBBH", len(protocol), protocol, proto_ver, connect_flags, keepalive))
-
-        self._pack_str16(packet, self._client_id)
-
-        if self._will:
-            self._pack_str16(packet, self._will_topic)
-            if self._will_payload is None or len(self._will_payload) == 0:
-                packet.extend(struct.pack("!H", 0))
-            else:
-                self._pack_str16(packet, self._will_payload)
-
-        if self._username:
-            self._pack_str16(packet, self._username)
-
-            if self._password:
-                self._pack_str16(packet, self._password)
-
-        self._keepalive = keepalive
-        return self._packet_queue(command, packet, 0, 0)
-
-    def _send_disconnect(self):
-        return self._send_simple_command(DISCONNECT)
-
-    def _send_subscribe(self, dup, topics):
-        print("_send_subscribe")
-        remaining_length = 2
-        for t in topics:
-            remaining_length = remaining_length + 2+len(t[0])+1
-
-        command = SUBSCRIBE | (dup<<3) | (1<<1)
-        packet = bytearray()
-        packet.extend(struct.pack("!B", command))
-        self._pack_remaining_length(packet, remaining_length)
-        local_mid = self._mid_generate()
-        packet.extend(struct.pack("!H", local_mid))
-        for t in topics:
-            self._pack_str16(packet, t[0])
-            packet.extend(struct.pack("B", t[1]))
-        return (self._packet_queue(command, packet, local_mid, 1), local_mid)
-
-    def _send_unsubscribe(self, dup, topics):
-        remaining_length = 2
-        for t in topics:
-            remaining_length = remaining_length + 2+len(t)
-
-        command = UNSUBSCRIBE | (dup<<3) | (1<<1)
-        packet = bytearray()
-        packet.extend(struct.pack("!B", command))
-        self._pack_remaining_length(packet, remaining_length)
-        local_mid = self._mid_generate()
-        packet.extend(struct.pack("!H", local_mid))
-        for t in topics:
-            self._pack_str16(packet, t)
-        return (self._packet_queue(command, packet, local_mid, 1), local_mid)
-
-    def _message_retry_check_actual(self, messages):
-        now = time.time()
-        for m in messages:
-            if m.timestamp + self._message_retry < now:
-                if m.state == mqtt_ms_wait_for_puback or m.state == mqtt_ms_wait_for_pubrec:
-                    m.timestamp = now
-                    m.dup = True
-                    self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
-                elif m.state == mqtt_ms_wait_for_pubrel:
-                    m.timestamp = now
-                    m.dup = True
-                    self._send_pubrec(m.mid)
-                elif m.state == mqtt_ms_wait_for_pubcomp:
-                    m.timestamp = now
-                    m.dup = True
-                    self._send_pubrel(m.mid, True)
-
-    def _message_retry_check(self):
-        self._message_retry_check_actual(self._out_messages)
-        self._message_retry_check_actual(self._in_messages)
-
-    def _messages_reconnect_reset_out(self):
-        self._inflight_messages = 0
-        for m in self._out_messages:
-            m.timestamp = 0
-            if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
-                if m.qos == 0:
-                    m.state = mqtt_ms_publish
-                elif m.qos == 1:
-                    #self._inflight_messages = self._inflight_messages + 1
-                    if m.state == mqtt_ms_wait_for_puback:
-                        m.dup = True
-                    m.state = mqtt_ms_publish
-                elif m.qos == 2:
-                    #self._inflight_messages = self._inflight_messages + 1
-                    if m.state == mqtt_ms_wait_for_pubcomp:
-                        m.state = mqtt_ms_resend_pubrel
-                        m.dup = True
+        if not self._coalesce:
+            topic = None
+        elif topic is not None:
+            with self._out_packet_mutex:
+                mpkt = self._coalesce_pending.get(topic)
+                if mpkt is not None:
+                    mpkt.packet = packet
+                    mpkt.to_process = len(packet)
+                    if isinstance(mpkt.info, list):
+                        mpkt.info.append(info)
                     else:
-                        if m.state == mqtt_ms_wait_for_pubrec:
-                            m.dup = True
-                        m.state = mqtt_ms_publish
-            else:
-                m.state = mqtt_ms_queued
+                        mpkt.info = [mpkt.info, info]
+                    self._coalesced += 1
+                    return MQTT_ERR_SUCCESS
 
-    def _messages_reconnect_reset_in(self):
-        for m in self._in_messages:
-            m.timestamp = 0
-            if m.qos != 2:
-                self._in_messages.pop(self._in_messages.index(m))
+        try:
+            mpkt = self._out_packet_pool.pop()
+        except IndexError:
+            mpkt = _OutPacket()
+        mpkt.set(command, packet, mid, qos, info)
+
+        # Acknowledgements and PINGREQs go in a lane of their own that is
+        # written first, so that they aren't held up behind a burst of
+        # PUBLISHes and the broker doesn't time us out.
+        with self._out_packet_mutex:
+            if command & 0xF0 in _PRIORITY_COMMANDS:
+                lane = self._out_control
+                lane.append(mpkt)
+                if len(lane) > self._out_control_max:
+                    self._out_control_max = len(lane)
             else:
-                # Preserve current state
-                pass
+                lane = self._out_packet
+                lane.append(mpkt)
+                if len(lane) > self._out_packet_max:
+                    self._out_packet_max = len(lane)
+                if topic is not None:
+                    mpkt.topic = topic
+                    self._coalesce_pending[topic] = mpkt
+        if self._group is not None:
+            self._group._touch(self)
+
+        if self._thread is not None and threading.current_thread() is not self._thread:
+            # Leave the writing to the network thread, breaking it out of
+            # select() if it isn't already on its way.
+            self._wakeup.set()
+            return MQTT_ERR_SUCCESS
 
-    def _messages_reconnect_reset(self):
-        self._messages_reconnect_reset_out()
-        self._messages_reconnect_reset_in()
-
-    def _packet_queue(self, command, packet, mid, qos):
-        print("_packet_queue")
-        mpkt = dict(
-            command = command,
-            mid = mid,
-            qos = qos,
-            pos = 0,
-            to_process = len(packet),
-            packet = packet)
-
-        self._out_packet.append(mpkt)
-        if self._current_out_packet is None and len(self._out_packet) > 0:
-            self._current_out_packet = self._out_packet.pop(0)
-
-        print("self._out_packet =", self._out_packet)
-        # Write a single byte to sockpairW (connected to sockpairR) to break
-        # out of select() if in threaded mode.
-        #try:
-        #    self._sockpairW.send(sockpair_data)
-        #except socket.error as err:
-        #    if err.errno != EAGAIN:
-        #        raise
-        print("self._in_callback =", self._in_callback)
-        if not self._in_callback: 
+        if not self._in_callback and not self._write_deferred:
             return self.loop_write()
         else:
-            print(MQTT_ERR_SUCCESS)
             return MQTT_ERR_SUCCESS
 
-    def _packet_handle(self):
-        print("_packet_handle")
-        cmd = self._in_packet['command']&0xF0
-        if cmd == PINGREQ:
-            return self._handle_pingreq()
-        elif cmd == PINGRESP:
-            return self._handle_pingresp()
-        elif cmd == PUBACK:
-            return self._handle_pubackcomp("PUBACK")
-        elif cmd == PUBCOMP:
-            return self._handle_pubackcomp("PUBCOMP")
-        elif cmd == PUBLISH:
-            return self._handle_publish()
-        elif cmd == PUBREC:
-            return self._handle_pubrec()
-        elif cmd == PUBREL:
-            return self._handle_pubrel()
-        elif cmd == CONNACK:
-            return self._handle_connack()
-        elif cmd == SUBACK:
-            return self._handle_suback()
-        elif cmd == UNSUBACK:
-            return self._handle_unsuback()
-        else:
-            # If we don't recognise the command, return an error straight away.
-            self._easy_log(MQTT_LOG_ERR, "Error: Unrecognised command "+str(cmd))
-            return MQTT_ERR_PROTOCOL
-
-    def _handle_pingreq(self):
-        if self._strict_protocol:
-            if self._in_packet['remaining_length'] != 0:
-                return MQTT_ERR_PROTOCOL
-
-        self._easy_log(MQTT_LOG_DEBUG, "Received PINGREQ")
-        return self._send_pingresp()
-
-    def _handle_pingresp(self):
-        if self._strict_protocol:
-            if self._in_packet['remaining_length'] != 0:
-                return MQTT_ERR_PROTOCOL
-
-        # No longer waiting for a PINGRESP.
-        self._ping_t = 0
-        self._easy_log(MQTT_LOG_DEBUG, "Received PINGRESP")
-        return MQTT_ERR_SUCCESS
-
-    def _handle_connack(self):
-        print("_handle_conneck")
-        if self._strict_protocol:
-            if self._in_packet['remaining_length'] != 2:
-                return MQTT_ERR_PROTOCOL
-
-        if len(self._in_packet['packet']) != 2:
-            return MQTT_ERR_PROTOCOL
-
-        (flags, result) = struct.unpack("!BB", self._in_packet['packet'])
-        if result == CONNACK_REFUSED_PROTOCOL_VERSION and self._protocol == MQTTv311:
-            self._easy_log(MQTT_LOG_DEBUG, "Received CONNACK ("+str(flags)+", "+str(result)+"), attempting downgrade to MQTT v3.1.")
-            # Downgrade to MQTT v3.1
-            self._protocol = MQTTv31
-            return self.reconnect()
-
-        if result == 0:
-            self._state = mqtt_cs_connected
-
-        self._easy_log(MQTT_LOG_DEBUG, "Received CONNACK ("+str(flags)+", "+str(result)+")")
+    def _on_connack(self, flags, result):
         if self.on_connect:
             self._in_callback = True
 
@@ -1622,239 +2466,431 @@ class Client(object):
                 flags_dict['session present'] = flags & 0x01
                 self.on_connect(self, self._userdata, flags_dict, result)
             self._in_callback = False
-        if result == 0:
-            rc = 0
-            for m in self._out_messages:
-                m.timestamp = time.time()
-                if m.state == mqtt_ms_queued:
-                    self.loop_write() # Process outgoing messages that have just been queued up
-                    return MQTT_ERR_SUCCESS
-
-                if m.qos == 0:
-                    self._in_callback = True # Don't call loop_write after _send_publish()
-                    rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
-                    self._in_callback = False
-                    if rc != 0:
-                        return rc
-                elif m.qos == 1:
-                    if m.state == mqtt_ms_publish:
-                        self._inflight_messages = self._inflight_messages + 1
-                        m.state = mqtt_ms_wait_for_puback
-                        self._in_callback = True # Don't call loop_write after _send_publish()
-                        rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
-                        self._in_callback = False
-                        if rc != 0:
-                            return rc
-                elif m.qos == 2:
-                    if m.state == mqtt_ms_publish:
-                        self._inflight_messages = self._inflight_messages + 1
-                        m.state = mqtt_ms_wait_for_pubrec
-                        self._in_callback = True # Don't call loop_write after _send_publish()
-                        rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
-                        self._in_callback = False
-                        if rc != 0:
-                            return rc
-                    elif m.state == mqtt_ms_resend_pubrel:
-                        self._inflight_messages = self._inflight_messages + 1
-                        m.state = mqtt_ms_wait_for_pubcomp
-                        self._in_callback = True # Don't call loop_write after _send_pubrel()
-                        rc = self._send_pubrel(m.mid, m.dup)
-                        self._in_callback = False
-                        if rc != 0:
-                            return rc
-                self.loop_write() # Process outgoing messages that have just been queued up
-            return rc
-        elif result > 0 and result < 6:
-            return MQTT_ERR_CONN_REFUSED
-        else:
-            return MQTT_ERR_PROTOCOL
-
-    def _handle_suback(self):
-        self._easy_log(MQTT_LOG_DEBUG, "Received SUBACK")
-        pack_format = "!H" + str(len(self._in_packet['packet'])-2) + 's'
-        (mid, packet) = struct.unpack(pack_format, self._in_packet['packet'])
-        pack_format = "!" + "B"*len(packet)
-        granted_qos = struct.unpack(pack_format, packet)
 
+    def _on_suback(self, mid, granted_qos):
         if self.on_subscribe:
             self._in_callback = True
             self.on_subscribe(self, self._userdata, mid, granted_qos)
             self._in_callback = False
 
-        return MQTT_ERR_SUCCESS
-
-    def _handle_publish(self):
-        rc = 0
-        print("_handle_publish")
-        header = self._in_packet['command']
-        message = MQTTMessage()
-        message.dup = (header & 0x08)>>3
-        message.qos = (header & 0x06)>>1
-        message.retain = (header & 0x01)
-
-        pack_format = "!H" + str(len(self._in_packet['packet'])-2) + 's'
-        (slen, packet) = struct.unpack(pack_format, self._in_packet['packet'])
-        pack_format = '!' + str(slen) + 's' + str(len(packet)-slen) + 's'
-        (message.topic, packet) = struct.unpack(pack_format, packet)
+    def _on_unsuback(self, mid):
+        if self.on_unsubscribe:
+            self._in_callback = True
+            self.on_unsubscribe(self, self._userdata, mid)
+            self._in_callback = False
 
-        if len(message.topic) == 0:
-            return MQTT_ERR_PROTOCOL
+    def _inflight_rtt(self, rtt):
+        # Record the round trip time of an acknowledged message and, in
+        # adaptive mode, resize the window from it. Messages already beyond
+        # a shrunk window are left to complete.
+        self._rtt_samples.append(rtt)
+        if self._inflight_target is None:
+            return
+        window = self._max_inflight_messages
+        if rtt > self._inflight_target:
+            self._inflight_slow_start = False
+            # Acks for messages sent before a cut arrive late too, so wait a
+            # round trip before cutting again.
+            if self._now >= self._inflight_hold and window > self._inflight_min:
+                self._max_inflight_messages = max(window // 2, self._inflight_min)
+                self._inflight_decreases += 1
+                self._inflight_hold = self._now + rtt
+                self._inflight_acks = 0
+        elif self._out_message_queue and window < self._inflight_limit:
+            if not self._inflight_slow_start:
+                self._inflight_acks += 1
+                if self._inflight_acks < window:
+                    return
+                self._inflight_acks = 0
+            self._max_inflight_messages = window + 1
+            self._inflight_increases += 1
+
+    def _time(self):
+        return time_func()
+
+    def _publish_complete(self, info):
+        info._published = True
+        if self.on_publish:
+            self._in_callback = True
+            self.on_publish(self, self._userdata, info.mid)
+            self._in_callback = False
 
+    def _topic_resolve(self, topic):
+        # Return (decoded topic, matching filtered callbacks) for the raw
+        # topic of an incoming PUBLISH, from the cache if possible.
+        key = bytes(topic)
+        cache = self._topic_cache
+        entry = cache.pop(key, None)
+        if entry is not None:
+            # Put it back as the most recently used.
+            cache[key] = entry
+            self._topic_cache_hits += 1
+            return entry
+
+        self._topic_cache_misses += 1
         if sys.version_info[0] >= 3:
-            message.topic = message.topic.decode('utf-8')
-
-        if message.qos > 0:
-            pack_format = "!H" + str(len(packet)-2) + 's'
-            (message.mid, packet) = struct.unpack(pack_format, packet)
-
-        message.payload = packet
-
-        self._easy_log(
-            MQTT_LOG_DEBUG,
-            "Received PUBLISH (d"+str(message.dup)+
-            ", q"+str(message.qos)+", r"+str(message.retain)+
-            ", m"+str(message.mid)+", '"+message.topic+
-            "', ...  ("+str(len(message.payload))+" bytes)")
-
-        message.timestamp = time.time()
-        if message.qos == 0:
-            self._handle_on_message(message)
-            return MQTT_ERR_SUCCESS
-        elif message.qos == 1:
-            rc = self._send_puback(message.mid)
-            self._handle_on_message(message)
-            return rc
-        elif message.qos == 2:
-            rc = self._send_pubrec(message.mid)
-            message.state = mqtt_ms_wait_for_pubrel
-            self._in_message_mutex.acquire()
-            self._in_messages.append(message)
-            self._in_message_mutex.release()
-            return rc
+            topic = _intern(key.decode('utf-8'))
         else:
-            return MQTT_ERR_PROTOCOL
-
-    def _handle_pubrel(self):
-        if self._strict_protocol:
-            if self._in_packet['remaining_length'] != 2:
-                return MQTT_ERR_PROTOCOL
-
-        if len(self._in_packet['packet']) != 2:
-            return MQTT_ERR_PROTOCOL
-
-        mid = struct.unpack("!H", self._in_packet['packet'])
-        mid = mid[0]
-        self._easy_log(MQTT_LOG_DEBUG, "Received PUBREL (Mid: "+str(mid)+")")
-
-        self._in_message_mutex.acquire()
-        for i in range(len(self._in_messages)):
-            if self._in_messages[i].mid == mid:
-
-                # Only pass the message on if we have removed it from the queue - this
-                # prevents multiple callbacks for the same message.
-                self._handle_on_message(self._in_messages[i])
-                self._in_messages.pop(i)
-                self._inflight_messages = self._inflight_messages - 1
-                if self._max_inflight_messages > 0:
-                    rc = self._update_inflight()
-                    if rc != MQTT_ERR_SUCCESS:
-                        return rc
+            topic = _intern(key)
+        entry = (topic, self._on_message_filtered.match(topic))
+        if self._topic_cache_size > 0:
+            if len(cache) >= self._topic_cache_size:
+                del cache[next(iter(cache))]
+            cache[key] = entry
+        return entry
+
+    def _handle_on_message(self, message, callbacks=None):
+        # callbacks is the result of matching message.topic, if the caller
+        # already has it.
+        if self._last_values is not None:
+            self._last_value_put(message)
+        if callbacks is None:
+            callbacks = self._on_message_filtered.match(message.topic)
+        if callbacks:
+            self._in_callback = True
+            for callback in callbacks:
+                callback(self, self._userdata, message)
+            self._in_callback = False
+        elif self.on_message:
+            self._in_callback = True
+            self.on_message(self, self._userdata, message)
+            self._in_callback = False
 
-                self._in_message_mutex.release()
-                return self._send_pubcomp(mid)
 
-        return MQTT_ERR_SUCCESS
+class ClientGroup(object):
+    """Drives any number of Clients from one thread, through one selector.
+
+    Every client socket in the group is registered with a single selector,
+    and the keepalive, retry and reconnect deadlines of all the clients are
+    kept in one heap, so a pass through loop() costs one select() however
+    many clients there are, plus work for the clients that have something
+    to do. Clients in a group must not also be driven by their own loop()
+    or loop_start(), and, as with loop(), must only be used from the thread
+    that calls the group's loop().
+
+    group = ClientGroup()
+    for i in range(1000):
+        client = Client("sensor-%d" % i)
+        client.on_message = on_message
+        group.add(client)
+        client.connect_async("broker.example.com")
+    group.loop_forever()
+
+    Connecting never blocks the loop. The broker's name is looked up on a
+    thread of its own, once for all the clients connecting to it, and the
+    connects themselves are non-blocking, see Client.reconnect(). A client
+    whose connection is lost, or cannot be made, is tried again
+    reconnect_delay seconds later, as loop_forever() does, until
+    disconnect() is called on it.
+    """
+    def __init__(self, reconnect_delay=1.0):
+        self.reconnect_delay = reconnect_delay
+        self._selector = selectors.DefaultSelector()
+        self._clients = set()
+        # Clients whose socket, output or deadlines may have changed since
+        # the group last looked. Added to by Client._packet_queue(), which
+        # also covers retry deadlines: one is only set when a packet is sent.
+        self._dirty = set()
+        # (deadline, seq, client). A client's live entry is the one whose
+        # deadline is client._group_deadline, the others are skipped when
+        # they come up. An entry is only added when a client's deadline moves
+        # earlier, one that moves later is found out when it comes due.
+        self._timers = []
+        self._timer_seq = itertools.count()
+        # Clients without a connection that the group is connecting: waiting
+        # for the timer, for their broker's addresses or for a connect to
+        # finish.
+        self._reconnects = set()
+        # Clients waiting for their broker's addresses, by (host, port), and
+        # the lookups that have finished, put there by the resolver thread,
+        # which then wakes the selector.
+        self._resolving = {}
+        self._resolved = collections.deque()
+        self._wakeup = _Wakeup()
+        self._selector.register(self._wakeup.fileno(), selectors.EVENT_READ, None)
+        self._now = time_func()
+
+    def __len__(self):
+        return len(self._clients)
+
+    def add(self, client):
+        """Add client to the group. It may already be connected, or be
+        connected later with connect(), connect_async() or reconnect()."""
+        if client._group is self:
+            return
+        if client._group is not None:
+            raise ValueError('Client is already in a group.')
+        if client._thread is not None:
+            raise ValueError('Client has its own network thread.')
+        client._group = self
+        client._group_fd = -1
+        client._group_write = False
+        client._group_deadline = None
+        self._clients.add(client)
+        self._dirty.add(client)
+
+    def remove(self, client):
+        """Take client out of the group, leaving its connection open."""
+        if client._group is not self:
+            raise ValueError('Client is not in this group.')
+        if client._group_fd >= 0:
+            self._unregister(client)
+        if client._connecting:
+            for sock in client._connecting:
+                self._selector.unregister(sock.fileno())
+            client._connect_abort()
+        client._group = None
+        client._group_deadline = None
+        self._clients.discard(client)
+        self._dirty.discard(client)
+        self._reconnects.discard(client)
 
-    def _update_inflight(self):
-        # Dont lock message_mutex here
-        for m in self._out_messages:
-            if self._inflight_messages < self._max_inflight_messages:
-                if m.qos > 0 and m.state == mqtt_ms_queued:
-                    self._inflight_messages = self._inflight_messages + 1
-                    if m.qos == 1:
-                        m.state = mqtt_ms_wait_for_puback
-                    elif m.qos == 2:
-                        m.state = mqtt_ms_wait_for_pubrec
-                    rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
-                    if rc != 0:
-                        return rc
+    def loop(self, timeout=1.0, max_packets=1):
+        """Wait up to timeout seconds for network traffic on any client,
+        handle it, and then do whatever time based work has come due:
+        PINGREQs, retries, reconnects. Returns the number of clients that
+        had something to do."""
+        if timeout < 0.0:
+            raise ValueError('Invalid timeout.')
+        if self._dirty:
+            self._now = time_func()
+            self._update_dirty()
+
+        timers = self._timers
+        if timers:
+            timeout = max(0.0, min(timeout, timers[0][0] - time_func()))
+        events = self._selector.select(timeout)
+
+        # The one clock reading for everything done on this pass.
+        now = self._now = time_func()
+        for key, mask in events:
+            client = key.data
+            if client is None:
+                self._wakeup.clear()
+                self._resolved_handle()
+                continue
+            if client._group is not self:
+                continue
+            client._now = now
+            if client._sock is None:
+                if client._connecting:
+                    self._connect_ready(client, key.fd)
+            elif mask & selectors.EVENT_READ:
+                rc = client._loop_read(max_packets)
+                if rc == MQTT_ERR_SUCCESS and client._sock is not None and mask & selectors.EVENT_WRITE:
+                    client._loop_write(max_packets)
+            elif mask & selectors.EVENT_WRITE:
+                client._loop_write(max_packets)
+            self._update(client)
+
+        handled = len(events)
+        while timers and timers[0][0] <= now:
+            (deadline, seq, client) = heapq.heappop(timers)
+            if client._group is not self or deadline != client._group_deadline:
+                continue
+            client._group_deadline = None
+            client._now = now
+            if client._connecting:
+                self._connect_unregister(client)
+                client._connect_abort()
+                self._connect_failed(client, socket.timeout('timed out'))
+            elif client._sock is None:
+                self._reconnect(client)
             else:
-                return MQTT_ERR_SUCCESS
-        return MQTT_ERR_SUCCESS
-
-    def _handle_pubrec(self):
-        if self._strict_protocol:
-            if self._in_packet['remaining_length'] != 2:
-                return MQTT_ERR_PROTOCOL
-
-        mid = struct.unpack("!H", self._in_packet['packet'])
-        mid = mid[0]
-        self._easy_log(MQTT_LOG_DEBUG, "Received PUBREC (Mid: "+str(mid)+")")
-
-        for m in self._out_messages:
-            if m.mid == mid:
-                m.state = mqtt_ms_wait_for_pubcomp
-                m.timestamp = time.time()
-                return self._send_pubrel(mid, False)
-
-        return MQTT_ERR_SUCCESS
-
-    def _handle_unsuback(self):
-        if self._strict_protocol:
-            if self._in_packet['remaining_length'] != 2:
-                return MQTT_ERR_PROTOCOL
-
-        mid = struct.unpack("!H", self._in_packet['packet'])
-        mid = mid[0]
-        self._easy_log(MQTT_LOG_DEBUG, "Received UNSUBACK (Mid: "+str(mid)+")")
-        if self.on_unsubscribe:
-            self._in_callback = True
-            self.on_unsubscribe(self, self._userdata, mid)
-            self._in_callback = False
-        return MQTT_ERR_SUCCESS
-
-    def _handle_pubackcomp(self, cmd):
-        if self._strict_protocol:
-            if self._in_packet['remaining_length'] != 2:
-                return MQTT_ERR_PROTOCOL
+                due = client._next_deadline()
+                if due is not None and due > now:
+                    # Traffic since it was scheduled has pushed it back.
+                    self._schedule(client, due)
+                    continue
+                client._loop_misc()
+            self._update(client)
+            handled += 1
+        return handled
+
+    def loop_forever(self, timeout=1.0, max_packets=1):
+        """Call loop() until every client in the group has disconnected on
+        purpose, or has been removed."""
+        # The wakeup is always registered.
+        while len(self._selector.get_map()) > 1 or self._reconnects or self._resolving or self._dirty:
+            self.loop(timeout, max_packets)
+
+    def close(self):
+        """Remove every client and close the selector. The clients'
+        connections are left open, connects under way are abandoned."""
+        for client in list(self._clients):
+            self.remove(client)
+        self._selector.close()
+        self._wakeup.close()
+
+    def _touch(self, client):
+        self._dirty.add(client)
+
+    def _update_dirty(self):
+        dirty = self._dirty
+        while dirty:
+            self._update(dirty.pop())
+
+    def _update(self, client):
+        # Bring the selector registration and the timer for client into line
+        # with its socket, its output queue and its deadlines.
+        sock = client._sock
+        if sock is None:
+            if client._group_fd >= 0:
+                self._unregister(client)
+                # Its keepalive and retry deadlines no longer apply.
+                client._group_deadline = None
+                if client._state == mqtt_cs_connect_async:
+                    # Asked to connect again at once, see
+                    # Client._connect_retry().
+                    self._reconnect_at(client, self._now)
+                elif client._state != mqtt_cs_disconnecting:
+                    # Lost, try again after a while.
+                    self._reconnect_at(client, self._now + self.reconnect_delay)
+            elif client._state == mqtt_cs_connect_async and client not in self._reconnects:
+                self._reconnect_at(client, self._now)
+            return
+
+        fd = sock.fileno()
+        want_write = len(client._out_control) > 0 or len(client._out_packet) > 0
+        if fd != client._group_fd:
+            if client._group_fd >= 0:
+                self._unregister(client)
+            events = selectors.EVENT_READ
+            if want_write:
+                events |= selectors.EVENT_WRITE
+            self._register(fd, events, client)
+            client._group_fd = fd
+            client._group_write = want_write
+        elif want_write != client._group_write:
+            events = selectors.EVENT_READ
+            if want_write:
+                events |= selectors.EVENT_WRITE
+            self._selector.modify(fd, events, client)
+            client._group_write = want_write
+
+        deadline = client._next_deadline()
+        if deadline is not None:
+            self._schedule(client, deadline)
+
+    def _register(self, fd, events, client):
+        try:
+            old = self._selector.get_map()[fd].data
+        except KeyError:
+            pass
+        else:
+            # The previous owner of fd closed it without the group noticing,
+            # and it has been reused.
+            self._selector.unregister(fd)
+            if old._group_fd == fd:
+                old._group_fd = -1
+                old._group_write = False
+                self._dirty.add(old)
+        self._selector.register(fd, events, client)
+
+    def _unregister(self, client):
+        try:
+            self._selector.unregister(client._group_fd)
+        except (KeyError, ValueError):
+            pass
+        client._group_fd = -1
+        client._group_write = False
+
+    def _schedule(self, client, deadline):
+        if client._group_deadline is not None and client._group_deadline <= deadline:
+            return
+        client._group_deadline = deadline
+        timers = self._timers
+        heapq.heappush(timers, (deadline, next(self._timer_seq), client))
+        if len(timers) > 2 * len(self._clients) + 64:
+            timers = [(c._group_deadline, next(self._timer_seq), c)
+                      for c in self._clients if c._group_deadline is not None]
+            heapq.heapify(timers)
+            self._timers = timers
+
+    def _reconnect_at(self, client, deadline):
+        self._reconnects.add(client)
+        client._group_deadline = None
+        self._schedule(client, deadline)
+
+    def _reconnect(self, client):
+        if client._state == mqtt_cs_disconnecting or not client._host:
+            self._reconnects.discard(client)
+            return
+        addresses = _address_cache.get(client._host, client._port)
+        if addresses is not None:
+            self._connect(client, addresses)
+            return
+        key = (client._host, client._port)
+        waiting = self._resolving.get(key)
+        if waiting is None:
+            self._resolving[key] = [client]
+            _address_cache.resolve_async(client._host, client._port, self._resolve_done)
+        else:
+            waiting.append(client)
+
+    def _resolve_done(self, key, addresses, error):
+        # Called on the resolver's thread.
+        self._resolved.append((key, addresses, error))
+        self._wakeup.set()
+
+    def _resolved_handle(self):
+        while self._resolved:
+            (key, addresses, error) = self._resolved.popleft()
+            for client in self._resolving.pop(key, ()):
+                if client._group is not self:
+                    continue
+                if client._state == mqtt_cs_disconnecting:
+                    self._reconnects.discard(client)
+                    continue
+                if error is not None:
+                    self._connect_failed(client, error)
+                else:
+                    self._connect(client, addresses)
 
-        mid = struct.unpack("!H", self._in_packet['packet'])
-        mid = mid[0]
-        self._easy_log(MQTT_LOG_DEBUG, "Received "+cmd+" (Mid: "+str(mid)+")")
+    def _connect(self, client, addresses):
+        self._connect_unregister(client)
+        client._reconnect_reset()
+        try:
+            client._connect_begin(addresses)
+        except socket.error as err:
+            self._connect_failed(client, err)
+            return
+        for sock in client._connecting:
+            self._register(sock.fileno(), selectors.EVENT_WRITE, client)
+        self._schedule(client, client._connect_deadline)
+
+    def _connect_ready(self, client, fd):
+        # fd, one of client's connect attempts, has become writable.
+        for sock in client._connecting:
+            if sock.fileno() == fd:
+                break
+        else:
+            return
+        self._connect_unregister(client)
+        if client._state == mqtt_cs_disconnecting:
+            client._connect_abort()
+            self._reconnects.discard(client)
+            return
+        try:
+            rc = client._connect_complete(sock)
+        except socket.error as err:
+            self._connect_failed(client, err)
+            return
+        if rc == MQTT_ERR_AGAIN:
+            for sock in client._connecting:
+                self._register(sock.fileno(), selectors.EVENT_WRITE, client)
+        else:
+            # The connect deadline is replaced by the keepalive one.
+            client._group_deadline = None
+            self._reconnects.discard(client)
 
-        for i in range(len(self._out_messages)):
+    def _connect_unregister(self, client):
+        for sock in client._connecting:
             try:
-                if self._out_messages[i].mid == mid:
-                    # Only inform the client the message has been sent once.
-                    if self.on_publish:
-                        self._in_callback = True
-                        self.on_publish(self, self._userdata, mid)
-                        self._in_callback = False
-
-                    self._out_messages.pop(i)
-                    self._inflight_messages = self._inflight_messages - 1
-                    if self._max_inflight_messages > 0:
-                        rc = self._update_inflight()
-                        if rc != MQTT_ERR_SUCCESS:
-                            return rc
-                    return MQTT_ERR_SUCCESS
-            except IndexError:
-                # Have removed item so i>count.
-                # Not really an error.
+                self._selector.unregister(sock.fileno())
+            except KeyError:
                 pass
 
-        return MQTT_ERR_SUCCESS
-
-    def _handle_on_message(self, message):
-        matched = False
-        for t in self.on_message_filtered:
-            if topic_matches_sub(t[0], message.topic):
-                self._in_callback = True
-                t[1](self, self._userdata, message)
-                self._in_callback = False
-                matched = True
-
-        if matched == False and self.on_message:
-            self._in_callback = True
-            self.on_message(self, self._userdata, message)
-            self._in_callback = False
+    def _connect_failed(self, client, error):
+        client._easy_log(MQTT_LOG_DEBUG, "Connection failed, retrying: %s", error)
+        self._reconnect_at(client, self._now + self.reconnect_delay)
@@ -0,0 +1,320 @@
+"""
+asyncio front end for the umqtt2 client.
+
+AsyncClient runs the same protocol code as umqtt2.Client: packet parsing,
+acknowledgements, retries and keepalive all stay in Client. Only the network
+loop is different. The socket is registered with the event loop through
+add_reader()/add_writer(), so incoming packets are handled as soon as the loop
+sees them instead of on the next call to loop(), and no extra thread is
+needed.
+
+Needs a selector based event loop (the default everywhere except the
+Windows proactor loop) and Python 3.6 or later.
+
+    async def main():
+        client = AsyncClient()
+        await client.connect("localhost")
+        client.subscribe("sensors/#", 1)
+        await client.publish("sensors/hello", "world", qos=1)
+        async for msg in client.messages("sensors/#"):
+            print(msg.topic, msg.payload)
+"""
+import asyncio
+import socket
+
+from umqtt2 import (Client, MQTTMatcher, MQTTv311, CONNACK_ACCEPTED, CONNECT_ATTEMPTS,
+                    CONNECT_TIMEOUT, MQTT_ERR_AGAIN, MQTT_ERR_SUCCESS, MQTT_ERR_PROTOCOL,
+                    MQTT_ERR_CONN_LOST, MQTT_LOG_ERR, _address_cache, error_string)
+
+# Longest time between checks of keepalive and retries, in seconds. They are
+# checked sooner if one is due sooner.
+MISC_INTERVAL = 1.0
+
+
+class AsyncClient(Client):
+    """MQTT client driven by an asyncio event loop.
+
+    The API is the one of Client with these differences:
+
+    connect() is a coroutine. It resolves the broker address and connects
+    without blocking the loop, then waits for the CONNACK. It returns the
+    CONNACK result: CONNACK_ACCEPTED, or one of the CONNACK_REFUSED_* codes.
+
+    publish() is a coroutine. It returns the MQTTMessageInfo for the message
+    once the message is complete: when it has been written to the socket for
+    QoS 0, on PUBACK for QoS 1 and on PUBCOMP for QoS 2. A QoS 0 message that
+    cannot be sent because there is no connection returns straight away with
+    info.rc set. QoS 1 and 2 messages stay queued and complete after the next
+    successful connect().
+
+    messages(sub) is an async iterator over incoming messages that match the
+    subscription filter sub. Any number of iterators can be open at once. Each
+    gets every matching message, in arrival order. It does not subscribe;
+    call subscribe() for that.
+
+    on_message and message_callback_add() accept coroutine functions as well
+    as plain functions. A coroutine handler is run as a task on the loop, so
+    it can await without holding up the network processing.
+
+    loop(), loop_read(), loop_write() and loop_misc() must not be called. The
+    event loop does that work.
+    """
+    def __init__(self, client_id="", clean_session=True, userdata=None, protocol=MQTTv311, loop=None):
+        Client.__init__(self, client_id, clean_session, userdata, protocol)
+        self._loop = loop
+        self._io_sock = None
+        self._io_fd = -1
+        self._io_writing = False
+        self._misc_handle = None
+        self._connect_future = None
+        self._connack_result = CONNACK_ACCEPTED
+        self._publish_futures = {}
+        self._message_queues = MQTTMatcher()
+        self._tasks = set()
+
+    async def connect(self, host, port=1883, keepalive=60, bind_address=""):
+        """Connect to a remote broker and wait for the CONNACK.
+
+        host, port, keepalive and bind_address are as for Client.connect().
+        Up to CONNECT_ATTEMPTS of the addresses that host resolves to are
+        tried at once, and the first to accept the connection is used.
+        Raises socket.error if none of them does within CONNECT_TIMEOUT
+        seconds, or if the connection fails before the CONNACK arrives."""
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        self.connect_async(host, port, keepalive, bind_address)
+        if len(self._host) == 0:
+            raise ValueError('Invalid host.')
+        if self._port <= 0:
+            raise ValueError('Invalid port number.')
+
+        while True:
+            self._reconnect_reset()
+            self._io_update()
+            sock = await self._open_socket()
+
+            future = self._loop.create_future()
+            self._connect_future = future
+            try:
+                rc = self._connect_socket(sock)
+                self._io_update()
+                if rc != MQTT_ERR_SUCCESS and not future.done():
+                    future.set_result(rc)
+                rc = await future
+            finally:
+                self._connect_future = None
+            if rc != MQTT_ERR_AGAIN:
+                break
+            # Refused as v3.1.1, go round again as v3.1.
+        if rc != MQTT_ERR_SUCCESS:
+            raise socket.error(error_string(rc))
+        return self._connack_result
+
+    async def _open_socket(self):
+        addrs = _address_cache.get(self._host, self._port)
+        if addrs is None:
+            addrs = await self._loop.getaddrinfo(self._host, self._port, type=socket.SOCK_STREAM)
+            _address_cache.put(self._host, self._port, addrs)
+        # Race the first CONNECT_ATTEMPTS addresses, as Client does: the
+        # first to connect wins and the rest are abandoned.
+        error = None
+        attempts = {}
+        for (family, socktype, proto, canonname, sockaddr) in addrs[:CONNECT_ATTEMPTS]:
+            sock = socket.socket(family, socktype, proto)
+            try:
+                sock.setblocking(False)
+                if self._bind_address:
+                    sock.bind((self._bind_address, 0))
+            except socket.error as err:
+                sock.close()
+                error = err
+                continue
+            attempts[self._loop.create_task(self._loop.sock_connect(sock, sockaddr))] = sock
+
+        winner = None
+        pending = set(attempts)
+        deadline = self._loop.time() + CONNECT_TIMEOUT
+        try:
+            while pending and winner is None:
+                (done, pending) = await asyncio.wait(
+                    pending, timeout=max(0.0, deadline - self._loop.time()),
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    error = socket.timeout('timed out')
+                    break
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = attempts[task]
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                # Let the cancelled connects drop their reader/writer
+                # registrations before their sockets are closed.
+                await asyncio.wait(pending)
+            for sock in attempts.values():
+                if sock is not winner:
+                    sock.close()
+        if winner is not None:
+            return winner
+        if error is None:
+            error = socket.error("getaddrinfo returned no addresses for %s" % self._host)
+        raise error
+
+    async def publish(self, topic, payload=None, qos=0, retain=False):
+        """Publish a message on a topic and wait for it to complete.
+
+        Arguments are as for Client.publish(). Returns the MQTTMessageInfo of
+        the message."""
+        info = Client.publish(self, topic, payload, qos, retain)
+        if info.is_published():
+            return info
+        if qos == 0 and info.rc != MQTT_ERR_SUCCESS:
+            return info
+
+        future = self._loop.create_future()
+        self._publish_futures[info.mid] = future
+        try:
+            await future
+        finally:
+            self._publish_futures.pop(info.mid, None)
+        return info
+
+    async def messages(self, sub="#"):
+        """Iterate over the incoming messages that match the filter sub.
+
+        Messages are queued from the moment the iteration starts until the
+        iterator is closed, so a slow consumer holds them in memory."""
+        queue = asyncio.Queue()
+        try:
+            queues = self._message_queues[sub]
+        except KeyError:
+            queues = self._message_queues[sub] = []
+        queues.append(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            queues.remove(queue)
+            if not queues:
+                del self._message_queues[sub]
+
+    def _io_update(self):
+        # Bring the loop's reader/writer registrations in line with the
+        # current socket and output queue.
+        sock = self._sock
+        if sock is not self._io_sock:
+            if self._io_sock is not None:
+                self._loop.remove_reader(self._io_fd)
+                self._loop.remove_writer(self._io_fd)
+                self._io_writing = False
+                if self._misc_handle is not None:
+                    self._misc_handle.cancel()
+                    self._misc_handle = None
+                future = self._connect_future
+                if future is not None and not future.done():
+                    future.set_result(MQTT_ERR_CONN_LOST)
+            self._io_sock = sock
+            if sock is None:
+                self._io_fd = -1
+                return
+            self._io_fd = sock.fileno()
+            self._loop.add_reader(self._io_fd, self._io_read)
+            self._misc_handle = self._loop.call_later(self._loop_timeout(MISC_INTERVAL), self._io_misc)
+        elif sock is None:
+            return
+
+        if self._out_control or self._out_packet:
+            if not self._io_writing:
+                self._loop.add_writer(self._io_fd, self._io_write)
+                self._io_writing = True
+        elif self._io_writing:
+            self._loop.remove_writer(self._io_fd)
+            self._io_writing = False
+
+    def _io_read(self):
+        self.loop_read()
+        self._io_update()
+
+    def _io_write(self):
+        self.loop_write()
+        self._io_update()
+
+    def _io_misc(self):
+        self._misc_handle = None
+        self.loop_misc()
+        self._io_update()
+        if self._sock is not None and self._misc_handle is None:
+            self._misc_handle = self._loop.call_later(self._loop_timeout(MISC_INTERVAL), self._io_misc)
+
+    def _packet_queue(self, command, packet, mid, qos, info=None, topic=None):
+        rc = Client._packet_queue(self, command, packet, mid, qos, info, topic)
+        if self._loop is not None:
+            self._io_update()
+        return rc
+
+    def _connect_retry(self):
+        # connect() opens the new socket for the v3.1 fallback, so that the
+        # event loop isn't blocked in reconnect().
+        future = self._connect_future
+        if future is None:
+            return Client._connect_retry(self)
+        self._reconnect_reset()
+        future.set_result(MQTT_ERR_AGAIN)
+        return MQTT_ERR_AGAIN
+
+    def _on_connack(self, flags, result):
+        Client._on_connack(self, flags, result)
+        future = self._connect_future
+        if future is not None and not future.done():
+            if result < 6:
+                self._connack_result = result
+                future.set_result(MQTT_ERR_SUCCESS)
+            else:
+                future.set_result(MQTT_ERR_PROTOCOL)
+
+    def _publish_complete(self, info):
+        Client._publish_complete(self, info)
+        future = self._publish_futures.get(info.mid)
+        if future is not None and not future.done():
+            future.set_result(info)
+
+    def _handle_on_message(self, message, callbacks=None):
+        if self._last_values is not None:
+            self._last_value_put(message)
+        if callbacks is None:
+            callbacks = self._on_message_filtered.match(message.topic)
+        matched = False
+        for callback in callbacks:
+            self._call_message_handler(callback, message)
+            matched = True
+
+        if matched == False and self.on_message:
+            self._call_message_handler(self.on_message, message)
+
+        for queues in self._message_queues.match(message.topic):
+            # The message outlives the receive buffer its payload points into.
+            message.detach()
+            for queue in queues:
+                queue.put_nowait(message)
+
+    def _call_message_handler(self, handler, message):
+        self._in_callback = True
+        try:
+            result = handler(self, self._userdata, message)
+        finally:
+            self._in_callback = False
+        if asyncio.iscoroutine(result):
+            # The coroutine body has not run yet, so the payload can still be
+            # copied out before the receive buffer is reused.
+            message.detach()
+            task = self._loop.create_task(result)
+            self._tasks.add(task)
+            task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self._easy_log(MQTT_LOG_ERR, "Message handler failed: %r", task.exception())
@@ -0,0 +1,392 @@
+# Copyright (c) 2012-2014 Roger Light <roger@atchoo.org>
+#
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# and Eclipse Distribution License v1.0 which accompany this distribution.
+#
+# The Eclipse Public License is available at
+#    http://www.eclipse.org/legal/epl-v10.html
+# and the Eclipse Distribution License is available at
+#   http://www.eclipse.org/org/documents/edl-v10.php.
+#
+# Contributors:
+#    Roger Light - initial API and implementation
+
+"""
+MQTT packet codec, shared by umqtt_core, umqtt and umqtt2.
+
+Fixed fields go through the Struct objects below, built once at import, so
+no format string is assembled or parsed per packet. The encode_*() functions
+pack the fields of a packet separately and join them with one copy into the
+finished packet. pack_publish() and friends append to an existing buffer
+instead, for batches, and the decoders unpack_from() straight out of the
+receive buffer. The remaining length field is encoded from a table for the
+one byte case and decoded with a table of byte weights.
+
+Packing into a buffer preallocated at the final size with pack_into() was
+tried, and is slower than the join on CPython for packets of every size:
+the zero fill and the slice assignments cost more than they save.
+
+Runs on MicroPython too. ustruct has no Struct, so a minimal stand-in over
+its module level functions is used there. On CPython the hottest functions,
+listed in pure, are replaced by compiled ones if the optional _umqtt_codec
+extension has been built; compiled says whether it was.
+"""
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+
+try:
+    Struct = struct.Struct
+except AttributeError:
+    class Struct(object):
+        """The part of struct.Struct the codec uses, for ustruct."""
+        def __init__(self, fmt):
+            self.format = fmt
+            self.size = struct.calcsize(fmt)
+
+        def pack(self, *args):
+            return struct.pack(self.format, *args)
+
+        def unpack(self, buf):
+            return struct.unpack(self.format, buf)
+
+        def unpack_from(self, buf, offset=0):
+            return struct.unpack_from(self.format, buf, offset)
+
+CONNECT = 0x10
+PUBLISH = 0x30
+
+# Network byte order layouts. U8_U8 is a fixed header with a one byte
+# remaining length (DISCONNECT, PINGREQ...), U8_U8_U16 one followed by a
+# message id (PUBACK...) or a topic length (short PUBLISH). In CONNECT,
+# U8_U8_U16 is also the protocol level, flags and keepalive.
+U8 = Struct("!B")
+U16 = Struct("!H")
+U8_U8 = Struct("!BB")
+U8_U8_U16 = Struct("!BBH")
+
+# The fixed four byte acknowledgements (PUBACK, PUBREC, PUBREL, PUBCOMP) are
+# the most common packets there are. pack_ack(command, 2, mid) packs one with
+# a single call, without looking pack up on U8_U8_U16 each time.
+pack_ack = U8_U8_U16.pack
+
+# The remaining length field of every packet shorter than 128 bytes, and the
+# weight of each byte of the field when decoding.
+_VARINT1 = tuple(bytes((n,)) for n in range(128))
+_VARINT_MULT = (1, 128, 16384, 2097152)
+
+
+def encode_remaining_length(remaining_length):
+    """Return the remaining length field for remaining_length."""
+    if remaining_length < 128:
+        return _VARINT1[remaining_length]
+    if remaining_length < 16384:
+        return U8_U8.pack((remaining_length & 0x7F) | 0x80, remaining_length >> 7)
+    if remaining_length > 268435455:
+        raise ValueError('Packet too large.')
+    field = bytearray()
+    while remaining_length > 127:
+        field.append((remaining_length & 0x7F) | 0x80)
+        remaining_length >>= 7
+    field.append(remaining_length)
+    return bytes(field)
+
+
+def pack_remaining_length(packet, remaining_length):
+    """Append the remaining length field for remaining_length to packet."""
+    packet += encode_remaining_length(remaining_length)
+    return packet
+
+
+def unpack_remaining_length(buf, pos, end):
+    """Decode the remaining length field starting at buf[pos].
+
+    Returns (remaining_length, offset of the first byte after the field). If
+    buf[pos:end] does not yet hold the whole field (-1, 0) is returned, and
+    (-1, -1) if it is longer than the 4 bytes allowed by the protocol.
+    """
+    if pos >= end:
+        return (-1, 0)
+    byte = buf[pos]
+    if byte < 128:
+        # Packets up to 127 bytes long, the common case.
+        return (byte, pos+1)
+    if pos + 1 >= end:
+        return (-1, 0)
+    remaining_length = (byte & 127) + ((buf[pos+1] & 127) << 7)
+    if buf[pos+1] < 128:
+        return (remaining_length, pos+2)
+    i = 2
+    while pos + i < end:
+        if i == 4:
+            # Anything more likely means a broken/malicious client.
+            return (-1, -1)
+        byte = buf[pos+i]
+        remaining_length += (byte & 127)*_VARINT_MULT[i]
+        i += 1
+        if byte < 128:
+            return (remaining_length, pos+i)
+    if i == 4:
+        return (-1, -1)
+    return (-1, 0)
+
+# split_frames() calls it by this name, so that it stays pure Python when
+# the compiled functions are loaded.
+_unpack_remaining_length = unpack_remaining_length
+
+
+def split_frames(buf, pos, end):
+    """Find the complete packets in buf[pos:end].
+
+    Returns (frames, pos, remaining_length, start). frames lists (command,
+    start, stop) for each complete packet, whose body is buf[start:stop]. pos
+    is where the first incomplete packet begins, or end if there is none.
+    remaining_length and start are what unpack_remaining_length() returned
+    for that packet: (-1, 0) if its length field is not all there yet, and
+    (-1, -1) if the field is malformed.
+    """
+    frames = []
+    while end - pos >= 2:
+        remaining_length, start = _unpack_remaining_length(buf, pos+1, end)
+        if remaining_length < 0 or end - start < remaining_length:
+            return (frames, pos, remaining_length, start)
+        frames.append((buf[pos], start, start+remaining_length))
+        pos = start + remaining_length
+    return (frames, pos, -1, 0)
+
+
+def unpack_publish_header(packet, qos):
+    """Parse the variable header at the start of a PUBLISH body.
+
+    Returns (topic length, mid, offset of the payload). The topic is
+    packet[2:2+topic length], and mid is 0 for QoS 0. Returns (-1, 0, 0) if
+    the packet is too short for the header it claims to have.
+    """
+    n = len(packet)
+    if n < 2:
+        return (-1, 0, 0)
+    (slen,) = U16.unpack_from(packet)
+    pos = 2+slen
+    if qos > 0:
+        if pos+2 > n:
+            return (-1, 0, 0)
+        return (slen, U16.unpack_from(packet, pos)[0], pos+2)
+    if pos > n:
+        return (-1, 0, 0)
+    return (slen, 0, pos)
+
+
+def _text(data):
+    # Topics and filters are matched as str. UTF-8 bytes are decoded first,
+    # anything else is refused, exactly as by the compiled version.
+    if isinstance(data, str):
+        return data
+    if isinstance(data, (bytes, bytearray)):
+        return str(data, 'utf-8')
+    raise TypeError('topic must be str or bytes, not %s' % type(data).__name__)
+
+
+def topic_matches_sub(sub, topic):
+    """Check whether a topic matches a subscription. Both can be str or UTF-8
+    bytes.
+
+    For example:
+
+    foo/bar would match the subscription foo/# or +/bar
+    non/matching would not match the subscription non/+/+
+    """
+    sub = _text(sub)
+    topic = _text(topic)
+    result = True
+    multilevel_wildcard = False
+
+    slen = len(sub)
+    tlen = len(topic)
+
+    if slen > 0 and tlen > 0:
+        if (sub[0] == '$' and topic[0] != '$') or (topic[0] == '$' and sub[0] != '$'):
+            return False
+
+    spos = 0
+    tpos = 0
+
+    while spos < slen and tpos < tlen:
+        if sub[spos] == topic[tpos]:
+            if tpos == tlen-1:
+                # Check for e.g. foo matching foo/#
+                if spos == slen-3 and sub[spos+1] == '/' and sub[spos+2] == '#':
+                    result = True
+                    multilevel_wildcard = True
+                    break
+
+            spos += 1
+            tpos += 1
+
+            if tpos == tlen and spos == slen-1 and sub[spos] == '+':
+                spos += 1
+                result = True
+                break
+        else:
+            if sub[spos] == '+':
+                spos += 1
+                while tpos < tlen and topic[tpos] != '/':
+                    tpos += 1
+                if tpos == tlen and spos == slen:
+                    result = True
+                    break
+
+            elif sub[spos] == '#':
+                multilevel_wildcard = True
+                if spos+1 != slen:
+                    result = False
+                    break
+                else:
+                    result = True
+                    break
+
+            else:
+                result = False
+                break
+
+    if not multilevel_wildcard and (tpos < tlen or spos < slen):
+        result = False
+
+    return result
+
+
+def _utf8(data):
+    if isinstance(data, str):
+        return data.encode('utf-8')
+    if isinstance(data, (bytes, bytearray)):
+        return data
+    raise TypeError
+
+
+def pack_str16(packet, data):
+    """Append data to packet as a length prefixed string. str is encoded as
+    UTF-8."""
+    data = _utf8(data)
+    packet += U16.pack(len(data))
+    packet += data
+
+
+def _publish_header(command, utopic, payload, qos):
+    # The fixed header and topic length of a PUBLISH.
+    topiclen = len(utopic)
+    remaining_length = 2+topiclen
+    if payload is not None:
+        remaining_length = remaining_length + len(payload)
+    if qos > 0:
+        # For message id
+        remaining_length = remaining_length + 2
+    if remaining_length < 128:
+        # The common case of a one byte remaining length, in one go.
+        return U8_U8_U16.pack(command, remaining_length, topiclen)
+    return U8.pack(command) + encode_remaining_length(remaining_length) + U16.pack(topiclen)
+
+
+def pack_publish(packet, mid, utopic, payload, qos, retain, dup):
+    """Append a PUBLISH packet to packet. utopic is the encoded topic, and
+    payload is bytes-like or None."""
+    command = PUBLISH | ((dup&0x1)<<3) | (qos<<1) | retain
+    packet += _publish_header(command, utopic, payload, qos)
+    packet += utopic
+    if qos > 0:
+        packet += U16.pack(mid)
+    if payload is not None:
+        packet += payload
+
+
+def encode_publish(mid, utopic, payload, qos, retain, dup):
+    """Return a PUBLISH packet. Arguments are as for pack_publish()."""
+    command = PUBLISH | ((dup&0x1)<<3) | (qos<<1) | retain
+    parts = [_publish_header(command, utopic, payload, qos), utopic]
+    if qos > 0:
+        parts.append(U16.pack(mid))
+    if payload is not None:
+        parts.append(payload)
+    return b"".join(parts)
+
+
+def encode_connect(protocol_name, proto_ver, keepalive, client_id, clean_session=True,
+                   will_topic=None, will_payload=None, will_qos=0, will_retain=False,
+                   username=None, password=None):
+    """Return a CONNECT packet. There is a will if will_topic is set.
+    password is only sent with a username. Strings may be str or bytes."""
+    connect_flags = 0
+    if clean_session:
+        connect_flags = connect_flags | 0x02
+    client_id = _utf8(client_id)
+    parts = [None, U16.pack(len(protocol_name)), protocol_name, None, U16.pack(len(client_id)), client_id]
+
+    if will_topic:
+        will_topic = _utf8(will_topic)
+        will_payload = _utf8(will_payload or b"")
+        parts.extend((U16.pack(len(will_topic)), will_topic, U16.pack(len(will_payload)), will_payload))
+        connect_flags = connect_flags | 0x04 | ((will_qos&0x03) << 3) | ((will_retain&0x01) << 5)
+
+    if username:
+        username = _utf8(username)
+        parts.extend((U16.pack(len(username)), username))
+        connect_flags = connect_flags | 0x80
+        if password:
+            password = _utf8(password)
+            parts.extend((U16.pack(len(password)), password))
+            connect_flags = connect_flags | 0x40
+
+    parts[3] = U8_U8_U16.pack(proto_ver, connect_flags, keepalive)
+    remaining_length = 0
+    for part in parts[1:]:
+        remaining_length = remaining_length + len(part)
+    parts[0] = U8.pack(CONNECT) + encode_remaining_length(remaining_length)
+    return b"".join(parts)
+
+
+def encode_subscribe(command, mid, topics):
+    """Return a SUBSCRIBE packet. topics is a list of (encoded topic, qos)."""
+    parts = [None, U16.pack(mid)]
+    remaining_length = 2
+    for t in topics:
+        parts.append(U16.pack(len(t[0])))
+        parts.append(t[0])
+        parts.append(U8.pack(t[1]))
+        remaining_length = remaining_length + 2+len(t[0])+1
+    parts[0] = U8.pack(command) + encode_remaining_length(remaining_length)
+    return b"".join(parts)
+
+
+def encode_unsubscribe(command, mid, topics):
+    """Return an UNSUBSCRIBE packet. topics is a list of encoded topic
+    filters."""
+    parts = [None, U16.pack(mid)]
+    remaining_length = 2
+    for t in topics:
+        parts.append(U16.pack(len(t)))
+        parts.append(t)
+        remaining_length = remaining_length + 2+len(t)
+    parts[0] = U8.pack(command) + encode_remaining_length(remaining_length)
+    return b"".join(parts)
+
+
+def unpack_suback(packet):
+    """Return (mid, granted_qos) from the body of a SUBACK."""
+    return (U16.unpack_from(packet)[0], tuple(packet[2:]))
+
+
+# The pure Python versions of the functions that _umqtt_codec, when it has
+# been built (see setup.py), replaces with compiled ones.
+pure = {
+    'unpack_remaining_length': unpack_remaining_length,
+    'split_frames': split_frames,
+    'unpack_publish_header': unpack_publish_header,
+    'topic_matches_sub': topic_matches_sub,
+}
+
+try:
+    from _umqtt_codec import (unpack_remaining_length, split_frames,
+                              unpack_publish_header, topic_matches_sub)
+    compiled = True
+except ImportError:
+    compiled = False
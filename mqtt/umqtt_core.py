@@ -0,0 +1,1203 @@
+# Copyright (c) 2012-2014 Roger Light <roger@atchoo.org>
+#
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# and Eclipse Distribution License v1.0 which accompany this distribution.
+#
+# The Eclipse Public License is available at
+#    http://www.eclipse.org/legal/epl-v10.html
+# and the Eclipse Distribution License is available at
+#   http://www.eclipse.org/org/documents/edl-v10.php.
+#
+# Contributors:
+#    Roger Light - initial API and implementation
+
+"""
+Sans-IO MQTT v3.1/v3.1.1 protocol core.
+
+MQTTSession is the protocol state machine of one client session: the
+handling of every incoming packet, the acknowledgement flows of QoS 1 and 2
+messages in both directions, the in-flight window, retries and keepalive.
+It does no I/O of its own. Packets to send go to _packet_queue(), and the
+results of incoming ones to a handful of hooks, which a subclass fills in.
+umqtt.Client and umqtt2.Client are such subclasses: they add the socket,
+the outgoing queue and the callbacks, and keep the protocol to this module.
+
+MQTTProtocol is the subclass for callers that want no more than bytes in and
+out. Bytes read from the broker go in through receive_data(), which returns
+the events they produced. The packets the protocol wants sent pile up in an
+output buffer that data_to_send() hands over. Time is also the caller's
+business: tick(now) sends the PINGREQs and retries that are due, and
+next_deadline() says when it next needs to be called. umqtt3.Client is a
+transport around one.
+
+    proto = MQTTProtocol("client-1")
+    proto.connect(keepalive=60, now=time.time())
+    sock.sendall(proto.data_to_send())
+    while True:
+        for event in proto.receive_data(sock.recv(4096), time.time()):
+            if event[0] == EV_MESSAGE:
+                print(event[1].topic, event[1].payload)
+        sock.sendall(proto.data_to_send())
+
+Packets are encoded and decoded by umqtt_codec. The module runs unchanged on
+CPython and MicroPython.
+"""
+try:
+    import heapq
+except ImportError:
+    import uheapq as heapq
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ucollections import OrderedDict
+try:
+    from collections import deque
+    deque()
+except (ImportError, TypeError):
+    # MicroPython's deque has a fixed size and can't be iterated over, so
+    # queues there are lists. They are short on a microcontroller.
+    class deque(list):
+        def popleft(self):
+            return self.pop(0)
+
+from umqtt_codec import (U16, U8_U8, encode_connect, encode_publish, encode_subscribe,
+                         encode_unsubscribe, pack_ack, pack_publish, split_frames,
+                         unpack_publish_header, unpack_suback)
+
+MQTTv31 = 3
+MQTTv311 = 4
+
+PROTOCOL_NAMEv31 = b"MQIsdp"
+PROTOCOL_NAMEv311 = b"MQTT"
+
+# Message types
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+PUBREC = 0x50
+PUBREL = 0x60
+PUBCOMP = 0x70
+SUBSCRIBE = 0x80
+SUBACK = 0x90
+UNSUBSCRIBE = 0xA0
+UNSUBACK = 0xB0
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+# Log levels
+MQTT_LOG_INFO = 0x01
+MQTT_LOG_NOTICE = 0x02
+MQTT_LOG_WARNING = 0x04
+MQTT_LOG_ERR = 0x08
+MQTT_LOG_DEBUG = 0x10
+
+CONNACK_REFUSED_PROTOCOL_VERSION = 1
+
+# Connection state
+mqtt_cs_new = 0
+mqtt_cs_connected = 1
+mqtt_cs_disconnecting = 2
+mqtt_cs_connect_async = 3
+
+# Message state
+mqtt_ms_invalid = 0
+mqtt_ms_publish= 1
+mqtt_ms_wait_for_puback = 2
+mqtt_ms_wait_for_pubrec = 3
+mqtt_ms_resend_pubrel = 4
+mqtt_ms_wait_for_pubrel = 5
+mqtt_ms_resend_pubcomp = 6
+mqtt_ms_wait_for_pubcomp = 7
+mqtt_ms_send_pubrec = 8
+mqtt_ms_queued = 9
+
+# States in which a message is waiting on the broker and gets retried.
+_RETRY_STATES = (mqtt_ms_wait_for_puback, mqtt_ms_wait_for_pubrec,
+                 mqtt_ms_wait_for_pubrel, mqtt_ms_wait_for_pubcomp)
+
+# Error values, the ones the session returns. The clients have the full list.
+MQTT_ERR_AGAIN = -1
+MQTT_ERR_SUCCESS = 0
+MQTT_ERR_PROTOCOL = 2
+MQTT_ERR_INVAL = 3
+MQTT_ERR_NO_CONN = 4
+MQTT_ERR_CONN_REFUSED = 5
+MQTT_ERR_CONN_LOST = 7
+
+# Events returned by receive_data() and tick(). Each event is a tuple whose
+# first item is one of these.
+EV_CONNACK = 1       # (EV_CONNACK, flags, result)
+EV_MESSAGE = 2       # (EV_MESSAGE, message)
+EV_PUBLISHED = 3     # (EV_PUBLISHED, mid)
+EV_SUBACK = 4        # (EV_SUBACK, mid, granted_qos)
+EV_UNSUBACK = 5      # (EV_UNSUBACK, mid)
+EV_TIMEOUT = 6       # (EV_TIMEOUT,)
+
+
+class ProtocolError(Exception):
+    """Raised by receive_data() for data that is not valid MQTT. The
+    connection cannot be used any further."""
+
+
+def encode_payload(payload):
+    """Convert a publish() payload to bytes, or None for a zero length
+    message. Raises TypeError/ValueError for payloads that can't be sent."""
+    if isinstance(payload, (bytes, bytearray)):
+        local_payload = payload
+    elif isinstance(payload, memoryview):
+        # Most likely a received payload, which won't outlive the callback.
+        local_payload = bytes(payload)
+    elif isinstance(payload, str):
+        local_payload = payload.encode('utf-8')
+    elif isinstance(payload, int) or isinstance(payload, float):
+        local_payload = str(payload).encode('ascii')
+    elif payload is None:
+        local_payload = None
+    else:
+        raise TypeError('payload must be a string, bytes, bytearray, int, float or None.')
+
+    if local_payload is not None and len(local_payload) > 268435455:
+        raise ValueError('Payload too large.')
+    return local_payload
+
+
+def _utf8(data):
+    if isinstance(data, str):
+        return data.encode('utf-8')
+    return data
+
+
+class Message(object):
+    """A message, incoming or outgoing (held by the session until it is
+    acknowledged). An incoming payload is a memoryview into the receive
+    buffer until detach() is called."""
+    __slots__ = ('timestamp', 'state', 'dup', 'mid', 'topic', 'payload', 'qos', 'retain', 'info')
+
+    def __init__(self):
+        self.timestamp = 0
+        self.state = mqtt_ms_invalid
+        self.dup = False
+        self.mid = 0
+        self.topic = ""
+        self.payload = None
+        self.qos = 0
+        self.retain = False
+        self.info = None
+
+    def detach(self):
+        """Copy the payload out of the client's receive buffer.
+
+        Incoming payloads are memoryviews into a buffer that is reused for the
+        next packet, so they are only valid inside the on_message callback.
+        Call this to keep a message after the callback has returned. Returns
+        the message itself."""
+        if isinstance(self.payload, memoryview):
+            self.payload = bytes(self.payload)
+        return self
+
+
+class MQTTMessageInfo(object):
+    """Returned by publish() and publish_many(), one per message, to track
+    the message after the call has returned.
+
+    Members:
+
+    rc : MQTT_ERR_SUCCESS, or the error the message was queued with, e.g.
+         MQTT_ERR_NO_CONN if the client was not connected.
+    mid : Integer. The message id, as passed to on_publish().
+
+    For compatibility with code written against the old (result, mid) return
+    value of publish(), it can be unpacked and indexed like that tuple.
+    """
+    __slots__ = ('mid', 'rc', '_published')
+
+    def __init__(self, mid):
+        self.mid = mid
+        self.rc = MQTT_ERR_SUCCESS
+        self._published = False
+
+    def __iter__(self):
+        return iter((self.rc, self.mid))
+
+    def __getitem__(self, index):
+        return (self.rc, self.mid)[index]
+
+    def is_published(self):
+        """True once the message has left the client (QoS 0) or the broker
+        has acknowledged it (QoS 1 and 2)."""
+        return self._published
+
+
+class _NoLock(object):
+    # Stands in for the locks of a session that only one thread uses.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_no_lock = _NoLock()
+
+
+class MQTTSession(object):
+    """Protocol state of an MQTT client session, with no I/O.
+
+    A subclass provides the transport through _packet_queue(), which is
+    handed every packet to send, and is told what happened through the
+    hooks _on_connack(), _on_suback(), _on_unsuback(), _handle_on_message()
+    and _publish_complete(). Received packets come in through
+    _packet_handle(), and the transport calls _check_keepalive() and
+    _message_retry_check() by the time _next_deadline() gives. Everything
+    is timed by _now, which the transport keeps up to date.
+
+    Methods return MQTT_ERR_* values, as the clients do.
+    """
+    # The class of the messages the session creates.
+    _message_class = Message
+
+    def __init__(self, client_id, clean_session=True, protocol=MQTTv311):
+        self._client_id = client_id
+        self._clean_session = clean_session
+        self._protocol = protocol
+        self._username = ""
+        self._password = ""
+        self._will = False
+        self._will_topic = ""
+        self._will_payload = None
+        self._will_qos = 0
+        self._will_retain = False
+        self._keepalive = 60
+        self._message_retry = 20
+        self._state = mqtt_cs_new
+        self._now = 0
+        self._last_msg_in = 0
+        self._last_msg_out = 0
+        self._ping_t = 0
+        self._last_mid = 0
+        # In-flight messages keyed by mid, oldest first, and messages waiting
+        # for room in the in-flight window.
+        self._out_messages = OrderedDict()
+        self._out_message_queue = deque()
+        self._in_messages = OrderedDict()
+        self._max_inflight_messages = 20
+        self._inflight_messages = 0
+        # Retry deadlines as (deadline, seq, message), see _retry_schedule().
+        self._retry_heap = []
+        self._retry_seq = 0
+        # A umqtt_store session store, see umqtt2.Client.session_store_set().
+        self._store = None
+        # Log levels _easy_log() passes on, tested before building arguments.
+        self._log_mask = 0
+        # Only a subclass used from more than one thread needs real locks.
+        self._out_message_mutex = _no_lock
+        self._mid_generate_mutex = _no_lock
+
+    # ============================================================
+    # Hooks for the transport
+    # ============================================================
+
+    def _packet_queue(self, command, packet, mid, qos, info=None, topic=None):
+        # Send packet. info is the MQTTMessageInfo of a QoS 0 PUBLISH, or a
+        # list of them for a publish_many() batch, to be marked published
+        # once written. topic is given for a QoS 0 PUBLISH, which may be
+        # coalesced with a later one. Returns MQTT_ERR_NO_CONN if there is no
+        # connection to send it on.
+        raise NotImplementedError
+
+    def _connect_retry(self):
+        # The broker refused MQTT v3.1.1 and _protocol is now MQTTv31: drop
+        # the connection and connect again.
+        raise NotImplementedError
+
+    def _on_connack(self, flags, result):
+        pass
+
+    def _on_suback(self, mid, granted_qos):
+        pass
+
+    def _on_unsuback(self, mid):
+        pass
+
+    def _handle_on_message(self, message, callbacks=None):
+        # Deliver an incoming message. callbacks is what _topic_resolve()
+        # returned for its topic, None if it hasn't been called.
+        pass
+
+    def _publish_complete(self, info):
+        # An outgoing QoS 1 or 2 message has been acknowledged.
+        pass
+
+    def _topic_resolve(self, topic):
+        # Return (topic, callbacks) for the raw topic of an incoming PUBLISH.
+        return (bytes(topic), None)
+
+    def _inflight_rtt(self, rtt):
+        # The round trip time of a message acknowledged on first sending.
+        pass
+
+    def _time(self):
+        # The time for messages published now, perhaps from another thread
+        # than the one that keeps _now.
+        return self._now
+
+    def _easy_log(self, level, fmt, *args):
+        pass
+
+    # ============================================================
+    # Sending
+    # ============================================================
+
+    def _mid_generate(self):
+        with self._mid_generate_mutex:
+            self._last_mid = self._last_mid + 1
+            if self._last_mid == 65536:
+                self._last_mid = 1
+            return self._last_mid
+
+    def _topic_wildcard_len_check(self, topic):
+        # Search for + or # in a topic. Return MQTT_ERR_INVAL if found.
+         # Also returns MQTT_ERR_INVAL if the topic string is too long.
+         # Returns MQTT_ERR_SUCCESS if everything is fine.
+        if '+' in topic or '#' in topic or len(topic) == 0 or len(topic) > 65535:
+            return MQTT_ERR_INVAL
+        else:
+            return MQTT_ERR_SUCCESS
+
+    def _publish(self, mid, topic, payload, qos, retain, info):
+        # Publish a checked message and return the result for info.rc.
+        if qos == 0:
+            return self._send_publish(mid, topic, payload, qos, retain, False, info)
+        with self._out_message_mutex:
+            message = self._out_message_new(mid, topic, payload, qos, retain, info)
+            if message.state == mqtt_ms_queued:
+                return MQTT_ERR_SUCCESS
+
+            rc = self._send_publish(message.mid, message.topic, message.payload, message.qos, message.retain, message.dup)
+
+            # remove from inflight messages so it will be send after a connection is made
+            if rc == MQTT_ERR_NO_CONN:
+                self._inflight_messages -= 1
+                message.state = mqtt_ms_publish
+            return rc
+
+    def _publish_many(self, batch, connected):
+        # Publish a checked batch of (topic, payload, qos, retain) in one
+        # packet and return an MQTTMessageInfo for each.
+        utopics = {}
+        infos = []
+        sent_infos = []
+        qos0_infos = []
+        packet = bytearray()
+        # Hand out the mids for the whole batch without going through
+        # _mid_generate() each time.
+        with self._mid_generate_mutex:
+            mid = self._last_mid
+            self._last_mid = (mid + len(batch) - 1) % 65535 + 1
+        with self._out_message_mutex:
+            for topic, payload, qos, retain in batch:
+                mid += 1
+                if mid == 65536:
+                    mid = 1
+                info = MQTTMessageInfo(mid)
+                infos.append(info)
+
+                if qos > 0:
+                    message = self._out_message_new(mid, topic, payload, qos, retain, info)
+                    if message.state == mqtt_ms_queued:
+                        continue
+                    if not connected:
+                        self._inflight_messages -= 1
+                        message.state = mqtt_ms_publish
+                        info.rc = MQTT_ERR_NO_CONN
+                        continue
+                    payload = message.payload
+                elif not connected:
+                    info.rc = MQTT_ERR_NO_CONN
+                    continue
+                else:
+                    qos0_infos.append(info)
+
+                utopic = utopics.get(topic)
+                if utopic is None:
+                    utopic = utopics[topic] = _utf8(topic)
+                pack_publish(packet, mid, utopic, payload, qos, retain, False)
+                sent_infos.append(info)
+
+            if packet:
+                if self._log_mask & MQTT_LOG_DEBUG:
+                    self._easy_log(MQTT_LOG_DEBUG, "Sending %d PUBLISH (%d bytes)", len(sent_infos), len(packet))
+                rc = self._packet_queue(PUBLISH, packet, 0, 0, qos0_infos)
+                if rc:
+                    for info in sent_infos:
+                        info.rc = rc
+        return infos
+
+    def _out_message_new(self, mid, topic, payload, qos, retain, info):
+        # Track an outgoing QoS 1/2 message. It is put in flight straight
+        # away if the window allows, otherwise left queued for
+        # _update_inflight().
+        message = self._message_class()
+        message.timestamp = self._time()
+        message.mid = mid
+        message.topic = topic
+        if payload is None or len(payload) == 0:
+            message.payload = None
+        else:
+            message.payload = payload
+        message.qos = qos
+        message.retain = retain
+        message.dup = False
+        message.info = info
+
+        if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
+            self._out_messages[mid] = message
+            self._inflight_messages = self._inflight_messages+1
+            if qos == 1:
+                message.state = mqtt_ms_wait_for_puback
+            elif qos == 2:
+                message.state = mqtt_ms_wait_for_pubrec
+            self._retry_schedule(message)
+        else:
+            message.state = mqtt_ms_queued
+            self._out_message_queue.append(message)
+        if self._store is not None:
+            self._store.out_put(mid, message.state, qos, retain, topic, message.payload)
+        return message
+
+    def _update_inflight(self):
+        # Move queued messages into the in-flight window while there is room.
+        queue = self._out_message_queue
+        while queue and self._inflight_messages < self._max_inflight_messages:
+            m = queue.popleft()
+            self._out_messages[m.mid] = m
+            self._inflight_messages = self._inflight_messages + 1
+            if m.qos == 1:
+                m.state = mqtt_ms_wait_for_puback
+            elif m.qos == 2:
+                m.state = mqtt_ms_wait_for_pubrec
+            if self._store is not None:
+                self._store.out_state(m.mid, m.state)
+            m.timestamp = self._now
+            self._retry_schedule(m)
+            rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
+            if rc != 0:
+                return rc
+        return MQTT_ERR_SUCCESS
+
+    def _send_pingreq(self):
+        self._easy_log(MQTT_LOG_DEBUG, "Sending PINGREQ")
+        rc = self._send_simple_command(PINGREQ)
+        if rc == MQTT_ERR_SUCCESS:
+            self._ping_t = self._now
+        return rc
+
+    def _send_pingresp(self):
+        self._easy_log(MQTT_LOG_DEBUG, "Sending PINGRESP")
+        return self._send_simple_command(PINGRESP)
+
+    def _send_puback(self, mid):
+        if self._log_mask & MQTT_LOG_DEBUG:
+            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBACK (Mid: %d)", mid)
+        return self._send_command_with_mid(PUBACK, mid, False)
+
+    def _send_pubcomp(self, mid):
+        if self._log_mask & MQTT_LOG_DEBUG:
+            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBCOMP (Mid: %d)", mid)
+        return self._send_command_with_mid(PUBCOMP, mid, False)
+
+    def _send_publish(self, mid, topic, payload=None, qos=0, retain=False, dup=False, info=None):
+        if self._log_mask & MQTT_LOG_DEBUG:
+            if payload is None:
+                self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d%d, q%d, r%d, m%d), '%s' (NULL payload)", dup, qos, retain, mid, topic)
+            else:
+                self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d%d, q%d, r%d, m%d), '%s', ... (%d bytes)", dup, qos, retain, mid, topic, len(payload))
+
+        packet = encode_publish(mid, _utf8(topic), payload, qos, retain, dup)
+        if qos == 0:
+            return self._packet_queue(PUBLISH, packet, mid, qos, info, topic)
+        return self._packet_queue(PUBLISH, packet, mid, qos, info)
+
+    def _send_pubrec(self, mid):
+        if self._log_mask & MQTT_LOG_DEBUG:
+            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBREC (Mid: %d)", mid)
+        return self._send_command_with_mid(PUBREC, mid, False)
+
+    def _send_pubrel(self, mid, dup=False):
+        if self._log_mask & MQTT_LOG_DEBUG:
+            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBREL (Mid: %d)", mid)
+        return self._send_command_with_mid(PUBREL|2, mid, dup)
+
+    def _send_command_with_mid(self, command, mid, dup):
+        # For PUBACK, PUBCOMP, PUBREC, and PUBREL
+        if dup:
+            command = command | 8
+
+        remaining_length = 2
+        packet = pack_ack(command, remaining_length, mid)
+        return self._packet_queue(command, packet, mid, 1)
+
+    def _send_simple_command(self, command):
+        # For DISCONNECT, PINGREQ and PINGRESP
+        remaining_length = 0
+        packet = U8_U8.pack(command, remaining_length)
+        return self._packet_queue(command, packet, 0, 0)
+
+    def _send_connect(self, keepalive, clean_session):
+        self._easy_log(MQTT_LOG_DEBUG, "Sending CONNECT (c%d, k%d) client_id=%s", clean_session, keepalive, self._client_id)
+        if self._protocol == MQTTv31:
+            protocol = PROTOCOL_NAMEv31
+            proto_ver = 3
+        else:
+            protocol = PROTOCOL_NAMEv311
+            proto_ver = 4
+        if self._will:
+            will_topic = self._will_topic
+        else:
+            will_topic = None
+        packet = encode_connect(protocol, proto_ver, keepalive, self._client_id, clean_session,
+                                will_topic, self._will_payload, self._will_qos, self._will_retain,
+                                self._username, self._password)
+        command = CONNECT
+        self._keepalive = keepalive
+        return self._packet_queue(command, packet, 0, 0)
+
+    def _send_disconnect(self):
+        return self._send_simple_command(DISCONNECT)
+
+    def _send_subscribe(self, dup, topics):
+        self._easy_log(MQTT_LOG_DEBUG, "Sending SUBSCRIBE (d%d) %s", dup, topics)
+        command = SUBSCRIBE | (dup<<3) | (1<<1)
+        local_mid = self._mid_generate()
+        packet = encode_subscribe(command, local_mid, topics)
+        return (self._packet_queue(command, packet, local_mid, 1), local_mid)
+
+    def _send_unsubscribe(self, dup, topics):
+        command = UNSUBSCRIBE | (dup<<3) | (1<<1)
+        local_mid = self._mid_generate()
+        packet = encode_unsubscribe(command, local_mid, topics)
+        return (self._packet_queue(command, packet, local_mid, 1), local_mid)
+
+    # ============================================================
+    # Time
+    # ============================================================
+
+    def _next_deadline(self):
+        # When _check_keepalive() or _message_retry_check() next has work to
+        # do: a PINGREQ to send, a PINGRESP that is overdue or a message to
+        # retry. None if never.
+        deadline = None
+        if self._keepalive > 0:
+            deadline = min(self._last_msg_out, self._last_msg_in) + self._keepalive
+        heap = self._retry_heap
+        if heap and (deadline is None or heap[0][0] < deadline):
+            deadline = heap[0][0]
+        return deadline
+
+    def _check_keepalive(self):
+        # Send a PINGREQ once the connection has been quiet for a keepalive.
+        # Returns MQTT_ERR_CONN_LOST if the broker has let a keepalive go by
+        # without a CONNACK or an answer to the PINGREQ, and the transport
+        # should close the connection.
+        keepalive = self._keepalive
+        if keepalive == 0:
+            return MQTT_ERR_SUCCESS
+        now = self._now
+        if self._ping_t > 0 and now - self._ping_t >= keepalive:
+            # Waiting for a PINGRESP for a keepalive.
+            return MQTT_ERR_CONN_LOST
+        if now - self._last_msg_out >= keepalive or now - self._last_msg_in >= keepalive:
+            if self._state == mqtt_cs_connected and self._ping_t == 0:
+                self._send_pingreq()
+                self._last_msg_out = now
+                self._last_msg_in = now
+            else:
+                return MQTT_ERR_CONN_LOST
+        return MQTT_ERR_SUCCESS
+
+    def _retry_schedule(self, m):
+        # Note that m, now in one of _RETRY_STATES, is due a retry
+        # _message_retry seconds after m.timestamp. Entries are never removed
+        # when a message completes or is rescheduled. They are skipped when
+        # they come up instead, and the heap is rebuilt if they pile up.
+        # Call with _out_message_mutex held.
+        heap = self._retry_heap
+        self._retry_seq += 1
+        heapq.heappush(heap, (m.timestamp + self._message_retry, self._retry_seq, m))
+        if len(heap) > 2 * (len(self._out_messages) + len(self._in_messages)) + 64:
+            self._retry_rebuild()
+
+    def _retry_rebuild(self):
+        with self._out_message_mutex:
+            heap = []
+            seq = self._retry_seq
+            for messages in (self._out_messages, self._in_messages):
+                for m in messages.values():
+                    if m.state in _RETRY_STATES:
+                        seq += 1
+                        heap.append((m.timestamp + self._message_retry, seq, m))
+            self._retry_seq = seq
+            heapq.heapify(heap)
+            self._retry_heap = heap
+
+    def _message_retry_check(self):
+        # Retry every message whose deadline has passed. Only the messages
+        # that are due are looked at, not the whole in-flight window.
+        with self._out_message_mutex:
+            heap = self._retry_heap
+            now = self._now
+            due = []
+            while heap and heap[0][0] <= now:
+                (deadline, seq, m) = heapq.heappop(heap)
+                if m.state not in _RETRY_STATES or m.timestamp + self._message_retry != deadline:
+                    # Completed, or rescheduled since.
+                    continue
+                if m.state == mqtt_ms_wait_for_pubrel:
+                    if self._in_messages.get(m.mid) is not m:
+                        continue
+                elif self._out_messages.get(m.mid) is not m:
+                    continue
+                m.timestamp = now
+                due.append(m)
+
+            # Rescheduled once the heap has been popped, so that with a
+            # message_retry of 0 they wait for the next check.
+            for m in due:
+                m.dup = True
+                self._retry_seq += 1
+                heapq.heappush(heap, (now + self._message_retry, self._retry_seq, m))
+                if m.state == mqtt_ms_wait_for_puback or m.state == mqtt_ms_wait_for_pubrec:
+                    self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
+                elif m.state == mqtt_ms_wait_for_pubrel:
+                    self._send_pubrec(m.mid)
+                elif m.state == mqtt_ms_wait_for_pubcomp:
+                    self._send_pubrel(m.mid, True)
+
+    def _messages_reconnect_reset_out(self):
+        # Everything that was in flight is sent again once the CONNACK
+        # arrives. Queued messages keep waiting for a slot.
+        self._inflight_messages = 0
+        for m in self._out_messages.values():
+            m.timestamp = 0
+            if m.qos == 0:
+                m.state = mqtt_ms_publish
+            elif m.qos == 1:
+                if m.state == mqtt_ms_wait_for_puback:
+                    m.dup = True
+                m.state = mqtt_ms_publish
+            elif m.qos == 2:
+                if m.state == mqtt_ms_wait_for_pubcomp:
+                    m.state = mqtt_ms_resend_pubrel
+                    m.dup = True
+                else:
+                    if m.state == mqtt_ms_wait_for_pubrec:
+                        m.dup = True
+                    m.state = mqtt_ms_publish
+
+    def _messages_reconnect_reset_in(self):
+        # Only QoS 2 messages waiting for PUBREL are kept, in their current
+        # state.
+        for m in list(self._in_messages.values()):
+            m.timestamp = 0
+            if m.qos != 2:
+                del self._in_messages[m.mid]
+
+    def _messages_reconnect_reset(self):
+        with self._out_message_mutex:
+            self._messages_reconnect_reset_out()
+            self._messages_reconnect_reset_in()
+            self._retry_rebuild()
+
+    # ============================================================
+    # Receiving
+    # ============================================================
+
+    def _packet_handle(self, command, packet):
+        # Handle one incoming packet, packet being its body. Returns
+        # MQTT_ERR_PROTOCOL if it is not valid MQTT.
+        self._last_msg_in = self._now
+        cmd = command & 0xF0
+        if cmd == PUBLISH:
+            return self._handle_publish(command, packet)
+        elif cmd == PUBACK:
+            return self._handle_pubackcomp("PUBACK", packet)
+        elif cmd == PUBCOMP:
+            return self._handle_pubackcomp("PUBCOMP", packet)
+        elif cmd == PUBREC:
+            return self._handle_pubrec(packet)
+        elif cmd == PUBREL:
+            return self._handle_pubrel(packet)
+        elif cmd == PINGREQ:
+            return self._handle_pingreq()
+        elif cmd == PINGRESP:
+            return self._handle_pingresp()
+        elif cmd == CONNACK:
+            return self._handle_connack(packet)
+        elif cmd == SUBACK:
+            return self._handle_suback(packet)
+        elif cmd == UNSUBACK:
+            return self._handle_unsuback(packet)
+        else:
+            # If we don't recognise the command, return an error straight away.
+            self._easy_log(MQTT_LOG_ERR, "Error: Unrecognised command %d", cmd)
+            return MQTT_ERR_PROTOCOL
+
+    def _handle_pingreq(self):
+        self._easy_log(MQTT_LOG_DEBUG, "Received PINGREQ")
+        return self._send_pingresp()
+
+    def _handle_pingresp(self):
+        # No longer waiting for a PINGRESP.
+        self._ping_t = 0
+        self._easy_log(MQTT_LOG_DEBUG, "Received PINGRESP")
+        return MQTT_ERR_SUCCESS
+
+    def _handle_connack(self, packet):
+        if len(packet) != 2:
+            return MQTT_ERR_PROTOCOL
+
+        (flags, result) = U8_U8.unpack(packet)
+        if result == CONNACK_REFUSED_PROTOCOL_VERSION and self._protocol == MQTTv311:
+            self._easy_log(MQTT_LOG_DEBUG, "Received CONNACK (%d, %d), attempting downgrade to MQTT v3.1.", flags, result)
+            # Downgrade to MQTT v3.1
+            self._protocol = MQTTv31
+            return self._connect_retry()
+
+        if result == 0:
+            self._state = mqtt_cs_connected
+
+        self._easy_log(MQTT_LOG_DEBUG, "Received CONNACK (%d, %d)", flags, result)
+        self._on_connack(flags, result)
+        if result == 0:
+            with self._out_message_mutex:
+                rc = 0
+                # The transport writes what this queues once the read is done.
+                # on_publish() may publish more, so iterate over a copy.
+                for m in list(self._out_messages.values()):
+                    m.timestamp = self._now
+                    if m.state == mqtt_ms_publish:
+                        self._inflight_messages = self._inflight_messages + 1
+                        if m.qos == 1:
+                            m.state = mqtt_ms_wait_for_puback
+                        else:
+                            m.state = mqtt_ms_wait_for_pubrec
+                        rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
+                    elif m.state == mqtt_ms_resend_pubrel:
+                        self._inflight_messages = self._inflight_messages + 1
+                        m.state = mqtt_ms_wait_for_pubcomp
+                        rc = self._send_pubrel(m.mid, m.dup)
+                    if rc != 0:
+                        return rc
+                # The broker sends the PUBRELs it owes again itself.
+                for m in self._in_messages.values():
+                    m.timestamp = self._now
+                self._retry_rebuild()
+                if self._max_inflight_messages > 0:
+                    # Fill whatever room is left in the window from the queue.
+                    rc = self._update_inflight()
+                return rc
+        elif result > 0 and result < 6:
+            return MQTT_ERR_CONN_REFUSED
+        else:
+            return MQTT_ERR_PROTOCOL
+
+    def _handle_suback(self, packet):
+        if len(packet) < 2:
+            return MQTT_ERR_PROTOCOL
+        self._easy_log(MQTT_LOG_DEBUG, "Received SUBACK")
+        (mid, granted_qos) = unpack_suback(packet)
+        self._on_suback(mid, granted_qos)
+        return MQTT_ERR_SUCCESS
+
+    def _handle_unsuback(self, packet):
+        if len(packet) != 2:
+            return MQTT_ERR_PROTOCOL
+        mid = U16.unpack(packet)[0]
+        if self._log_mask & MQTT_LOG_DEBUG:
+            self._easy_log(MQTT_LOG_DEBUG, "Received UNSUBACK (Mid: %d)", mid)
+        self._on_unsuback(mid)
+        return MQTT_ERR_SUCCESS
+
+    def _handle_publish(self, command, packet):
+        # packet is a memoryview into the receive buffer. Slice the topic and
+        # payload out of it rather than copying them.
+        message = self._message_class()
+        message.dup = (command & 0x08)>>3
+        message.qos = qos = (command & 0x06)>>1
+        message.retain = (command & 0x01)
+
+        (slen, mid, pos) = unpack_publish_header(packet, qos)
+        if slen <= 0:
+            return MQTT_ERR_PROTOCOL
+
+        (message.topic, callbacks) = self._topic_resolve(packet[2:2+slen])
+        message.mid = mid
+        message.payload = packet[pos:]
+
+        if self._log_mask & MQTT_LOG_DEBUG:
+            self._easy_log(
+                MQTT_LOG_DEBUG, "Received PUBLISH (d%d, q%d, r%d, m%d), '%s', ...  (%d bytes)",
+                message.dup, qos, message.retain, mid, message.topic,
+                len(message.payload))
+
+        message.timestamp = self._now
+        if qos == 0:
+            self._handle_on_message(message, callbacks)
+            return MQTT_ERR_SUCCESS
+        elif qos == 1:
+            rc = self._send_puback(mid)
+            self._handle_on_message(message, callbacks)
+            return rc
+        elif qos == 2:
+            message.state = mqtt_ms_wait_for_pubrel
+            # Held until PUBREL arrives, long after the buffer is reused.
+            message.detach()
+            with self._out_message_mutex:
+                self._in_messages[mid] = message
+                if self._store is not None:
+                    self._store.in_put(mid, qos, message.retain, message.topic, message.payload)
+                self._retry_schedule(message)
+            return self._send_pubrec(mid)
+        else:
+            return MQTT_ERR_PROTOCOL
+
+    def _handle_pubrel(self, packet):
+        if len(packet) != 2:
+            return MQTT_ERR_PROTOCOL
+
+        mid = U16.unpack(packet)[0]
+        if self._log_mask & MQTT_LOG_DEBUG:
+            self._easy_log(MQTT_LOG_DEBUG, "Received PUBREL (Mid: %d)", mid)
+
+        # Only pass the message on if we have removed it from the table - this
+        # prevents multiple callbacks for the same message. The PUBREL is
+        # answered either way, as it is sent again until it is.
+        message = self._in_messages.pop(mid, None)
+        if message is not None:
+            if self._store is not None:
+                self._store.in_del(mid)
+            self._handle_on_message(message)
+        return self._send_pubcomp(mid)
+
+    def _handle_pubrec(self, packet):
+        if len(packet) != 2:
+            return MQTT_ERR_PROTOCOL
+
+        mid = U16.unpack(packet)[0]
+        if self._log_mask & MQTT_LOG_DEBUG:
+            self._easy_log(MQTT_LOG_DEBUG, "Received PUBREC (Mid: %d)", mid)
+
+        with self._out_message_mutex:
+            m = self._out_messages.get(mid)
+            if m is not None:
+                if m.state == mqtt_ms_wait_for_pubrec and not m.dup:
+                    self._inflight_rtt(self._now - m.timestamp)
+                m.state = mqtt_ms_wait_for_pubcomp
+                if self._store is not None:
+                    self._store.out_state(mid, m.state)
+                m.timestamp = self._now
+                self._retry_schedule(m)
+                return self._send_pubrel(mid, False)
+
+        return MQTT_ERR_SUCCESS
+
+    def _handle_pubackcomp(self, cmd, packet):
+        if len(packet) != 2:
+            return MQTT_ERR_PROTOCOL
+
+        mid = U16.unpack(packet)[0]
+        if self._log_mask & MQTT_LOG_DEBUG:
+            self._easy_log(MQTT_LOG_DEBUG, "Received %s (Mid: %d)", cmd, mid)
+
+        with self._out_message_mutex:
+            m = self._out_messages.pop(mid, None)
+            if m is not None:
+                if self._store is not None:
+                    self._store.out_del(mid)
+                if m.qos == 1 and not m.dup:
+                    self._inflight_rtt(self._now - m.timestamp)
+                # Only inform the client the message has been sent once.
+                self._publish_complete(m.info)
+                self._inflight_messages = self._inflight_messages - 1
+                if self._max_inflight_messages > 0:
+                    rc = self._update_inflight()
+                    if rc != MQTT_ERR_SUCCESS:
+                        return rc
+
+        return MQTT_ERR_SUCCESS
+
+
+class MQTTProtocol(MQTTSession):
+    """Protocol state of an MQTT client session, with no I/O.
+
+    Every method that makes the protocol send something appends the packet
+    to the output buffer; call data_to_send() afterwards and write what it
+    returns. Times are in seconds from any clock, as long as it is the same
+    one throughout. Methods that take no now argument use the time given to
+    the last call that did.
+
+    Outgoing QoS 1 and 2 messages are kept until they are acknowledged, and
+    are sent again with the DUP flag on reconnect, or after message_retry
+    seconds without an acknowledgement. At most max_inflight of them are in
+    flight at once; the rest wait their turn. Incoming QoS 2 messages are
+    delivered once, when the PUBREL arrives.
+    """
+    def __init__(self, client_id="", clean_session=True, protocol=MQTTv311):
+        if protocol != MQTTv31 and protocol != MQTTv311:
+            raise ValueError('Invalid protocol version.')
+        if not clean_session and not client_id:
+            raise ValueError('A client id must be provided if clean session is False.')
+        MQTTSession.__init__(self, client_id, clean_session, protocol)
+        self._open = False
+        # Received bytes not yet handled, from _in_pos on. Only the start of
+        # a packet that has not all arrived is ever held.
+        self._in_buf = bytearray()
+        self._in_pos = 0
+        self._out = bytearray()
+        # The events of the receive_data() or tick() call under way.
+        self._events = []
+
+    @property
+    def keepalive(self):
+        """The keepalive of the last connect()."""
+        return self._keepalive
+
+    @property
+    def username(self):
+        """The username sent with the next CONNECT, if any."""
+        return self._username
+
+    @username.setter
+    def username(self, username):
+        self._username = username
+
+    @property
+    def password(self):
+        """The password sent with the next CONNECT, if there is a username."""
+        return self._password
+
+    @password.setter
+    def password(self, password):
+        self._password = password
+
+    @property
+    def max_inflight(self):
+        """The most QoS 1 and 2 messages in flight at once, 20 by default."""
+        return self._max_inflight_messages
+
+    @max_inflight.setter
+    def max_inflight(self, inflight):
+        if inflight < 0:
+            raise ValueError('Invalid inflight.')
+        self._max_inflight_messages = inflight
+
+    @property
+    def message_retry(self):
+        """Seconds before an unacknowledged message is sent again, 20 by
+        default."""
+        return self._message_retry
+
+    @message_retry.setter
+    def message_retry(self, retry):
+        if retry < 0:
+            raise ValueError('Invalid retry.')
+        self._message_retry = retry
+        self._retry_rebuild()
+
+    @property
+    def connected(self):
+        """True from an accepting CONNACK until the connection is lost."""
+        return self._state == mqtt_cs_connected
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        """Set the Will sent with the next CONNECT."""
+        if not topic:
+            raise ValueError('Invalid topic.')
+        if qos < 0 or qos > 2:
+            raise ValueError('Invalid QoS level.')
+        self._will = True
+        self._will_topic = topic
+        self._will_payload = encode_payload(payload)
+        self._will_qos = qos
+        self._will_retain = retain
+
+    def data_to_send(self):
+        """Return the bytes queued for sending since the last call, and empty
+        the output buffer. The transport must write all of them, in order."""
+        data = self._out
+        if data:
+            self._out = bytearray()
+        return data
+
+    def connect(self, keepalive=60, now=0):
+        """Start a new connection: forget anything half received from the
+        last one and queue a CONNECT. Call it after every (re)connect of the
+        transport, before anything else is sent."""
+        if keepalive < 0:
+            raise ValueError('Keepalive must be >=0.')
+        self._now = now
+        self._open = True
+        self._state = mqtt_cs_new
+        self._in_buf = bytearray()
+        self._in_pos = 0
+        self._out = bytearray()
+        self._last_msg_in = self._last_msg_out = now
+        self._ping_t = 0
+        self._messages_reconnect_reset()
+        self._send_connect(keepalive, self._clean_session)
+
+    def connection_lost(self):
+        """Tell the protocol the transport has gone. Messages in flight are
+        kept for the next connect()."""
+        self._open = False
+        self._state = mqtt_cs_new
+        self._in_buf = bytearray()
+        self._in_pos = 0
+        self._out = bytearray()
+
+    def disconnect(self):
+        """Queue a DISCONNECT."""
+        self._state = mqtt_cs_disconnecting
+        self._send_disconnect()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        """Queue a message for publishing and return its mid.
+
+        A QoS 0 message is only sent if the protocol is connected. QoS 1 and
+        2 messages are sent when there is room in the in-flight window and a
+        connection, and an EV_PUBLISHED event reports their completion."""
+        if qos < 0 or qos > 2:
+            raise ValueError('Invalid QoS level.')
+        if not topic:
+            raise ValueError('Invalid topic.')
+        payload = encode_payload(payload)
+        mid = self._mid_generate()
+        if qos == 0:
+            if self._state == mqtt_cs_connected:
+                # Nothing to track, so straight into the output buffer.
+                pack_publish(self._out, mid, _utf8(topic), payload, 0, retain, False)
+                self._last_msg_out = self._now
+        else:
+            self._publish(mid, topic, payload, qos, retain, MQTTMessageInfo(mid))
+        return mid
+
+    def subscribe(self, topics):
+        """Queue a SUBSCRIBE for topics, a list of (topic, qos), and return
+        its mid."""
+        if not topics:
+            raise ValueError('No topic specified.')
+        return self._send_subscribe(False, [(_utf8(t[0]), t[1]) for t in topics])[1]
+
+    def unsubscribe(self, topics):
+        """Queue an UNSUBSCRIBE for topics, a list of topic filters, and return
+        its mid."""
+        if not topics:
+            raise ValueError('No topic specified.')
+        return self._send_unsubscribe(False, [_utf8(t) for t in topics])[1]
+
+    def receive_data(self, data, now=0):
+        """Feed bytes received from the broker into the protocol and return
+        the list of events they complete. A packet split across calls is
+        held until the rest of it arrives. Raises ProtocolError if data is
+        not valid MQTT."""
+        self._now = now
+        events = self._events = []
+        buf = self._in_buf
+        pos = self._in_pos
+        if pos == len(buf):
+            # Nothing held back, so handle data where it is.
+            buf = data
+            pos = 0
+        else:
+            # Appending only copies data, not what is already held, so a
+            # large packet arriving in many reads costs linear time.
+            buf.extend(data)
+        end = len(buf)
+        frames, pos, remaining_length, start = split_frames(buf, pos, end)
+        if frames:
+            # Messages are detached before they are handed out, so no view
+            # into buf outlives this loop.
+            view = memoryview(buf)
+            for command, body_start, body_end in frames:
+                if self._packet_handle(command, view[body_start:body_end]) == MQTT_ERR_PROTOCOL:
+                    raise ProtocolError('Invalid packet 0x%02x.' % command)
+            view = None
+        if start < 0:
+            raise ProtocolError('Invalid remaining length.')
+        if buf is data:
+            if pos < end:
+                self._in_buf.extend(memoryview(data)[pos:])
+        elif pos == end:
+            del buf[:]
+            self._in_pos = 0
+        elif pos > end >> 1:
+            # Drop what has been handled once it is most of the buffer.
+            del buf[:pos]
+            self._in_pos = 0
+        else:
+            self._in_pos = pos
+        return events
+
+    def tick(self, now):
+        """Do the time based work due at now: send a PINGREQ if the
+        connection has been idle for keepalive seconds, and resend messages
+        unacknowledged for message_retry seconds. Returns a list of events,
+        [(EV_TIMEOUT,)] if the broker has not answered the CONNECT or a
+        PINGREQ in time, in which case the transport should drop the
+        connection."""
+        self._now = now
+        if not self._open:
+            return []
+        if self._check_keepalive() != MQTT_ERR_SUCCESS:
+            return [(EV_TIMEOUT,)]
+        heap = self._retry_heap
+        if heap and heap[0][0] <= now:
+            self._message_retry_check()
+        return []
+
+    def next_deadline(self):
+        """Return the time tick() next has work to do, or None if it has
+        none."""
+        if not self._open:
+            return None
+        return self._next_deadline()
+
+    def inflight(self):
+        """Return the number of outgoing QoS 1 and 2 messages in flight."""
+        return self._inflight_messages
+
+    # ============================================================
+    # Private functions
+    # ============================================================
+
+    def _packet_queue(self, command, packet, mid, qos, info=None, topic=None):
+        if not self._open:
+            return MQTT_ERR_NO_CONN
+        self._out += packet
+        self._last_msg_out = self._now
+        return MQTT_ERR_SUCCESS
+
+    def _connect_retry(self):
+        # Reported as refused, for the transport to connect again with
+        # MQTT v3.1.
+        self._events.append((EV_CONNACK, 0, CONNACK_REFUSED_PROTOCOL_VERSION))
+        return MQTT_ERR_CONN_REFUSED
+
+    def _on_connack(self, flags, result):
+        self._events.append((EV_CONNACK, flags, result))
+
+    def _on_suback(self, mid, granted_qos):
+        self._events.append((EV_SUBACK, mid, granted_qos))
+
+    def _on_unsuback(self, mid):
+        self._events.append((EV_UNSUBACK, mid))
+
+    def _handle_on_message(self, message, callbacks=None):
+        self._events.append((EV_MESSAGE, message.detach()))
+
+    def _publish_complete(self, info):
+        info._published = True
+        self._events.append((EV_PUBLISHED, info.mid))
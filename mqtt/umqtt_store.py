@@ -0,0 +1,433 @@
+# Copyright (c) 2012-2014 Roger Light <roger@atchoo.org>
+#
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# and Eclipse Distribution License v1.0 which accompany this distribution.
+#
+# The Eclipse Public License is available at
+#    http://www.eclipse.org/legal/epl-v10.html
+# and the Eclipse Distribution License is available at
+#   http://www.eclipse.org/org/documents/edl-v10.php.
+#
+# Contributors:
+#    Roger Light - initial API and implementation
+
+"""
+Session stores for umqtt2, see Client.session_store_set().
+
+A store holds the QoS 1 and 2 messages that are part way through their flow,
+so that a client restarted with clean_session=False can finish them instead
+of losing them. SessionStore is the interface the client calls and keeps
+nothing. FileSessionStore appends each change to a log file, which is
+rewritten with only the live messages once it is mostly dead records.
+
+SpillQueue holds messages published while the client is disconnected, see
+Client.offline_queue_set(). write_messages() and read_messages() save and
+load the last value cache, see Client.last_value_cache_set().
+"""
+
+import collections
+import os
+import struct
+import threading
+import zlib
+
+# A record is a CRC-32 of the rest of it, then the operation, the message
+# state, the mid and the length of the data that follows.
+_CRC = struct.Struct("!I")
+_RECORD = struct.Struct("!BBHI")
+_HEADER_SIZE = _CRC.size + _RECORD.size
+
+# Data of a message record: qos, retain and topic length, then the UTF-8
+# topic and the payload.
+_MESSAGE = struct.Struct("!BBH")
+
+_OUT_PUT = 1
+_OUT_STATE = 2
+_OUT_DEL = 3
+_IN_PUT = 4
+_IN_DEL = 5
+
+# Dead records a log may hold beyond its live ones before it is compacted.
+COMPACT_MIN = 1024
+
+# Length of a message in a SpillQueue segment file or a write_messages() file.
+_LENGTH = struct.Struct("!I")
+
+
+class SessionStore(object):
+    """The interface between Client and a session store, which does not
+    store anything. Subclass it and override every method for a store of
+    your own.
+
+    Messages are identified by direction and mid. Outgoing messages are
+    added with out_put() as they are published, change state as their flow
+    progresses and are removed with out_del() once complete. Incoming QoS 2
+    messages are added with in_put() when the PUBLISH arrives and removed
+    with in_del() at the PUBREL. state is one of the client's mqtt_ms_*
+    constants. Changes need not be durable until commit() returns, which
+    the client calls before sending any packet that depends on them. The
+    methods may be called from more than one thread."""
+
+    def load(self):
+        """Return (out, in), the messages in the store when it was opened.
+        Each is a list of (mid, state, qos, retain, topic, payload) tuples,
+        oldest first."""
+        return [], []
+
+    def out_put(self, mid, state, qos, retain, topic, payload):
+        pass
+
+    def out_state(self, mid, state):
+        pass
+
+    def out_del(self, mid):
+        pass
+
+    def in_put(self, mid, qos, retain, topic, payload):
+        pass
+
+    def in_del(self, mid):
+        pass
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FileSessionStore(SessionStore):
+    """A session store kept in the file at path.
+
+    Changes are buffered in memory and appended to the file together by
+    commit(), one write() and, if fsync is true, one fsync() for everything
+    since the last commit. The live messages are also kept in memory. When
+    the file holds more than compact_min dead records beyond its live ones,
+    it is rewritten with only the live ones, to a temporary file that then
+    replaces it.
+
+    Every record carries a checksum. Opening the store reads the file up to
+    the first record that is incomplete or damaged, as left by a crash part
+    way through a write, and rewrites it without that tail."""
+
+    def __init__(self, path, fsync=True, compact_min=COMPACT_MIN):
+        self._path = path
+        self._fsync = fsync
+        self._compact_min = compact_min
+        self._lock = threading.Lock()
+        self._file = None
+        self._pending = bytearray()
+        # Live messages, mid -> [state, data] going out and mid -> data
+        # coming in, as encoded in their records.
+        self._out = collections.OrderedDict()
+        self._in = collections.OrderedDict()
+        self._records = 0
+        self._commits = 0
+        self._compactions = 0
+        self._read()
+        self._loaded = (self._decode(self._out.items(), True),
+                        self._decode(self._in.items(), False))
+        with self._lock:
+            self._compact()
+
+    def load(self):
+        return self._loaded
+
+    def out_put(self, mid, state, qos, retain, topic, payload):
+        data = _encode_message(qos, retain, topic, payload)
+        with self._lock:
+            self._out.pop(mid, None)
+            self._out[mid] = [state, data]
+            self._append(_OUT_PUT, state, mid, data)
+
+    def out_state(self, mid, state):
+        with self._lock:
+            entry = self._out.get(mid)
+            if entry is not None:
+                entry[0] = state
+                self._append(_OUT_STATE, state, mid, b"")
+
+    def out_del(self, mid):
+        with self._lock:
+            if self._out.pop(mid, None) is not None:
+                self._append(_OUT_DEL, 0, mid, b"")
+
+    def in_put(self, mid, qos, retain, topic, payload):
+        data = _encode_message(qos, retain, topic, payload)
+        with self._lock:
+            self._in.pop(mid, None)
+            self._in[mid] = data
+            self._append(_IN_PUT, 0, mid, data)
+
+    def in_del(self, mid):
+        with self._lock:
+            if self._in.pop(mid, None) is not None:
+                self._append(_IN_DEL, 0, mid, b"")
+
+    def commit(self):
+        """Write out the changes made since the last commit."""
+        with self._lock:
+            if not self._pending:
+                return
+            self._file.write(self._pending)
+            self._file.flush()
+            if self._fsync:
+                os.fsync(self._file.fileno())
+            del self._pending[:]
+            self._commits += 1
+            live = len(self._out) + len(self._in)
+            if self._records - live > max(self._compact_min, live):
+                self._compact()
+
+    def close(self):
+        self.commit()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def stats(self):
+        """Return a dict with the number of live messages each way, the
+        records in the log, and the commits and compactions since the store
+        was opened."""
+        with self._lock:
+            return {
+                'out': len(self._out),
+                'in': len(self._in),
+                'records': self._records,
+                'commits': self._commits,
+                'compactions': self._compactions}
+
+    def _append(self, op, state, mid, data):
+        body = _RECORD.pack(op, state, mid, len(data)) + data
+        self._pending += _CRC.pack(zlib.crc32(body) & 0xFFFFFFFF)
+        self._pending += body
+        self._records += 1
+
+    def _decode(self, entries, out):
+        messages = []
+        for (mid, entry) in entries:
+            (state, data) = entry if out else (0, entry)
+            messages.append((mid, state) + _decode_message(data))
+        return messages
+
+    def _read(self):
+        try:
+            with open(self._path, 'rb') as f:
+                buf = f.read()
+        except IOError:
+            return
+        pos = 0
+        end = len(buf)
+        while pos + _HEADER_SIZE <= end:
+            (crc,) = _CRC.unpack_from(buf, pos)
+            (op, state, mid, length) = _RECORD.unpack_from(buf, pos + _CRC.size)
+            stop = pos + _HEADER_SIZE + length
+            if stop > end or zlib.crc32(buf[pos + _CRC.size:stop]) & 0xFFFFFFFF != crc:
+                break
+            data = buf[pos + _HEADER_SIZE:stop]
+            pos = stop
+            if op == _OUT_PUT:
+                self._out.pop(mid, None)
+                self._out[mid] = [state, data]
+            elif op == _OUT_STATE:
+                entry = self._out.get(mid)
+                if entry is not None:
+                    entry[0] = state
+            elif op == _OUT_DEL:
+                self._out.pop(mid, None)
+            elif op == _IN_PUT:
+                self._in.pop(mid, None)
+                self._in[mid] = data
+            elif op == _IN_DEL:
+                self._in.pop(mid, None)
+            else:
+                break
+
+    def _compact(self):
+        # Write just the live messages to a new file and swap it in. Pending
+        # changes are already reflected in them.
+        buf = bytearray()
+        self._pending = buf
+        self._records = 0
+        for (mid, (state, data)) in self._out.items():
+            self._append(_OUT_PUT, state, mid, data)
+        for (mid, data) in self._in.items():
+            self._append(_IN_PUT, 0, mid, data)
+        self._pending = bytearray()
+
+        if self._file is not None:
+            self._file.close()
+        tmp = self._path + ".tmp"
+        with open(tmp, 'wb') as f:
+            f.write(buf)
+            f.flush()
+            if self._fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp, self._path)
+        if self._fsync and hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(os.path.dirname(os.path.abspath(self._path)), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self._file = open(self._path, 'ab')
+        self._compactions += 1
+
+
+class SpillQueue(object):
+    """A first in, first out queue of (topic, payload, qos, retain, info)
+    messages. Up to max_messages of them, and max_bytes of topic and
+    payload, are kept in memory. With a path, the messages behind those go
+    to a segment file there, up to file_max_bytes of it. put() returns
+    False when both are full.
+
+    The info of a message in the file stays in memory, so the file can't
+    be read back after a restart and is removed by close(). Its space is
+    reclaimed each time it empties.
+
+    A message only goes to the client's SessionStore once it leaves this
+    queue, so QoS 1 and 2 messages still queued are lost if the process
+    restarts while offline."""
+
+    def __init__(self, max_messages, max_bytes, path=None, file_max_bytes=0):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self._path = path
+        self._file_max_bytes = file_max_bytes
+        self._memory = collections.deque()
+        self._memory_bytes = 0
+        self._file = None
+        self._file_infos = collections.deque()
+        self._read_pos = 0
+        self._write_pos = 0
+        self._spilled = 0
+
+    def __len__(self):
+        return len(self._memory) + len(self._file_infos)
+
+    def put(self, topic, payload, qos, retain, info):
+        size = len(topic) + (len(payload) if payload else 0)
+        # Nothing may pass messages already in the file.
+        if not self._file_infos and self._memory_fits(size):
+            self._memory.append((topic, payload, qos, retain, info))
+            self._memory_bytes += size
+            return True
+        if self._path is None:
+            return False
+        data = _encode_message(qos, retain, topic, payload)
+        if self._write_pos - self._read_pos + _LENGTH.size + len(data) > self._file_max_bytes:
+            return False
+        if self._file is None:
+            self._file = open(self._path, 'w+b')
+        self._file.seek(self._write_pos)
+        self._file.write(_LENGTH.pack(len(data)))
+        self._file.write(data)
+        self._write_pos = self._file.tell()
+        self._file_infos.append(info)
+        self._spilled += 1
+        return True
+
+    def get(self):
+        """Remove and return the oldest message, None if there are none."""
+        if not self._memory:
+            self._refill()
+            if not self._memory:
+                return None
+        message = self._memory.popleft()
+        self._memory_bytes -= len(message[0]) + (len(message[1]) if message[1] else 0)
+        if self._file_infos:
+            self._refill()
+        return message
+
+    def stats(self):
+        """Return a dict with the messages and bytes in memory and in the
+        file, and the number of messages ever put in the file."""
+        return {
+            'messages': len(self._memory),
+            'bytes': self._memory_bytes,
+            'file_messages': len(self._file_infos),
+            'file_bytes': self._write_pos - self._read_pos,
+            'spilled': self._spilled}
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self._path)
+
+    def _memory_fits(self, size):
+        return (len(self._memory) < self.max_messages
+                and (self._memory_bytes + size <= self.max_bytes or not self._memory))
+
+    def _refill(self):
+        # Move messages from the head of the file into memory while they fit.
+        f = self._file
+        infos = self._file_infos
+        if infos:
+            f.seek(self._read_pos)
+        while infos:
+            (length,) = _LENGTH.unpack(f.read(_LENGTH.size))
+            data = f.read(length)
+            (qos, retain, topic, payload) = _decode_message(data)
+            size = len(topic) + (len(payload) if payload else 0)
+            if not self._memory_fits(size):
+                break
+            self._read_pos += _LENGTH.size + length
+            self._memory.append((topic, payload, qos, retain, infos.popleft()))
+            self._memory_bytes += size
+        if not infos and self._write_pos:
+            f.truncate(0)
+            self._read_pos = self._write_pos = 0
+
+
+def write_messages(path, messages):
+    """Replace the file at path with (qos, retain, topic, payload) messages.
+    They are written to a temporary file first, so a crash leaves either
+    the old file or the new one."""
+    tmp = path + ".tmp"
+    with open(tmp, 'wb') as f:
+        for (qos, retain, topic, payload) in messages:
+            data = _encode_message(qos, retain, topic, payload)
+            f.write(_LENGTH.pack(len(data)))
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def read_messages(path):
+    """Return the (qos, retain, topic, payload) messages in a file written by
+    write_messages(), or an empty list if there is no such file."""
+    try:
+        with open(path, 'rb') as f:
+            buf = f.read()
+    except IOError:
+        return []
+    messages = []
+    pos = 0
+    while pos + _LENGTH.size <= len(buf):
+        (length,) = _LENGTH.unpack_from(buf, pos)
+        pos += _LENGTH.size
+        if pos + length > len(buf):
+            break
+        messages.append(_decode_message(buf[pos:pos+length]))
+        pos += length
+    return messages
+
+
+def _encode_message(qos, retain, topic, payload):
+    utopic = topic.encode('utf-8')
+    data = _MESSAGE.pack(qos, retain, len(utopic)) + utopic
+    if payload:
+        data += payload
+    return data
+
+
+def _decode_message(data):
+    # Returns (qos, retain, topic, payload) of a message encoded by
+    # _encode_message().
+    (qos, retain, tlen) = _MESSAGE.unpack_from(data)
+    pos = _MESSAGE.size + tlen
+    return (qos, bool(retain), data[_MESSAGE.size:pos].decode('utf-8'), data[pos:] or None)